@@ -0,0 +1,160 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+"use strict";
+
+module.metadata = {
+  "stability": "experimental"
+};
+
+const memory = require('api-utils/memory');
+const timer = require("./timer");
+const { reportResult } = require("./system");
+
+// How long a sample should take, in milliseconds, unless cfx says otherwise.
+const DEFAULT_SAMPLE_TIME = 100;
+const DEFAULT_SAMPLES = 10;
+// Calibration stops growing the iteration count here, so that an empty
+// benchmark does not run forever.
+const MAX_ITERATIONS = 1e8;
+
+/**
+ * Runs the benchmarks of the `bench-*.js` modules that cfx passes as
+ * allTestModules. Every function such a module exports, but `setup` and
+ * `teardown`, is a benchmark: a synchronous function that is called over
+ * and over. Calls onDone with a summary like the one of a TestRunner.
+ */
+exports.findAndRunBenchmarks = function findAndRunBenchmarks(options) {
+  var TestFinder = require("./unit-test-finder").TestFinder;
+  var finder = new TestFinder({
+    filter: options.filter,
+    testInProcess: true
+  });
+  var runner = new BenchmarkRunner({
+    sampleTime: options.sampleTime,
+    samples: options.samples
+  });
+  finder.findTests(function (benchmarks) {
+    runner.startMany({benchmarks: benchmarks,
+                      stopOnError: options.stopOnError,
+                      onDone: options.onDone});
+  });
+};
+
+var BenchmarkRunner = exports.BenchmarkRunner =
+function BenchmarkRunner(options) {
+  memory.track(this);
+  this.sampleTime = (options && options.sampleTime) || DEFAULT_SAMPLE_TIME;
+  this.samples = (options && options.samples) || DEFAULT_SAMPLES;
+  this.console = (options && "console" in options) ? options.console : console;
+  this.passed = 0;
+  this.failed = 0;
+  this.testRunSummary = [];
+};
+
+BenchmarkRunner.prototype = {
+  toString: function toString() "[object BenchmarkRunner]",
+
+  // Returns how many milliseconds `iterations` calls of `fn` take.
+  time: function time(fn, iterations) {
+    let start = Date.now();
+    for (let i = 0; i < iterations; i++)
+      fn();
+    return Date.now() - start;
+  },
+
+  // Returns how many calls of `fn` take about this.sampleTime.
+  calibrate: function calibrate(fn) {
+    let iterations = 1;
+    while (iterations < MAX_ITERATIONS) {
+      let elapsed = this.time(fn, iterations);
+      if (elapsed >= this.sampleTime)
+        break;
+      // grow by at most 10x, since the first calls may be slow ones
+      let factor = elapsed ? Math.ceil(this.sampleTime * 1.2 / elapsed) : 10;
+      iterations = Math.min(iterations * Math.min(factor, 10),
+                            MAX_ITERATIONS);
+    }
+    return iterations;
+  },
+
+  start: function start(options) {
+    let self = this;
+    let benchmark = options.benchmark;
+    let samples = [];
+    let iterations;
+
+    function finish(error) {
+      try {
+        if (benchmark.teardown)
+          benchmark.teardown();
+      } catch (e) {
+        error = error || e;
+      }
+      let entry = {action: "bench-end", bench: benchmark.name};
+      if (error) {
+        self.failed++;
+        self.console.error(benchmark.name + " failed:");
+        self.console.exception(error);
+        entry.error = String(error);
+      } else {
+        self.passed++;
+        self.console.info(benchmark.name + ": " + iterations +
+                          " iterations x " + samples.length + " samples");
+        entry.iterations = iterations;
+        entry.samples = samples;
+      }
+      self.testRunSummary.push({
+        name: benchmark.name,
+        passed: error ? 0 : 1,
+        failed: error ? 1 : 0,
+        errors: error ? "exception" : ""
+      });
+      reportResult(entry);
+      options.onDone(self, !!error);
+    }
+
+    // yield to the event loop between samples, so that the browser stays
+    // responsive and the benchmarks do not add up to one long script
+    function nextSample() {
+      try {
+        if (samples.length == self.samples)
+          return finish(null);
+        samples.push(self.time(benchmark.testFunction, iterations) /
+                     iterations);
+      } catch (e) {
+        return finish(e);
+      }
+      timer.setTimeout(nextSample, 0);
+    }
+
+    reportResult({action: "bench-start", bench: benchmark.name});
+    try {
+      if (benchmark.setup)
+        benchmark.setup();
+      iterations = this.calibrate(benchmark.testFunction);
+    } catch (e) {
+      finish(e);
+      return;
+    }
+    timer.setTimeout(nextSample, 0);
+  },
+
+  startMany: function startMany(options) {
+    let self = this;
+    function runNext(runner, failed) {
+      let benchmark = options.benchmarks.shift();
+      if (options.stopOnError && failed) {
+        self.console.error("aborted: benchmark failed and --stop-on-error " +
+                           "was specified");
+        options.onDone(self);
+      } else if (benchmark) {
+        self.start({benchmark: benchmark, onDone: runNext});
+      } else {
+        options.onDone(self);
+      }
+    }
+    runNext(this, false);
+  }
+};
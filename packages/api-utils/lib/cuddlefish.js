@@ -30,8 +30,44 @@ const loaderModule = loaderSandbox.exports;
 
 const { override } = loaderModule;
 
+// Converts cfx-py generated paths to module ids, like bootstrap.js does.
+function path2id(path) {
+  // Strips out `/lib` and `.js` from package/lib/path.js
+  return path.replace(/([^\/]*)\/lib/, '$1').replace(/.js$/, '');
+}
+
+// Returns a function that finds the manifest entry for a module id. Compact
+// manifests (`cfx --compact-manifest`, format 2) keep each path and
+// requirement name once in `strings`, and describe every module as a row of
+// indexes into it: `[ path, name, target, name, target, ... ]`. A row is
+// only decoded the first time its module requires something, so add-ons
+// don't pay at startup for modules they never load. Other manifests are
+// already maps of module ids to entries.
+function ManifestLookup(manifest) {
+  if (!manifest || manifest.format !== 2)
+    return function lookup(id) id in manifest && manifest[id];
+
+  let { strings, modules } = manifest;
+  let rows = {};
+  modules.forEach(function(row) {
+    rows[path2id(strings[row[0]])] = row;
+  });
+  let entries = {};
+  return function lookup(id) {
+    if (id in entries)
+      return entries[id];
+    if (!(id in rows))
+      return false;
+    let row = rows[id];
+    let requirements = {};
+    for (let i = 1; i < row.length; i += 2)
+      requirements[strings[row[i]]] = path2id(strings[row[i + 1]]);
+    return entries[id] = { requirements: requirements };
+  };
+}
+
 function CuddlefishLoader(options) {
-  let { manifest } = options;
+  let lookup = ManifestLookup(options.manifest);
 
   options = override(options, {
     // Put `api-utils/loader` and `api-utils/cuddlefish` loaded as JSM to module
@@ -41,7 +77,7 @@ function CuddlefishLoader(options) {
       'api-utils/cuddlefish': exports
     }, options.modules),
     resolve: function resolve(id, requirer) {
-      let entry = requirer && requirer in manifest && manifest[requirer];
+      let entry = requirer && lookup(requirer);
       let uri = null;
 
       // If manifest entry for this requirement is present we follow manifest.
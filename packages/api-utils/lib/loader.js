@@ -177,7 +177,7 @@ exports.evaluate = evaluate;
 // Populates `exports` of the given CommonJS `module` object, in the context
 // of the given `loader` by evaluating code associated with it.
 const load = iced(function load(loader, module) {
-  let { sandboxes, globals } = loader;
+  let { sandboxes, globals, source } = loader;
   let require = Require(loader, module);
 
   let sandbox = sandboxes[module.uri] = Sandbox({
@@ -196,7 +196,7 @@ const load = iced(function load(loader, module) {
     wantXrays: false
   });
 
-  evaluate(sandbox, module.uri);
+  evaluate(sandbox, module.uri, { source: source(module.uri) });
 
   if (module.exports && typeof(module.exports) === 'object')
     freeze(module.exports);
@@ -326,12 +326,16 @@ exports.unload = unload;
 //   module object (that has `uri` property) and `baseURI` of the loader.
 //   If `resolve` does not returns `uri` string exception will be thrown by
 //   an associated `require` call.
+// - `source` Optional function that is called with the `uri` of each module
+//   that is about to be loaded, and may return its source code. Modules for
+//   which it returns `null` are loaded from their `uri`.
 const Loader = iced(function Loader(options) {
-  let { modules, globals, resolve, paths } = override({
+  let { modules, globals, resolve, paths, source } = override({
     paths: {},
     modules: {},
     globals: {},
-    resolve: exports.resolve
+    resolve: exports.resolve,
+    source: function source(uri) null
   }, options);
 
   // We create an identity object that will be dispatched on an unload
@@ -380,6 +384,7 @@ const Loader = iced(function Loader(options) {
     // Map of module sandboxes indexed by module URIs.
     sandboxes: { enumerable: false, value: {} },
     resolve: { enumerable: false, value: resolve },
+    source: { enumerable: false, value: source },
     // Main (entry point) module, it can be set only once, since loader
     // instance can have only one main module.
     main: new function() {
@@ -89,6 +89,32 @@ var getObjects = exports.getObjects = function getObjects(bin) {
   return results;
 };
 
+/**
+ * Returns how much memory the application uses, as the "resident" and
+ * "explicit" byte counts of its memory reporter manager (null where it does
+ * not have them), and how many of the tracked objects are alive, in all and
+ * in each bin.
+ */
+var getUsage = exports.getUsage = function getUsage() {
+  var usage = {resident: null, explicit: null, trackedObjects: 0, bins: {}};
+  var mgr = Cc["@mozilla.org/memory-reporter-manager;1"]
+            .getService(Ci.nsIMemoryReporterManager);
+  ["resident", "explicit"].forEach(function(name) {
+    try {
+      if (typeof mgr[name] == "number" && mgr[name] >= 0)
+        usage[name] = mgr[name];
+    } catch (e) {}
+  });
+  for (let name in trackedObjects) {
+    let count = getObjects(name).length;
+    if (count) {
+      usage.bins[name] = count;
+      usage.trackedObjects += count;
+    }
+  }
+  return usage;
+};
+
 var gc = exports.gc = function gc() {
   // Components.utils.forceGC() doesn't currently perform
   // cycle collection, which means that e.g. DOM elements
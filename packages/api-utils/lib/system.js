@@ -82,6 +82,25 @@ exports.stdout = new function() {
   return Object.freeze({ write: write });
 };
 
+/**
+ * Writes `entry` as a line of JSON to the file that 'cfx' reads test results
+ * from while the tests run, if there is one.
+ */
+exports.reportResult = function() {
+  if (!('resultStreamFile' in options && options.resultStreamFile))
+    return function reportResult() {};
+  let mode = PR_WRONLY | PR_CREATE_FILE | PR_APPEND;
+  let stream = openFile(options.resultStreamFile, mode);
+  return function reportResult(entry) {
+    // escape what isn't ASCII, so that the stream gets one byte per char
+    let text = JSON.stringify(entry).replace(/[\u007f-\uffff]/g, function(c) {
+      return "\\u" + ("0000" + c.charCodeAt(0).toString(16)).slice(-4);
+    }) + "\n";
+    stream.write(text, text.length);
+    stream.flush();
+  };
+}();
+
 /**
  * Returns a path of the system's or application's special directory / file
  * associated with a given `id`. For list of possible `id`s please see:
@@ -11,6 +11,10 @@ module.metadata = {
 
 const memory = require('api-utils/memory');
 var timer = require("./timer");
+var { reportResult } = require("./system");
+
+// How many failure messages of a test go into its result for cfx.
+const MAX_REPORTED_MESSAGES = 10;
 
 exports.findAndRunTests = function findAndRunTests(options) {
   var TestFinder = require("./unit-test-finder").TestFinder;
@@ -19,7 +23,8 @@ exports.findAndRunTests = function findAndRunTests(options) {
     testInProcess: options.testInProcess,
     testOutOfProcess: options.testOutOfProcess
   });
-  var runner = new TestRunner({fs: options.fs});
+  var runner = new TestRunner({fs: options.fs,
+                               profileMemory: options.profileMemory});
   finder.findTests(
     function (tests) {
       runner.startMany({tests: tests,
@@ -31,6 +36,7 @@ exports.findAndRunTests = function findAndRunTests(options) {
 var TestRunner = exports.TestRunner = function TestRunner(options) {
   if (options) {
     this.fs = options.fs;
+    this.profileMemory = options.profileMemory;
   }
   this.console = (options && "console" in options) ? options.console : console;
   memory.track(this);
@@ -46,6 +52,11 @@ TestRunner.prototype = {
   DEFAULT_PAUSE_TIMEOUT: 10000,
   PAUSE_DELAY: 500,
 
+  _reportMessage: function _reportMessage(message) {
+    if (this.test.messages.length < MAX_REPORTED_MESSAGES)
+      this.test.messages.push(String(message));
+  },
+
   _logTestFailed: function _logTestFailed(why) {
     if (!(why in this.test.errors))
       this.test.errors[why] = 0;
@@ -71,6 +82,7 @@ TestRunner.prototype = {
   fail: function fail(message) {
     if(!this.expectFailure) {
       this._logTestFailed("failure");
+      this._reportMessage(message);
       this.console.error("fail:", message);
       this.console.trace();
       this.failed++;
@@ -90,6 +102,7 @@ TestRunner.prototype = {
 
   exception: function exception(e) {
     this._logTestFailed("exception");
+    this._reportMessage(e);
     this.console.exception(e);
     this.failed++;
     this.test.failed++;
@@ -259,6 +272,21 @@ TestRunner.prototype = {
         failed: this.test.failed,
         errors: [error for (error in this.test.errors)].join(", ")
       });
+      let result = {
+        action: "test-end",
+        test: this.test.name,
+        passed: this.test.passed,
+        failed: this.test.failed,
+        errors: [error for (error in this.test.errors)],
+        messages: this.test.messages,
+        duration: Date.now() - this.test.startTime
+      };
+      if (this.profileMemory) {
+        memory.gc();
+        result.memory = {before: this.test.memoryBefore,
+                         after: memory.getUsage()};
+      }
+      reportResult(result);
       
       if (this.onDone !== null) {
         var onDone = this.onDone;
@@ -429,6 +457,13 @@ TestRunner.prototype = {
     this.test.passed = 0;
     this.test.failed = 0;
     this.test.errors = {};
+    this.test.messages = [];
+    if (this.profileMemory) {
+      memory.gc();
+      this.test.memoryBefore = memory.getUsage();
+    }
+    this.test.startTime = Date.now();
+    reportResult({action: "test-start", test: this.test.name});
 
     this.isDone = false;
     this.onDone = options.onDone;
@@ -0,0 +1,27 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+// Run with `cfx bench` in packages/api-utils.
+
+var url = require("url");
+var base64 = require("base64");
+
+var text = Array(100).join("The quick brown fox jumps over the lazy dog. ");
+var encoded = base64.encode(text);
+
+exports.benchResolve = function() {
+  url.URL("../bar/baz.html?q=1#top", "http://www.foo.com/a/b/c.html");
+};
+
+exports.benchDataURL = function() {
+  url.DataURL("data:text/plain;base64," + encoded);
+};
+
+exports.benchBase64Encode = function() {
+  base64.encode(text);
+};
+
+exports.benchBase64Decode = function() {
+  base64.decode(encoded);
+};
@@ -23,5 +23,29 @@ exports['test dependency cycles'] = function(assert) {
   unload(loader);
 };
 
+exports['test module sources'] = function(assert) {
+  let uri = module.uri.substr(0, module.uri.lastIndexOf('/')) +
+            '/fixtures/loader/cycles/'
+  let requested = [];
+
+  let loader = Loader({
+    paths: { '': uri },
+    source: function source(moduleURI) {
+      requested.push(moduleURI.substr(uri.length));
+      // Replace `c` and load the other modules from their files.
+      return moduleURI === uri + 'c.js' ? 'exports.bundled = true;' : null;
+    }
+  });
+
+  let program = main(loader, 'main');
+
+  assert.equal(program.a.b, program.b, 'modules without source still load');
+  assert.ok(program.c.bundled, 'module `c` comes from its given source');
+  assert.equal(requested.sort().join(' '), 'a.js b.js c.js main.js',
+               'source is asked for every module');
+
+  unload(loader);
+};
+
 require('test').run(exports);
 
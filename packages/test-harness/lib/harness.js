@@ -7,6 +7,7 @@
 const { Cc,Ci } = require("chrome");
 const { Loader } = require('./loader');
 const memory = require('api-utils/memory');
+const { reportResult } = require('api-utils/system');
 
 var cService = Cc['@mozilla.org/consoleservice;1'].getService()
                .QueryInterface(Ci.nsIConsoleService);
@@ -121,8 +122,19 @@ function dictDiff(last, curr) {
   return diff;
 }
 
+// Tell cfx how much memory is in use once `iteration` runs of the tests
+// are done, counting the objects tracked in the loader the tests run in.
+function reportMemorySample(iteration) {
+  reportResult({
+    action: "memory",
+    iteration: iteration,
+    usage: loader.require("api-utils/memory").getUsage()
+  });
+}
+
 function reportMemoryUsage() {
   memory.gc();
+  reportMemorySample(results.testRuns.length + 1);
 
   var mgr = Cc["@mozilla.org/memory-reporter-manager;1"]
             .getService(Ci.nsIMemoryReporterManager);
@@ -305,6 +317,11 @@ var runTests = exports.runTests = function runTests(options) {
       console: new TestRunnerConsole(new ptc.PlainTextConsole(print), options)
     });
 
+    if (profileMemory) {
+      memory.gc();
+      reportMemorySample(0);
+    }
+
     nextIteration();
   } catch (e) {
     print(require("api-utils/traceback").format(e) + "\n" + e + "\n");
@@ -101,9 +101,21 @@ function main() {
   if (!testsStarted) {
     testsStarted = true;
     runTests(function findAndRunTests(loader, nextIteration) {
+      // `cfx bench` passes benchmarks as the test modules
+      if (cfxArgs.benchmark) {
+        loader.require("api-utils/benchmark").findAndRunBenchmarks({
+          stopOnError: cfxArgs.stopOnError,
+          filter: cfxArgs.filter,
+          samples: cfxArgs.benchSamples,
+          sampleTime: cfxArgs.benchSampleTime,
+          onDone: nextIteration
+        });
+        return;
+      }
       loader.require("api-utils/unit-test").findAndRunTests({
         testOutOfProcess: false,
         testInProcess: true,
+        profileMemory: cfxArgs.profileMemory,
         stopOnError: cfxArgs.stopOnError,
         filter: cfxArgs.filter,
         onDone: nextIteration
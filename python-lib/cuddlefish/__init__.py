@@ -8,7 +8,7 @@ import optparse
 import webbrowser
 
 from copy import copy
-import simplejson as json
+from cuddlefish import json_backend as json
 from cuddlefish import packaging
 from cuddlefish._version import get_versions
 
@@ -30,6 +30,7 @@ Supported Commands:
   test       - run tests
   run        - run program
   xpi        - generate an xpi
+  bench      - run benchmarks (experimental)
 
 Internal Commands:
   sdocs      - export static documentation
@@ -66,20 +67,20 @@ parser_groups = (
                                              "app"),
                                        metavar=None,
                                        default=None,
-                                       cmds=['test', 'run', 'testex',
+                                       cmds=['bench', 'test', 'run', 'testex',
                                              'testpkgs', 'testall'])),
         (("-b", "--binary",), dict(dest="binary",
                                    help="path to app binary",
                                    metavar=None,
                                    default=None,
-                                   cmds=['test', 'run', 'testex', 'testpkgs',
-                                         'testall'])),
+                                   cmds=['bench', 'test', 'run', 'testex',
+                                         'testpkgs', 'testall'])),
         (("", "--binary-args",), dict(dest="cmdargs",
                                  help=("additional arguments passed to the "
                                        "binary"),
                                  metavar=None,
                                  default=None,
-                                 cmds=['run', 'test'])),
+                                 cmds=['bench', 'run', 'test'])),
         (("", "--dependencies",), dict(dest="dep_tests",
                                        help="include tests for all deps",
                                        action="store_true",
@@ -98,14 +99,15 @@ parser_groups = (
                                          "match TESTNAME, both regexps"),
                                    metavar="FILENAME[:TESTNAME]",
                                    default=None,
-                                   cmds=['test', 'testex', 'testpkgs',
+                                   cmds=['bench', 'test', 'testex', 'testpkgs',
                                          'testall'])),
         (("-g", "--use-config",), dict(dest="config",
                                        help="use named config from local.json",
                                        metavar=None,
                                        default="default",
-                                       cmds=['test', 'run', 'xpi', 'testex',
-                                             'testpkgs', 'testall'])),
+                                       cmds=['bench', 'test', 'run', 'xpi',
+                                             'testex', 'testpkgs',
+                                             'testall'])),
         (("", "--templatedir",), dict(dest="templatedir",
                                       help="XULRunner app/ext. template",
                                       metavar=None,
@@ -115,15 +117,15 @@ parser_groups = (
                                        help="extra directories for package search",
                                        metavar=None,
                                        default=[],
-                                       cmds=['run', 'xpi', 'test'])),
+                                       cmds=['bench', 'run', 'xpi', 'test'])),
         (("", "--extra-packages",), dict(dest="extra_packages",
                                          help=("extra packages to include, "
                                                "comma-separated. Default is "
                                                "'addon-kit'."),
                                          metavar=None,
                                          default="addon-kit",
-                                         cmds=['run', 'xpi', 'test', 'testex',
-                                               'testpkgs', 'testall',
+                                         cmds=['bench', 'run', 'xpi', 'test',
+                                               'testex', 'testpkgs', 'testall',
                                                'testcfx'])),
         (("", "--pkgdir",), dict(dest="pkgdir",
                                  help=("package dir containing "
@@ -131,7 +133,7 @@ parser_groups = (
                                        "current directory"),
                                  metavar=None,
                                  default=None,
-                                 cmds=['run', 'xpi', 'test'])),
+                                 cmds=['bench', 'run', 'xpi', 'test'])),
         (("", "--static-args",), dict(dest="static_args",
                                       help="extra harness options as JSON",
                                       type="json",
@@ -152,8 +154,8 @@ parser_groups = (
                                          "fennec-on-device", "thunderbird",
                                          "xulrunner"],
                                 default="firefox",
-                                cmds=['test', 'run', 'testex', 'testpkgs',
-                                      'testall'])),
+                                cmds=['bench', 'test', 'run', 'testex',
+                                      'testpkgs', 'testall'])),
         (("", "--no-run",), dict(dest="no_run",
                                      help=("Instead of launching the "
                                            "application, just show the command "
@@ -162,12 +164,67 @@ parser_groups = (
                                            "gdb."),
                                      action="store_true",
                                      default=False,
-                                     cmds=['run', 'test'])),
+                                     cmds=['bench', 'run', 'test'])),
         (("", "--no-strip-xpi",), dict(dest="no_strip_xpi",
                                     help="retain unused modules in XPI",
                                     action="store_true",
                                     default=False,
                                     cmds=['xpi'])),
+        (("", "--compact-manifest",), dict(dest="compact_manifest",
+                                    help=("write the module manifest in the "
+                                          "compact format (module hashes "
+                                          "are only kept by 'cfx xpi')"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['run', 'test', 'xpi', 'testex',
+                                          'testpkgs', 'testall'])),
+        (("", "--strip-locales",), dict(dest="strip_locales",
+                                    help=("only ship the translations that "
+                                          "modules look up with _(\"key\") "
+                                          "or that data/ HTML files name in "
+                                          "data-l10n-id"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['run', 'test', 'xpi', 'testex',
+                                          'testpkgs', 'testall'])),
+        (("", "--strip-data",), dict(dest="strip_data",
+                                    help=("leave out the files in data/ that "
+                                          "no data.url() or data.load() call, "
+                                          "data/ HTML or CSS file, or "
+                                          "package.json dataAllowlist refers "
+                                          "to"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['xpi'])),
+        (("", "--bundle",), dict(dest="bundle",
+                                    help=("also write every module into one "
+                                          "bundle, which the loader reads "
+                                          "them from"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['xpi'])),
+        (("", "--minify",), dict(dest="minify",
+                                    help=("strip comments and whitespace "
+                                          "from the modules, and write their "
+                                          "source maps next to the XPI"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['xpi'])),
+        (("", "--build-cache",), dict(dest="build_cache",
+                                    help=("reuse the XPI from an earlier "
+                                          "build when none of its inputs "
+                                          "changed"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['xpi'])),
+        (("", "--preload",), dict(dest="preload",
+                                    help=("tell the loader the order modules "
+                                          "load in, so it can read them ahead "
+                                          "of require()"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['run', 'test', 'xpi', 'testex',
+                                          'testpkgs', 'testall'])),
         (("", "--force-mobile",), dict(dest="enable_mobile",
                                     help="Force compatibility with Firefox Mobile",
                                     action="store_true",
@@ -193,7 +250,45 @@ parser_groups = (
                                   action="store_true",
                                   metavar=None,
                                   default=False,
-                                  cmds=['test', 'testex', 'testpkgs'])),
+                                  cmds=['bench', 'test', 'testex', 'testpkgs'])),
+        (("", "--junit-xml",), dict(dest="junit_xml",
+                                    help=("Write a JUnit XML report of the "
+                                          "tests to this file"),
+                                    metavar=None,
+                                    default=None,
+                                    cmds=['test', 'testex', 'testpkgs',
+                                          'testall'])),
+        (("", "--bench-baseline",), dict(dest="bench_baseline",
+                                    help=("JSON file of earlier benchmark "
+                                          "results to compare with"),
+                                    metavar=None,
+                                    default=None,
+                                    cmds=['bench'])),
+        (("", "--bench-save",), dict(dest="bench_save",
+                                    help=("store the results in the "
+                                          "--bench-baseline file"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['bench'])),
+        (("", "--bench-threshold",), dict(dest="bench_threshold",
+                                    help=("how many percent slower than the "
+                                          "baseline a benchmark's median may "
+                                          "get before cfx fails"),
+                                    type="float",
+                                    default=10.0,
+                                    cmds=['bench'])),
+        (("", "--bench-samples",), dict(dest="benchSamples",
+                                    help=("how many times to time each "
+                                          "benchmark"),
+                                    type="int",
+                                    default=10,
+                                    cmds=['bench'])),
+        (("", "--bench-sample-time",), dict(dest="benchSampleTime",
+                                    help=("how many milliseconds each of "
+                                          "those should take"),
+                                    type="int",
+                                    default=100,
+                                    cmds=['bench'])),
         ]
      ),
 
@@ -203,8 +298,8 @@ parser_groups = (
                                        "comma-separated"),
                                  metavar=None,
                                  default=None,
-                                 cmds=['test', 'run', 'testex', 'testpkgs',
-                                       'testall'])),
+                                 cmds=['bench', 'test', 'run', 'testex',
+                                       'testpkgs', 'testall'])),
         (("", "--baseurl",), dict(dest="baseurl",
                                  help=("root of static docs tree: "
                                        "for example: 'http://me.com/the_docs/'"),
@@ -217,8 +312,8 @@ parser_groups = (
                                                 "program (default is "
                                                 "test-harness)"),
                                           default="test-harness",
-                                          cmds=['test', 'testex', 'testpkgs',
-                                                'testall'])),
+                                          cmds=['bench', 'test', 'testex',
+                                                'testpkgs', 'testall'])),
         # --keydir was removed in 1.0b5, but we keep it around in the options
         # parser to make life easier for frontends like FlightDeck which
         # might still pass it. It can go away once the frontends are updated.
@@ -237,7 +332,8 @@ parser_groups = (
                                   help="log console output to file",
                                   metavar=None,
                                   default=None,
-                                  cmds=['run', 'test', 'testex', 'testpkgs'])),
+                                  cmds=['bench', 'run', 'test', 'testex',
+                                        'testpkgs'])),
         # TODO: This should default to true once our memory debugging
         # issues are resolved; see bug 592774.
         (("", "--profile-memory",), dict(dest="profileMemory",
@@ -248,6 +344,30 @@ parser_groups = (
                                          default=0,
                                          cmds=['test', 'testex', 'testpkgs',
                                                'testall'])),
+        (("", "--memory-report",), dict(dest="memory_report",
+                                        help=("write what --profile-memory "
+                                              "measured to this JSON file, "
+                                              "and as HTML next to it"),
+                                        metavar=None,
+                                        default=None,
+                                        cmds=['test', 'testex', 'testpkgs',
+                                              'testall'])),
+        (("", "--memory-baseline",), dict(dest="memory_baseline",
+                                          help=("fail if memory use got "
+                                                "worse than in this earlier "
+                                                "--memory-report"),
+                                          metavar=None,
+                                          default=None,
+                                          cmds=['test', 'testex', 'testpkgs',
+                                                'testall'])),
+        (("", "--memory-threshold",), dict(dest="memory_threshold",
+                                           help=("how many percent more "
+                                                 "bytes than the baseline "
+                                                 "count as worse"),
+                                           type="float",
+                                           default=10.0,
+                                           cmds=['test', 'testex',
+                                                 'testpkgs', 'testall'])),
         ]
      ),
     )
@@ -583,11 +703,21 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         filename = generate.generate_static_docs(env_root)
         print >>stdout, "Wrote %s." % filename
         return
-    elif command not in ["xpi", "test", "run"]:
+    elif command not in ["xpi", "test", "run", "bench"]:
         print >>sys.stderr, "Unknown command: %s" % command
         print >>sys.stderr, "Try using '--help' for assistance."
         sys.exit(1)
 
+    if options.bench_save and not options.bench_baseline:
+        print >>sys.stderr, ("--bench-save needs --bench-baseline, the file "
+                             "to save the results to.")
+        sys.exit(1)
+
+    if options.strip_data and options.no_strip_xpi:
+        print >>sys.stderr, ("--strip-data cannot be combined with "
+                             "--no-strip-xpi, which ships every file.")
+        sys.exit(1)
+
     target_cfg_json = None
     if not target_cfg:
         if not options.pkgdir:
@@ -618,9 +748,18 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     elif command == "test":
         if 'tests' not in target_cfg:
             target_cfg['tests'] = []
+        # there is nothing to report or compare without the samples
+        if options.memory_report or options.memory_baseline:
+            options.profileMemory = options.profileMemory or 1
         inherited_options.extend(['iterations', 'filter', 'profileMemory',
                                   'stopOnError'])
         enforce_timeouts = True
+    elif command == "bench":
+        if 'tests' not in target_cfg:
+            target_cfg['tests'] = []
+        inherited_options.extend(['filter', 'stopOnError', 'benchSamples',
+                                  'benchSampleTime'])
+        enforce_timeouts = True
     elif command == "run":
         use_main = True
     else:
@@ -659,12 +798,12 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
                 sys.exit(1)
         # if we make it this far, we have a JID
     else:
-        assert command == "test"
+        assert command in ("test", "bench")
 
     jid = buildJID(target_cfg)
 
     targets = [target]
-    if command == "test":
+    if command in ("test", "bench"):
         targets.append(options.test_runner_pkg)
 
     extra_packages = []
@@ -676,6 +815,28 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
     deps = packaging.get_deps_for_targets(pkg_cfg, targets)
 
+    # an XPI is only a function of the files it is built from when cfx
+    # writes nothing else next to it
+    build_cache = build_key = None
+    if (command == "xpi" and options.build_cache and env_root and
+        not options.update_link and not options.minify):
+        from cuddlefish.xpi import BuildCache, get_build_key, \
+                                   BUILD_CACHE_DIRNAME
+        xpi_path = XPI_FILENAME % target_cfg.name
+        if options.templatedir:
+            template_dir = os.path.abspath(options.templatedir)
+        else:
+            template_dir = os.path.join(os.path.dirname(
+                os.path.abspath(__file__)), "app-extension")
+        build_cache = BuildCache(os.path.join(env_root, BUILD_CACHE_DIRNAME))
+        build_key = get_build_key(
+            [pkg_cfg.packages[name].root_dir for name in deps],
+            template_dir, options.__dict__, sdk_version,
+            ignored_paths=[xpi_path])
+        if build_cache.fetch(build_key, xpi_path):
+            print >>stdout, "Exporting extension to %s (unchanged)." % xpi_path
+            sys.exit(0)
+
     from cuddlefish.manifest import build_manifest, ModuleNotFoundError, \
                                     BadChromeMarkerError
     # Figure out what loader files should be scanned. This is normally
@@ -695,7 +856,7 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     cuddlefish_js_path = os.path.join(pkg_cfg.packages["api-utils"].root_dir,
                                       "lib", "cuddlefish.js")
     loader_modules = [("api-utils", "lib", "cuddlefish", cuddlefish_js_path)]
-    scan_tests = command == "test"
+    scan_tests = command in ("test", "bench")
     test_filter_re = None
     if scan_tests and options.filter:
         test_filter_re = options.filter
@@ -704,7 +865,9 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     try:
         manifest = build_manifest(target_cfg, pkg_cfg, deps,
                                   scan_tests, test_filter_re,
-                                  loader_modules)
+                                  loader_modules,
+                                  test_prefix=(command == "bench" and
+                                               "bench-" or "test-"))
     except ModuleNotFoundError, e:
         print str(e)
         sys.exit(1)
@@ -712,7 +875,7 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         # An error had already been displayed on stderr in manifest code
         sys.exit(1)
     used_deps = manifest.get_used_packages()
-    if command == "test":
+    if command in ("test", "bench"):
         # The test runner doesn't appear to link against any actual packages,
         # because it loads everything at runtime (invisible to the linker).
         # If we believe that, we won't set up URI mappings for anything, and
@@ -725,7 +888,7 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     build = packaging.generate_build_for_target(
         pkg_cfg, target, used_deps,
         include_dep_tests=options.dep_tests,
-        is_running_tests=(command == "test")
+        is_running_tests=(command in ("test", "bench"))
         )
 
     harness_options = {
@@ -736,8 +899,15 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
     harness_options.update(build)
 
+    if options.strip_locales and harness_options['locale']:
+        from cuddlefish.l10n import strip_locales, parse_plural_rules, \
+                                    get_plural_rules_path
+        plural_forms = parse_plural_rules(get_plural_rules_path(pkg_cfg))
+        strip_locales(harness_options['locale'],
+                      manifest.get_used_l10n_keys(), plural_forms, stdout)
+
     extra_environment = {}
-    if command == "test":
+    if command in ("test", "bench"):
         # This should be contained in the test runner package.
         # maybe just do: target_cfg.main = 'test-harness/run-tests'
         harness_options['main'] = 'test-harness/run-tests'
@@ -749,6 +919,8 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
     for option in inherited_options:
         harness_options[option] = getattr(options, option)
+    if command == "bench":
+        harness_options['benchmark'] = True
 
     harness_options['metadata'] = packaging.get_metadata(pkg_cfg, used_deps)
 
@@ -768,9 +940,26 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     if target_cfg.get('preferences'):
         harness_options['preferences'] = target_cfg.get('preferences')
 
-    harness_options['manifest'] = manifest.get_harness_options_manifest()
+    # the module hashes must describe the bytes the XPI ships
+    minified_modules = None
+    if command == "xpi" and options.minify:
+        from cuddlefish.minify import MinifyCache, minify_modules, \
+                                      CACHE_DIRNAME
+        cache_dir = env_root and os.path.join(env_root, CACHE_DIRNAME)
+        minified_modules = minify_modules(manifest, MinifyCache(cache_dir),
+                                          stdout)
+
+    # nothing reads the module hashes at runtime, they are only there for
+    # whoever reviews the XPI
+    harness_options['manifest'] = manifest.get_harness_options_manifest(
+        compact=options.compact_manifest,
+        include_hashes=(command == "xpi"))
+    if options.preload:
+        harness_options.update(
+            manifest.get_load_order(harness_options['mainPath']))
     harness_options['allTestModules'] = manifest.get_all_test_modules()
-    if len(harness_options['allTestModules']) == 0 and command == "test":
+    if (len(harness_options['allTestModules']) == 0 and
+        command in ("test", "bench")):
         sys.exit(0)
 
     from cuddlefish.rdf import gen_manifest, RDFUpdate
@@ -797,17 +986,23 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     # build_manifest earlier
     used_files = None
     if command == "xpi":
+      if options.strip_data:
+        manifest.strip_unused_data(stdout)
       used_files = set(manifest.get_used_files())
 
     if options.no_strip_xpi:
         used_files = None # disables the filter, includes all files
 
     if command == 'xpi':
-        from cuddlefish.xpi import build_xpi
+        from cuddlefish.xpi import build_xpi, TEMPLATE_CACHE_DIRNAME
         extra_harness_options = {}
         for kv in options.extra_harness_option_args:
             key,value = kv.split("=", 1)
             extra_harness_options[key] = value
+        bundle_modules = None
+        if options.bundle:
+            bundle_modules = [(me.get_path(), me.js_filename)
+                              for me in manifest.get_module_load_order()]
         xpi_path = XPI_FILENAME % target_cfg.name
         print >>stdout, "Exporting extension to %s." % xpi_path
         build_xpi(template_root_dir=app_extension_dir,
@@ -815,9 +1010,23 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
                   xpi_path=xpi_path,
                   harness_options=harness_options,
                   limit_to=used_files,
-                  extra_harness_options=extra_harness_options)
+                  extra_harness_options=extra_harness_options,
+                  bundle_modules=bundle_modules,
+                  minified_modules=minified_modules,
+                  template_cache_dir=(env_root and
+                                      os.path.join(env_root,
+                                                   TEMPLATE_CACHE_DIRNAME)))
+        if build_cache:
+            build_cache.store(build_key, xpi_path)
+        if minified_modules:
+            from cuddlefish.minify import write_source_maps, \
+                                          SOURCEMAPS_DIRNAME
+            maps_dir = SOURCEMAPS_DIRNAME % target_cfg.name
+            print >>stdout, "Exporting source maps to %s." % maps_dir
+            write_source_maps(minified_modules, maps_dir)
     else:
-        from cuddlefish.runner import run_app
+        from cuddlefish.runner import run_app, BINARY_CACHE_FILENAME, \
+                                      ADDON_STORE_DIRNAME
 
         if options.profiledir:
             options.profiledir = os.path.expanduser(options.profiledir)
@@ -826,6 +1035,10 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         if options.addons is not None:
             options.addons = options.addons.split(",")
 
+        bench_results = None
+        if command == "bench":
+            bench_results = []
+
         try:
             retval = run_app(harness_root_dir=app_extension_dir,
                              manifest_rdf=manifest_rdf,
@@ -842,7 +1055,31 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
                              norun=options.no_run,
                              used_files=used_files,
                              enable_mobile=options.enable_mobile,
-                             mobile_app_name=options.mobile_app_name)
+                             mobile_app_name=options.mobile_app_name,
+                             binary_cache=(env_root and
+                                           os.path.join(env_root,
+                                                        BINARY_CACHE_FILENAME)),
+                             addon_store=(env_root and
+                                          os.path.join(env_root,
+                                                       ADDON_STORE_DIRNAME)),
+                             stop_on_error=options.stopOnError,
+                             junit_xml=(options.junit_xml and
+                                        os.path.abspath(options.junit_xml)),
+                             bench_results=bench_results,
+                             memory_report=(options.memory_report and
+                                            os.path.abspath(
+                                                options.memory_report)),
+                             memory_baseline=options.memory_baseline,
+                             memory_threshold=options.memory_threshold)
+            if bench_results:
+                # report what was measured even if a benchmark failed, but
+                # only save the results of a run that went well
+                from cuddlefish.bench import report_benchmarks
+                bench_retval = report_benchmarks(
+                    bench_results, baseline_path=options.bench_baseline,
+                    save=options.bench_save and retval == 0,
+                    threshold=options.bench_threshold, stdout=stdout)
+                retval = retval or bench_retval
         except ValueError, e:
             print ""
             print "A given cfx option has an inappropriate value:"
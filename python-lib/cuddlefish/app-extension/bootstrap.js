@@ -34,8 +34,12 @@ function readURI(uri) {
   let ioservice = Cc['@mozilla.org/network/io-service;1'].
     getService(Ci.nsIIOService);
   let channel = ioservice.newChannel(uri, 'UTF-8', null);
-  let stream = channel.open();
+  return readStream(channel.open());
+}
 
+// Utility function that reads the whole of the given UTF-8 `stream`, and
+// returns content string.
+function readStream(stream) {
   let cstream = Cc['@mozilla.org/intl/converter-input-stream;1'].
     createInstance(Ci.nsIConverterInputStream);
   cstream.init(stream, 'UTF-8', 0, 0);
@@ -62,6 +66,9 @@ function path2id(path) {
 // Utility function that takes old manifest format and creates a manifest
 // in a new format: https://github.com/mozilla/addon-sdk/wiki/JEP-Linker
 function manifestV2(manifest) {
+  // Compact manifests are decoded by cuddlefish.js as modules get resolved.
+  if (manifest.format === 2)
+    return manifest;
   return Object.keys(manifest).reduce(function(result, path) {
     let entry = manifest[path];
     let id = path2id(path);
@@ -76,6 +83,66 @@ function manifestV2(manifest) {
   }, {});
 }
 
+// Utility function that returns a `source` function for the loader, which
+// finds modules in the bundle written by `cfx xpi --bundle`. `bundle.offsets`
+// maps the path of each module in the bundle to the offset and length of its
+// source. The bundle is read in one go, the first time a module from it is
+// loaded.
+function bundleSource(rootURI, prefixURI, bundle) {
+  let { file, offsets } = bundle;
+  let text = null;
+  return function source(uri) {
+    if (uri.indexOf(prefixURI) !== 0)
+      return null;
+    let path = uri.substr(prefixURI.length);
+    if (!(path in offsets))
+      return null;
+    if (text === null)
+      text = readURI(rootURI + file);
+    let [ offset, length ] = offsets[path];
+    return text.substr(offset, length);
+  };
+}
+
+// Utility function that starts reading the modules listed in `preload` (in
+// load order, as computed by `cfx --preload`) in the background, and returns
+// a `source` function for the loader that hands out the ones that have
+// arrived by the time they are required. Everything else comes from `next`.
+function preloadSource(prefixURI, preload, next) {
+  let sources = {};
+  let loaded = {};
+  preload.forEach(function(path) {
+    let uri = prefixURI + path;
+    let channel = ioService.newChannel(uri, 'UTF-8', null);
+    channel.asyncOpen({
+      stream: null,
+      onStartRequest: function(request, context) {
+        this.stream = Cc['@mozilla.org/storagestream;1'].
+                      createInstance(Ci.nsIStorageStream);
+        this.stream.init(8192, 0xffffffff, null);
+      },
+      onDataAvailable: function(request, context, input, offset, count) {
+        let output = this.stream.getOutputStream(offset);
+        output.writeFrom(input, count);
+        output.close();
+      },
+      onStopRequest: function(request, context, status) {
+        if (Components.isSuccessCode(status) && !(uri in loaded))
+          sources[uri] = readStream(this.stream.newInputStream(0));
+        this.stream = null;
+      }
+    }, null);
+  });
+  return function source(uri) {
+    loaded[uri] = true;
+    if (!(uri in sources))
+      return next(uri);
+    let text = sources[uri];
+    delete sources[uri];
+    return text;
+  };
+}
+
 // We don't do anything on install & uninstall yet, but in a future
 // we should allow add-ons to cleanup after uninstall.
 function install(data, reason) {}
@@ -127,6 +194,12 @@ function startup(data, reasonCode) {
     // Make version 2 of the manifest
     let manifest = manifestV2(options.manifest);
 
+    let source = options.bundle ? bundleSource(rootURI, prefixURI,
+                                               options.bundle)
+                                : function source(uri) null;
+    if (options.preload && !options.bundle)
+      source = preloadSource(prefixURI, options.preload, source);
+
     // Import `cuddlefish.js` module using a Sandbox and bootstrap loader.
     let cuddlefishURI = prefixURI + options.loader;
     cuddlefishSandbox = loadSandbox(cuddlefishURI);
@@ -141,6 +214,8 @@ function startup(data, reasonCode) {
       paths: paths,
       // modules manifest.
       manifest: manifest,
+      // sources of bundled modules.
+      source: source,
 
       // Add-on ID used by different APIs as a unique identifier.
       id: id,
@@ -161,6 +236,8 @@ function startup(data, reasonCode) {
       resultFile: options.resultFile,
       // File to write stdout.
       logFile: options.logFile,
+      // File to write test results to as they happen, one JSON per line.
+      resultStreamFile: options.resultStreamFile,
       // Arguments passed as --static-args
       staticArgs: options.staticArgs,
 
@@ -173,6 +250,9 @@ function startup(data, reasonCode) {
           profileMemory: options.profileMemory,
           stopOnError: options.stopOnError,
           verbose: options.verbose,
+          benchmark: options.benchmark,
+          benchSamples: options.benchSamples,
+          benchSampleTime: options.benchSampleTime,
         }
       }
     });
@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Summarize what `cfx bench` measured, and compare it with a baseline: a
+# JSON file of earlier results that --bench-save writes.
+
+import os
+import math
+
+from cuddlefish import json_backend as json
+
+BASELINE_VERSION = 1
+
+def percentile(values, p):
+    """Return the nearest-rank p-th percentile of `values`."""
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank - 1, 0)]
+
+def get_stats(entry):
+    """Return the statistics of a bench-end entry of a TestResultStream,
+    whose samples are the milliseconds that each call took, on average,
+    in each sample."""
+    samples = entry["samples"]
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2.0
+    return {"mean": sum(samples) / float(len(samples)),
+            "median": median,
+            "p95": percentile(samples, 95),
+            "iterations": entry["iterations"],
+            "samples": len(samples)}
+
+def format_time(ms):
+    for (unit, scale) in (("s", 1000.0), ("ms", 1.0), ("us", 1e-3)):
+        if ms >= scale:
+            return "%.3f%s" % (ms / scale, unit)
+    return "%.1fns" % (ms * 1e6)
+
+def load_baseline(path):
+    """Return the benchmarks of the baseline at `path`, a dict that maps
+    each name to its statistics, or an empty dict if there is none."""
+    if not os.path.exists(path):
+        return {}
+    data = json.load(open(path, "r"))
+    if data.get("version") != BASELINE_VERSION:
+        raise ValueError("%s is not a version %d benchmark baseline"
+                         % (path, BASELINE_VERSION))
+    return data["benchmarks"]
+
+def save_baseline(path, stats):
+    """Write `stats` to the baseline at `path`, keeping what it says about
+    benchmarks that did not run this time."""
+    benchmarks = load_baseline(path)
+    benchmarks.update(stats)
+    tmp = path + ".tmp"
+    f = open(tmp, "w")
+    json.dump({"version": BASELINE_VERSION, "benchmarks": benchmarks}, f,
+              indent=1, sort_keys=True)
+    f.close()
+    if os.path.exists(path):
+        os.remove(path) # windows can't rename over a file
+    os.rename(tmp, path)
+
+def compare(stats, baseline, threshold):
+    """Compare the median of each benchmark in `stats` with the one in
+    `baseline`. Return a dict that maps each name to its change, as a
+    percentage, and the names of the ones that got slower by more than
+    `threshold` percent."""
+    changes = {}
+    regressions = []
+    for name in sorted(stats):
+        if name not in baseline or not baseline[name]["median"]:
+            continue
+        old = baseline[name]["median"]
+        change = (stats[name]["median"] - old) * 100.0 / old
+        changes[name] = change
+        if change > threshold:
+            regressions.append(name)
+    return changes, regressions
+
+def report_benchmarks(entries, baseline_path=None, save=False,
+                      threshold=10.0, stdout=None):
+    """Print the statistics of `entries`, the bench-end entries of a run,
+    compare them with the baseline at `baseline_path` and, if `save`,
+    store them there. Return 1 if a benchmark regressed and they were not
+    saved, 0 otherwise."""
+    stats = {}
+    for entry in entries:
+        if "samples" in entry and entry["samples"]:
+            stats[entry["bench"]] = get_stats(entry)
+    baseline = {}
+    if baseline_path:
+        baseline = load_baseline(baseline_path)
+    changes, regressions = compare(stats, baseline, threshold)
+
+    if stdout:
+        print >>stdout, "Benchmark results (time per call):"
+        for name in sorted(stats):
+            s = stats[name]
+            line = ("  %s: median %s, mean %s, p95 %s (%d x %d)"
+                    % (name, format_time(s["median"]),
+                       format_time(s["mean"]), format_time(s["p95"]),
+                       s["samples"], s["iterations"]))
+            if name in changes:
+                line += ", %+.1f%% vs baseline" % changes[name]
+                if name in regressions:
+                    line += " REGRESSION"
+            print >>stdout, line
+    if save and baseline_path:
+        save_baseline(baseline_path, stats)
+        if stdout:
+            print >>stdout, "Saved the baseline to %s." % baseline_path
+    # a saved baseline accepts what was measured, regressions and all
+    if regressions and not save:
+        if stdout:
+            print >>stdout, ("%d of %d benchmarks are more than %g%% slower "
+                             "than the baseline." % (len(regressions),
+                                                     len(stats), threshold))
+        return 1
+    return 0
@@ -3,8 +3,10 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import sys, os
-import markdown
+import hashlib
+from cuddlefish import json_backend
 import apiparser
+import converter
 
 # list of all the 'class' and 'id' attributes assigned to
 # <div> and <span> tags by the renderer.
@@ -103,7 +105,7 @@ class API_Renderer(object):
         raise Exception('not implemented in this class')
 
     def render_description(self):
-        return markdown.markdown(self.description)
+        return converter.convert(self.description)
 
     def render_subcomponents(self):
         raise Exception('not implemented in this class')
@@ -171,7 +173,7 @@ class Function_Doc(API_Renderer):
         if not self.returns:
             return ''
         text = 'Returns: ' + span_wrap(self.returns['datatype'], DATATYPE)
-        text += markdown.markdown(self.returns['description'])
+        text += converter.convert(self.returns['description'])
         return tag_wrap(text, RETURNS)
 
 class Property_Doc(API_Renderer):
@@ -241,7 +243,7 @@ def render_comp_group(group, group_name, ctor, tag = 'div', comp_tag = 'div'):
 
 def render_descriptions(descriptions_md):
     text = ''.join([description_md for description_md in descriptions_md])
-    return tag_wrap(markdown.markdown(text), MODULE_DESCRIPTION)
+    return tag_wrap(converter.convert(text), MODULE_DESCRIPTION)
 
 def render_api_reference(api_docs):
     if (len(api_docs) == 0):
@@ -283,10 +285,84 @@ def json_to_html(json, markdown_filename):
     return indent(HTML_HEADER + \
            json_to_div(json, markdown_filename) + HTML_FOOTER)
 
+_renderer_hash = None
+
+def get_renderer_hash():
+    """Return a hash of the code that renders DIVs: this module, the
+    converter and the markdown package."""
+    global _renderer_hash
+    if _renderer_hash is None:
+        import markdown
+        filenames = [os.path.splitext(module.__file__)[0] + ".py"
+                     for module in (sys.modules[__name__], converter)]
+        markdown_dir = os.path.dirname(os.path.abspath(markdown.__file__))
+        for dirpath, dirnames, names in os.walk(markdown_dir):
+            dirnames.sort()
+            filenames.extend([os.path.join(dirpath, name)
+                              for name in sorted(names)
+                              if name.endswith(".py")])
+        key = hashlib.sha256()
+        for filename in filenames:
+            key.update(hashlib.sha256(open(filename, "rb").read()).digest())
+        _renderer_hash = key.hexdigest()
+    return _renderer_hash
+
+class RenderCache(object):
+    """A persistent cache of parsed API doc hunks and rendered module DIVs.
+
+    Entries are keyed on a hash of the Markdown source and the apiparser
+    VERSION, so an edited file, or a change to the parser's output format,
+    misses the cache while unchanged files are served straight from disk.
+    Rendered DIVs are also keyed on get_renderer_hash(), so they are
+    rendered again when the renderer or the markdown package changes.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.renderer_hash = get_renderer_hash()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _get_path(self, kind, *key_parts):
+        key = hashlib.sha256(str(apiparser.VERSION))
+        for part in key_parts:
+            key.update("\0" + part.encode('utf8'))
+        return os.path.join(self.cache_dir, key.hexdigest() + "." + kind)
+
+    def _store(self, path, data):
+        # write to a temporary file first, so an interrupted run can never
+        # leave a truncated entry behind
+        tmp_path = path + ".tmp"
+        open(tmp_path, "wb").write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def get_hunks(self, markdown_contents):
+        path = self._get_path("json", markdown_contents)
+        if os.path.exists(path):
+            return json_backend.loads(open(path, "rb").read().decode('utf8'))
+        json = list(apiparser.parse_hunks(markdown_contents))
+        self._store(path, json_backend.dumps(json))
+        return json
+
+    def get_div(self, markdown_contents, markdown_filename):
+        # the module name (taken from the filename) is part of the DIV
+        module_name = os.path.basename(markdown_filename)
+        path = self._get_path("html", self.renderer_hash, markdown_contents,
+                              module_name)
+        if os.path.exists(path):
+            return open(path, "rb").read()
+        div = json_to_div(self.get_hunks(markdown_contents), markdown_filename)
+        self._store(path, div)
+        return div
+
 # take the name of a Markdown file
 # return the HTML DIV containing the rendered component
-def md_to_div(markdown_filename):
+# if a RenderCache is supplied, unchanged files are not parsed or rendered
+def md_to_div(markdown_filename, cache=None):
     markdown_contents = open(markdown_filename).read().decode('utf8')
+    if cache:
+        return cache.get_div(markdown_contents, markdown_filename)
     json = list(apiparser.parse_hunks(markdown_contents))
     return json_to_div(json, markdown_filename)
 
@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# markdown.markdown() builds a new Markdown instance for every call, which
+# means registering every preprocessor, block processor, inline pattern and
+# tree processor (and compiling their regexps) all over again. The docs
+# convert thousands of small fragments, so we build converters once and
+# reset() them between documents instead.
+
+import os, sys, time
+import threading
+import markdown
+
+class MarkdownPool(object):
+    """A thread-safe pool of reusable Markdown converters.
+
+    Each call to convert() borrows an idle converter (building a new one if
+    none is free), and hands it back, reset, once the document is done.
+    """
+    def __init__(self, **markdown_kwargs):
+        self.markdown_kwargs = markdown_kwargs
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _acquire(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()
+        finally:
+            self.lock.release()
+        return markdown.Markdown(**self.markdown_kwargs)
+
+    def _release(self, md):
+        md.reset()
+        self.lock.acquire()
+        try:
+            self.idle.append(md)
+        finally:
+            self.lock.release()
+
+    def convert(self, text):
+        md = self._acquire()
+        # a converter that raised part-way through may hold stale parser
+        # state, so only successful ones go back into the pool
+        html = md.convert(text)
+        self._release(md)
+        return html
+
+_converter = None
+
+def get_converter():
+    # the process-wide converter, built on first use
+    global _converter
+    if _converter is None:
+        _converter = markdown.Markdown()
+    return _converter
+
+def convert(text):
+    """Convert a Markdown string to HTML, like markdown.markdown(), using
+    the process-wide converter. This is not thread-safe: threaded callers
+    should use a MarkdownPool instead."""
+    md = get_converter()
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
+
+def read_docs(docs_dir):
+    docs = []
+    for (dirpath, dirnames, filenames) in os.walk(docs_dir):
+        for filename in sorted(filenames):
+            if filename.endswith(".md"):
+                path = os.path.join(dirpath, filename)
+                docs.append(open(path).read().decode('utf8'))
+    return docs
+
+def benchmark(docs, rounds=3):
+    pool = MarkdownPool()
+    approaches = [("markdown.markdown()", markdown.markdown),
+                  ("shared converter", convert),
+                  ("MarkdownPool", pool.convert)]
+    results = []
+    for name, convert_one in approaches:
+        best = None
+        for i in range(rounds):
+            start = time.time()
+            for text in docs:
+                convert_one(text)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, best))
+    return results
+
+if __name__ == '__main__':
+    # benchmark converting the whole dev-guide with each approach
+    if len(sys.argv) > 1:
+        docs_dir = sys.argv[1]
+    else:
+        env_root = os.environ.get('CUDDLEFISH_ROOT', os.getcwd())
+        docs_dir = os.path.join(env_root, "doc", "dev-guide-source")
+    docs = read_docs(docs_dir)
+    print "Converting %d files from %s" % (len(docs), docs_dir)
+    for name, elapsed in benchmark(docs):
+        print "%-22s %.3fs" % (name, elapsed)
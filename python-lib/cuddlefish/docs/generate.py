@@ -15,14 +15,20 @@ from cuddlefish import packaging
 from cuddlefish.docs import apiparser
 from cuddlefish.docs import apirenderer
 from cuddlefish.docs import webdocs
-import simplejson as json
+from cuddlefish import json_backend as json
 
 DIGEST = "status.md5"
 TGZ_FILENAME = "addon-sdk-docs.tgz"
+CACHE_DIRNAME = ".docs-cache"
 
 def get_sdk_docs_path(env_root):
     return os.path.join(env_root, "doc")
 
+# the render cache lives outside the doc directory, so that it survives
+# clean_generated_docs() and stays out of the static docs tarball
+def get_docs_cache_path(env_root):
+    return os.path.join(env_root, CACHE_DIRNAME)
+
 def get_base_url(env_root):
     sdk_docs_path = get_sdk_docs_path(env_root).lstrip("/")
     return "file://"+"/"+"/".join(sdk_docs_path.split(os.sep))+"/"
@@ -53,7 +59,8 @@ def generate_local_docs(env_root):
     return generate_docs(env_root, get_base_url(env_root))
 
 def generate_named_file(env_root, filename):
-    web_docs = webdocs.WebDocs(env_root, get_base_url(env_root))
+    web_docs = webdocs.WebDocs(env_root, get_base_url(env_root),
+                               get_docs_cache_path(env_root))
     # next, generate api doc or guide doc
     abs_path = os.path.abspath(filename)
     if abs_path.startswith(os.path.join(env_root, 'packages')):
@@ -111,7 +118,8 @@ def calculate_current_status(env_root):
 
 def generate_docs_from_scratch(env_root, base_url):
     docs_dir = get_sdk_docs_path(env_root)
-    web_docs = webdocs.WebDocs(env_root, base_url)
+    web_docs = webdocs.WebDocs(env_root, base_url,
+                               get_docs_cache_path(env_root))
     must_rewrite_links = True
     if base_url:
         must_rewrite_links = False
@@ -3,11 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os, re, errno
-import markdown
 import cgi
 
 from cuddlefish import packaging
 from cuddlefish.docs import apirenderer
+from cuddlefish.docs import converter
 from cuddlefish._version import get_versions
 
 INDEX_PAGE = '/doc/static-files/base.html'
@@ -53,8 +53,11 @@ def insert_after(target, insertion_point_id, text_to_insert):
     return target[:insertion_point] + text_to_insert + target[insertion_point:]
 
 class WebDocs(object):
-    def __init__(self, root, base_url = None):
+    def __init__(self, root, base_url = None, cache_dir = None):
         self.root = root
+        self.render_cache = None
+        if cache_dir:
+            self.render_cache = apirenderer.RenderCache(cache_dir)
         self.pkg_cfg = packaging.build_pkg_cfg(root)
         self.packages_json = packaging.build_pkg_index(self.pkg_cfg)
         self.base_page = self._create_base_page(root, base_url)
@@ -63,13 +66,13 @@ class WebDocs(object):
         path, ext = os.path.splitext(path)
         md_path = path + '.md'
         md_content = unicode(open(md_path, 'r').read(), 'utf8')
-        guide_content = markdown.markdown(md_content)
+        guide_content = converter.convert(md_content)
         return self._create_page(guide_content)
 
     def create_module_page(self, path):
         path, ext = os.path.splitext(path)
         md_path = path + '.md'
-        module_content = apirenderer.md_to_div(md_path)
+        module_content = apirenderer.md_to_div(md_path, self.render_cache)
         return self._create_page(module_content)
 
     def create_package_page(self, package_name):
@@ -177,7 +180,7 @@ class WebDocs(object):
         description = ''
         if package_json.get('readme', None):
             description += tag_wrap(tag_wrap(\
-                markdown.markdown(\
+                converter.convert(\
                     package_json['readme']), 'p'), 'div', {'class':'docs'})
         return tag_wrap(package_title + table + description, 'div', \
                         {'class':'package-detail'})
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Pick the fastest JSON implementation available. Our bundled simplejson
+# only has its pure-Python scanner and encoder unless its _speedups
+# extension has been compiled, which it never is in the SDK tree. The
+# standard library's json module (Python 2.6 and later) comes from the same
+# code base, and on Python 2.7 ships C-accelerated versions of them, so we
+# use it when it has them. Both produce byte-identical output for the data
+# we write (see tests/test_json_backend.py).
+#
+# Use it like the module it replaces:
+#
+#   from cuddlefish import json_backend as json
+
+from __future__ import absolute_import
+
+import sys
+import time
+
+def _stdlib_json():
+    try:
+        import json
+        from json import decoder, encoder
+    except ImportError:
+        return None
+    if (getattr(decoder, "c_scanstring", None) is None or
+        getattr(encoder, "c_encode_basestring_ascii", None) is None):
+        return None
+    return json
+
+def _simplejson():
+    import simplejson
+    try:
+        import simplejson._speedups
+        return simplejson, "simplejson (speedups)"
+    except ImportError:
+        return simplejson, "simplejson (pure Python)"
+
+_json = _stdlib_json()
+if _json is not None:
+    BACKEND = "json (C accelerated)"
+else:
+    _json, BACKEND = _simplejson()
+
+dump = _json.dump
+dumps = _json.dumps
+load = _json.load
+loads = _json.loads
+
+def make_manifest(num_modules):
+    # a harness-options "manifest" shaped like the one ManifestBuilder makes
+    manifest = {}
+    for i in range(num_modules):
+        path = "pkg%d/lib/module%d" % (i % 10, i)
+        manifest[path] = {
+            "packageName": "pkg%d" % (i % 10),
+            "sectionName": "lib",
+            "moduleName": "module%d" % i,
+            "jsSHA256": "%064x" % (i * 7919),
+            "docsSHA256": None,
+            "requirements": dict([("module%d" % j,
+                                   "pkg%d/lib/module%d" % (j % 10, j))
+                                  for j in range(max(0, i - 5), i)]),
+            "chrome": False,
+            "zipPath": "resources/pkg%d/lib/module%d.js" % (i % 10, i),
+            }
+    return {"manifest": manifest, "name": u"caf\xe9", "jetpackID": "x@jetpack"}
+
+def benchmark(sizes=(100, 1000, 10000), rounds=3):
+    import simplejson
+    backends = [("simplejson (bundled)", simplejson),
+                ("selected: " + BACKEND, _json)]
+    for num_modules in sizes:
+        options = make_manifest(num_modules)
+        for name, backend in backends:
+            encode_times, decode_times = [], []
+            for i in range(rounds):
+                start = time.time()
+                text = backend.dumps(options, indent=1, sort_keys=True)
+                middle = time.time()
+                backend.loads(text)
+                encode_times.append(middle - start)
+                decode_times.append(time.time() - middle)
+            print "%6d modules  %-32s dumps %.4fs  loads %.4fs" % (
+                num_modules, name, min(encode_times), min(decode_times))
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or (100, 1000, 10000)
+    benchmark(sizes)
@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Strip the translations that an add-on cannot use out of its locales: keys
+# that none of its modules looks up, and plural forms that the plural rules
+# of a language never pick.
+
+import os
+import re
+import hashlib
+
+from cuddlefish import json_backend as json
+from cuddlefish.packaging import Locale
+
+# addon-kit/lib/l10n.js tries these for 0, 1 and 2 in every language, before
+# it asks the plural rules, and falls back to "other"
+ALWAYS_USED_PLURAL_FORMS = frozenset(["zero", "one", "two", "other"])
+
+LOCALES_TO_RULES_RE = re.compile(r"const LOCALES_TO_RULES = (\{.*?\});",
+                                 re.S)
+RULE_RE = re.compile(r'"(\d+)": function \(n\) \{(.*?)\n  \}', re.S)
+RETURN_RE = re.compile(r'return "(\w+)"')
+
+def parse_plural_rules(path):
+    """Read api-utils/lib/l10n/plural-rules.js (as written by
+    plural-rules-generator.py), and return a dict that maps each short
+    language code to the set of plural forms its rule can return."""
+    text = open(path, "r").read()
+    locales_to_rules = json.loads(LOCALES_TO_RULES_RE.search(text).group(1))
+    rule_forms = {}
+    for mo in RULE_RE.finditer(text):
+        rule_forms[mo.group(1)] = frozenset(RETURN_RE.findall(mo.group(2)))
+    forms = {}
+    for (language, index) in locales_to_rules.items():
+        forms[language] = rule_forms[str(index)]
+    return forms
+
+def get_plural_rules_path(pkg_cfg):
+    return os.path.join(pkg_cfg.packages["api-utils"].root_dir,
+                        "lib", "l10n", "plural-rules.js")
+
+def get_used_plural_forms(language, plural_forms):
+    # like api-utils/l10n/core's language(): fr-FR and fr share their rules,
+    # and languages with no known rules only ever use "other"
+    short = language.split("-")[0].lower()
+    return ALWAYS_USED_PLURAL_FORMS.union(plural_forms.get(short, []))
+
+def strip_locale(locale, language, used_keys, plural_forms):
+    """Return a new Locale with only the keys in `used_keys`, and only the
+    plural forms that `language` can use."""
+    used_forms = get_used_plural_forms(language, plural_forms)
+    stripped = Locale()
+    for key in locale:
+        if key not in used_keys:
+            continue
+        value = locale[key]
+        if isinstance(value, dict):
+            value = dict([(form, text) for (form, text) in value.items()
+                          if form in used_forms])
+        stripped[key] = value
+        stripped.packages[key] = locale.packages.get(key)
+    # the stripped translations depend on everything stripping looked at,
+    # so packaged JSON for them can be reused only for the same inputs
+    fingerprint = hashlib.sha256()
+    fingerprint.update(language.encode("utf-8"))
+    for key in sorted(used_keys):
+        fingerprint.update("\0" + key.encode("utf-8"))
+    stripped.sources = (list(getattr(locale, "sources", [])) +
+                        ["strip:" + fingerprint.hexdigest()])
+    return stripped
+
+def encoded_size(locale):
+    # what the locale weighs in the XPI, see xpi.get_locale_json()
+    return len(json.dumps(locale, indent=1, sort_keys=True,
+                          ensure_ascii=False).encode("utf-8"))
+
+def strip_locales(locales, used_keys, plural_forms, stdout=None):
+    """Strip every language in `locales` (the 'locale' property of the
+    build), and print how many bytes that saved for each one."""
+    total_before = total_after = 0
+    for language in sorted(locales):
+        locale = locales[language]
+        stripped = strip_locale(locale, language, used_keys, plural_forms)
+        before = encoded_size(locale)
+        after = encoded_size(stripped)
+        total_before += before
+        total_after += after
+        if stdout:
+            print >>stdout, ("  %s: %d of %d keys kept, %d -> %d bytes"
+                             % (language, len(stripped), len(locale),
+                                before, after))
+        locales[language] = stripped
+    if stdout and locales:
+        print >>stdout, ("Stripped locales: %d -> %d bytes (saved %d)"
+                         % (total_before, total_after,
+                            total_before - total_after))
@@ -3,8 +3,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-import os, sys, re, hashlib
-import simplejson as json
+import os, sys, re, hashlib, fnmatch, posixpath
+from cuddlefish import json_backend as json
 SEP = os.path.sep
 from cuddlefish.util import filter_filenames, filter_dirnames
 
@@ -51,6 +51,9 @@ class ManifestEntry:
         self.docs_hash = None
         self.requirements = {}
         self.datamap = None
+        self.l10n_keys = set()
+        self.data_refs = set()
+        self.data_dynamic = False
 
     def get_path(self):
         path = "%s/%s/%s" % \
@@ -79,6 +82,12 @@ class ManifestEntry:
             assert isinstance(entry["requirements"][req], dict)
         return entry
 
+    def get_required_entries(self):
+        # the ManifestEntry of each module this one requires, in the order
+        # of their require() names
+        return [self.requirements[req] for req in sorted(self.requirements)
+                if isinstance(self.requirements[req], ManifestEntry)]
+
     def add_js(self, js_filename):
         self.js_filename = js_filename
         self.js_hash = hash_file(js_filename)
@@ -89,6 +98,11 @@ class ManifestEntry:
         self.requirements[reqname] = reqdata
     def add_data(self, datamap):
         self.datamap = datamap
+    def add_l10n_keys(self, keys):
+        self.l10n_keys.update(keys)
+    def add_data_refs(self, refs, dynamic):
+        self.data_refs.update(refs)
+        self.data_dynamic = self.data_dynamic or dynamic
 
     def get_js_zipname(self):
         return js_zipname(self.packagename, self.modulename)
@@ -100,6 +114,63 @@ class ManifestEntry:
     # self.docs_filename
 
 
+def find_load_order(roots, follow=None):
+    """Find the strongly connected components of the require() graph that
+    can be reached from the `roots` ManifestEntry objects, with Tarjan's
+    algorithm, and return them as lists of entries (sorted by path), in an
+    order where each component comes after the ones it requires. When
+    `follow` is given, only the required entries it returns True for are
+    visited."""
+    # require("two") and require("two.js") get separate entries for the
+    # same file, so the graph is built on paths, with one entry for each
+    entries = {}
+    def visit(me):
+        path = me.get_path()
+        entries.setdefault(path, me)
+        return path
+    def required(path):
+        return [visit(them) for them in entries[path].get_required_entries()
+                if follow is None or follow(them)]
+    index = {}
+    lowlink = {}
+    stack = [] # paths whose component is not known yet
+    on_stack = set()
+    groups = []
+    for root in map(visit, roots):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(required(root)))]
+        while work:
+            path, children = work[-1]
+            for them in children:
+                if them not in index:
+                    index[them] = lowlink[them] = len(index)
+                    stack.append(them)
+                    on_stack.add(them)
+                    work.append((them, iter(required(them))))
+                    break
+                elif them in on_stack:
+                    lowlink[path] = min(lowlink[path], index[them])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[path])
+                if lowlink[path] == index[path]:
+                    group = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        group.append(member)
+                        if member == path:
+                            break
+                    groups.append([entries[member]
+                                   for member in sorted(group)])
+    return groups
+
 def hash_file(fn):
     return hashlib.sha256(open(fn,"rb").read()).hexdigest()
 
@@ -121,6 +192,7 @@ class DataMap:
         self.pkg = pkg
         self.name = pkg.name
         self.files_to_copy = []
+        self.datafiles = {} # maps "/"-separated name within data/ to absname
         datamap = {}
         datadir = os.path.join(pkg.root_dir, "data")
         for dataname in get_datafiles(datadir):
@@ -128,11 +200,75 @@ class DataMap:
             zipname = datafile_zipname(pkg.name, dataname)
             datamap[dataname] = hash_file(absname)
             self.files_to_copy.append( (zipname, absname) )
+            self.datafiles["/".join(dataname.split(SEP))] = absname
         self.data_manifest = to_json(datamap)
         self.data_manifest_hash = hashlib.sha256(self.data_manifest).hexdigest()
         self.data_manifest_zipname = datamap_zipname(pkg.name)
         self.data_uri_prefix = "%s/data/" % (self.name)
 
+COMPACT_MANIFEST_FORMAT = 2
+
+def compact_manifest(manifest, include_hashes=True):
+    """
+    Encode a harness-options manifest (as returned by
+    get_harness_options_manifest()) in the compact format that
+    api-utils/lib/cuddlefish.js also understands:
+
+     {"format": 2,
+      "strings": [every path and requirement name, sorted, once each],
+      "modules": [[path, name, target, name, target, ...], ...],
+      "jsSHA256": [...], "docsSHA256": [...]}
+
+    Each row of 'modules' is a list of indexes into 'strings': the module's
+    path followed by a (requirement name, path it resolves to) pair for
+    each of its requirements. The two hash lists are parallel to 'modules',
+    and are left out when include_hashes is False. packageName, sectionName
+    and moduleName are not kept, since the path is made of them.
+    """
+    strings = set()
+    for path, entry in manifest.items():
+        strings.add(path)
+        for name, req in entry["requirements"].items():
+            strings.add(name)
+            strings.add(req["path"])
+    strings = sorted(strings)
+    index = dict([(s, i) for (i, s) in enumerate(strings)])
+
+    paths = sorted(manifest.keys())
+    modules = []
+    for path in paths:
+        requirements = manifest[path]["requirements"]
+        row = [index[path]]
+        for name in sorted(requirements.keys()):
+            row.append(index[name])
+            row.append(index[requirements[name]["path"]])
+        modules.append(row)
+    compact = {"format": COMPACT_MANIFEST_FORMAT,
+               "strings": strings,
+               "modules": modules}
+    if include_hashes:
+        compact["jsSHA256"] = [manifest[path]["jsSHA256"] for path in paths]
+        compact["docsSHA256"] = [manifest[path]["docsSHA256"]
+                                 for path in paths]
+    return compact
+
+def expand_manifest(compact):
+    # the inverse of compact_manifest(), minus the entries' package, section
+    # and module names. Hashes come back as None if they were left out.
+    strings = compact["strings"]
+    modules = compact["modules"]
+    js_hashes = compact.get("jsSHA256", [None] * len(modules))
+    docs_hashes = compact.get("docsSHA256", [None] * len(modules))
+    manifest = {}
+    for (row, js_hash, docs_hash) in zip(modules, js_hashes, docs_hashes):
+        requirements = {}
+        for i in range(1, len(row), 2):
+            requirements[strings[row[i]]] = {"path": strings[row[i+1]]}
+        manifest[strings[row[0]]] = {"jsSHA256": js_hash,
+                                     "docsSHA256": docs_hash,
+                                     "requirements": requirements}
+    return manifest
+
 class BadChromeMarkerError(Exception):
     pass
 
@@ -175,14 +311,16 @@ class ManifestBuilder:
         self.datamaps = {} # maps package name to DataMap instance
         self.files = [] # maps manifest index to (absfn,absfn) js/docs pair
         self.test_modules = [] # for runtime
+        self.top_entry = None
 
-    def build(self, scan_tests, test_filter_re):
+    def build(self, scan_tests, test_filter_re, test_prefix="test-"):
         # process the top module, which recurses to process everything it
         # reaches
         if "main" in self.target_cfg:
             top_mi = self.find_top(self.target_cfg)
             top_me = self.process_module(top_mi)
             self.top_path = top_me.get_path()
+            self.top_entry = top_me
             self.datamaps[self.target_cfg.name] = DataMap(self.target_cfg)
         if scan_tests:
             mi = self._find_module_in_package("test-harness", "lib", "run-tests", [])
@@ -192,7 +330,8 @@ class ManifestBuilder:
             # processing tests in packages that our own tests depend upon. If
             # we're running tests for package A, and either modules in A or
             # tests in A depend upon modules from package B, we *don't* want
-            # to run tests for package B.
+            # to run tests for package B. `cfx bench` looks for benchmarks
+            # instead, in "bench-*.js" files.
             test_modules = []
             dirnames = self.target_cfg["tests"]
             if isinstance(dirnames, basestring):
@@ -201,7 +340,8 @@ class ManifestBuilder:
                         for d in dirnames]
             for d in dirnames:
                 for filename in os.listdir(d):
-                    if filename.startswith("test-") and filename.endswith(".js"):
+                    if (filename.startswith(test_prefix) and
+                        filename.endswith(".js")):
                         testname = filename[:-3] # require(testname)
                         if test_filter_re:
                             if not re.search(test_filter_re, testname):
@@ -257,11 +397,99 @@ class ManifestBuilder:
     def get_all_test_modules(self):
         return self.test_modules
 
-    def get_harness_options_manifest(self):
-        manifest = {}
+    def get_module_load_order(self):
+        # returns every ManifestEntry, starting with the ones the main
+        # module needs, in an order where each module comes after
+        # everything it requires, except within a cycle
+        roots = sorted(self.get_module_entries(), key=ManifestEntry.get_path)
+        if self.top_entry is not None:
+            roots.insert(0, self.top_entry)
+        order = []
+        for group in find_load_order(roots):
+            order.extend(group)
+        return order
+
+    def get_load_order(self, main_path):
+        """Return the 'loadOrder' and 'preload' properties for
+        harness-options.json. 'loadOrder' lists the modules that the module
+        at `main_path` reaches, in groups that come after every group they
+        require: each group is a single module, or the modules of one
+        require() cycle. 'preload' is the part of that list that is not
+        reached through a test module, since the test runner loads those
+        when it gets to them."""
+        entries = dict([(me.get_path(), me)
+                        for me in self.get_module_entries()])
+        main = entries[main_path]
+        load_order = [[me.get_path() for me in group]
+                      for group in find_load_order([main])]
+        eager = find_load_order([main], lambda me: me.sectionName != "tests")
+        preload = [me.get_path() for group in eager for me in group]
+        return {"loadOrder": load_order, "preload": preload}
+
+    def get_used_l10n_keys(self):
+        # every key that used modules look up with _("key"), plus the
+        # data-l10n-id attributes of the HTML files in data/
+        keys = set()
         for me in self.get_module_entries():
+            keys.update(me.l10n_keys)
+        for datamap in self.datamaps.values():
+            for (zipname, absname) in datamap.files_to_copy:
+                if os.path.splitext(absname)[1] in HTML_EXTENSIONS:
+                    keys.update(scan_html_l10n_ids(open(absname).read()))
+        return keys
+
+    def strip_unused_data(self, stdout=sys.stdout):
+        """Remove the files in the add-on's data/ directory that nothing
+        refers to from get_used_files(), and report how many bytes that
+        saved. Files are used when a module of the add-on names them in a
+        data.url() or data.load() call, when an HTML or CSS file that is
+        used refers to them, or when they match a pattern in the
+        "dataAllowlist" list of package.json."""
+        name = self.target_cfg.name
+        datamap = self.datamaps.get(name)
+        if not datamap or not datamap.datafiles:
+            return
+        allowlist = self.target_cfg.get("dataAllowlist", [])
+        entries = [me for me in self.get_module_entries()
+                   if me.packageName == name]
+        dynamic = sorted([me.js_filename for me in entries
+                          if me.data_dynamic])
+        if dynamic and not allowlist:
+            print >>stdout, ("Keeping all of data/: data.url() or data.load()"
+                             " is called with a computed name in:\n  %s\n"
+                             "List the files it needs in the "
+                             "\"dataAllowlist\" of package.json to strip "
+                             "the others." % "\n  ".join(dynamic))
+            return
+        refs = set()
+        for me in entries:
+            refs.update(me.data_refs)
+        used = find_used_datafiles(datamap.datafiles, refs, allowlist)
+        removed = [(zipname, absname)
+                   for (zipname, absname) in datamap.files_to_copy
+                   if absname not in used]
+        datamap.files_to_copy = [(zipname, absname)
+                                 for (zipname, absname)
+                                 in datamap.files_to_copy
+                                 if absname in used]
+        removed_bytes = sum([os.path.getsize(absname)
+                             for (zipname, absname) in removed])
+        print >>stdout, ("Stripped %d of %d files from data/ (%d bytes)"
+                         % (len(removed), len(datamap.datafiles),
+                            removed_bytes))
+
+    def get_harness_options_manifest(self, compact=False,
+                                     include_hashes=True):
+        manifest = {}
+        # require("two") and require("two.js") make two entries for the
+        # same path: always describe it with the same one
+        for me in sorted(self.get_module_entries(),
+                         key=lambda me: (me.get_path(), me.moduleName)):
             path = me.get_path()
-            manifest[path] = me.get_entry_for_manifest()
+            if path not in manifest:
+                manifest[path] = me.get_entry_for_manifest()
+        if compact:
+            return compact_manifest(manifest, include_hashes)
         return manifest
 
     def get_manifest_entry(self, package, section, module):
@@ -365,6 +593,8 @@ class ManifestBuilder:
         if problems:
             # the relevant instructions have already been written to stderr
             raise BadChromeMarkerError()
+        me.add_l10n_keys(scan_l10n_keys(mi.js, js_lines))
+        me.add_data_refs(*scan_data_refs(mi.js, js_lines))
 
         # We update our requirements on the way out of the depth-first
         # traversal of the module graph
@@ -567,7 +797,8 @@ class ManifestBuilder:
         return None
 
 def build_manifest(target_cfg, pkg_cfg, deps, scan_tests,
-                   test_filter_re=None, extra_modules=[]):
+                   test_filter_re=None, extra_modules=[],
+                   test_prefix="test-"):
     """
     Perform recursive dependency analysis starting from entry_point,
     building up a manifest of modules that need to be included in the XPI.
@@ -594,7 +825,7 @@ def build_manifest(target_cfg, pkg_cfg, deps, scan_tests,
     """
 
     mxt = ManifestBuilder(target_cfg, pkg_cfg, deps, extra_modules)
-    mxt.build(scan_tests, test_filter_re)
+    mxt.build(scan_tests, test_filter_re, test_prefix)
     return mxt
 
 
@@ -649,6 +880,102 @@ def scan_requirements_with_grep(fn, lines):
 
     return requires, first_location
 
+# _("key") and _("key", count), the way add-ons use addon-kit/l10n's get()
+L10N_RE = re.compile(r"""(?<![\w.$])_\(\s*(?:"((?:[^"\\\n]|\\.)*)"|'((?:[^'\\\n]|\\.)*)')""")
+L10N_ID_RE = re.compile(r"""data-l10n-id\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+HTML_EXTENSIONS = [".html", ".htm", ".xhtml"]
+JS_ESCAPE_RE = re.compile(r"\\(.)")
+
+def scan_l10n_keys(fn, lines):
+    # Like the require() scan, this only sees string literals: keys that
+    # are computed at runtime are invisible to it.
+    keys = set()
+    text = "".join(lines)
+    if "_(" not in text:
+        return keys
+    for mo in L10N_RE.finditer(text):
+        literal = mo.group(1)
+        if literal is None:
+            literal = mo.group(2)
+        literal = JS_ESCAPE_RE.sub(r"\1", literal)
+        keys.add(literal.decode("utf-8", "replace"))
+    return keys
+
+def scan_html_l10n_ids(text):
+    keys = set()
+    for mo in L10N_ID_RE.finditer(text):
+        l10n_id = mo.group(1) or mo.group(2) or ""
+        keys.add(l10n_id.decode("utf-8", "replace"))
+    return keys
+
+# data.url("name") and data.load("name"), whether data comes from
+# require("self") or not. An empty data.url() names the data/ directory.
+DATA_CALL_RE = re.compile(r"(?<![\w$])data\.(?:url|load)\(\s*")
+STRING_LITERAL_RE = re.compile(r"""(?:"((?:[^"\\\n]|\\.)*)"|'((?:[^'\\\n]|\\.)*)')\s*\)""")
+# references from HTML and CSS files in data/ to their neighbours
+DATA_LINK_RE = re.compile(r"""(?:\b(?:src|href)\s*=\s*["']|url\(\s*["']?)([^"')\s]+)""")
+LINKING_EXTENSIONS = HTML_EXTENSIONS + [".css"]
+
+def scan_data_refs(fn, lines):
+    # returns the set of names passed to data.url()/data.load() as string
+    # literals, and whether any of them is passed something else
+    refs = set()
+    dynamic = False
+    text = "".join(lines)
+    if "data." not in text:
+        return refs, dynamic
+    for mo in DATA_CALL_RE.finditer(text):
+        rest = text[mo.end():]
+        if rest.startswith(")"):
+            refs.add("")
+            continue
+        literal = STRING_LITERAL_RE.match(rest)
+        if not literal:
+            dynamic = True
+            continue
+        name = literal.group(1)
+        if name is None:
+            name = literal.group(2)
+        refs.add(JS_ESCAPE_RE.sub(r"\1", name))
+    return refs, dynamic
+
+def find_used_datafiles(datafiles, refs, allowlist=[]):
+    """Given `datafiles`, a dict that maps "/"-separated names within a
+    data/ directory to local paths, return the set of local paths that are
+    reachable from the names in `refs` or that match a pattern of
+    `allowlist`. A name that ends in "/" (or is empty) keeps the whole
+    directory."""
+    used = set()
+    todo = []
+    def use(name):
+        name = name.lstrip("/")
+        if name and not name.endswith("/"):
+            name = posixpath.normpath(name)
+        if name in datafiles:
+            todo.append(name)
+        elif name == "" or name.endswith("/"):
+            todo.extend([n for n in datafiles if n.startswith(name)])
+    for ref in refs:
+        use(ref)
+    for pattern in allowlist:
+        todo.extend([n for n in datafiles if fnmatch.fnmatch(n, pattern)])
+    while todo:
+        name = todo.pop()
+        if datafiles[name] in used:
+            continue
+        used.add(datafiles[name])
+        if os.path.splitext(name)[1] not in LINKING_EXTENSIONS:
+            continue
+        base = posixpath.dirname(name)
+        for mo in DATA_LINK_RE.finditer(open(datafiles[name]).read()):
+            link = mo.group(1).split("#")[0].split("?")[0]
+            if not link or ":" in link or link.startswith("/"):
+                continue # absolute URLs point outside of data/
+            link = posixpath.normpath(posixpath.join(base, link))
+            if link in datafiles:
+                todo.append(link)
+    return used
+
 CHROME_ALIASES = [
     (re.compile(r"Components\.classes"), "Cc"),
     (re.compile(r"Components\.interfaces"), "Ci"),
@@ -717,7 +1044,50 @@ def scan_module(fn, lines, stderr=sys.stderr):
 
 
 
+def benchmark_manifest_formats(manifest, rounds=5):
+    # size of each manifest encoding as it is written into
+    # harness-options.json, and the best time to parse it back
+    import time
+    formats = [("full", manifest),
+               ("compact", compact_manifest(manifest)),
+               ("compact, no hashes", compact_manifest(manifest, False))]
+    results = []
+    for (name, data) in formats:
+        text = json.dumps(data, indent=1, sort_keys=True)
+        best = None
+        for i in range(rounds):
+            start = time.time()
+            json.loads(text)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, len(text), best))
+    return results
+
+def get_sdk_test_manifest(env_root):
+    # the manifest that 'cfx test' builds for addon-kit's tests, which
+    # covers most of the SDK
+    from cuddlefish import packaging
+    pkgdir = os.path.join(env_root, "packages", "addon-kit")
+    target_cfg = packaging.get_config_in_dir(pkgdir)
+    pkg_cfg = packaging.build_config(env_root, target_cfg)
+    deps = packaging.get_deps_for_targets(pkg_cfg, ["addon-kit",
+                                                    "test-harness"])
+    loader_js = os.path.join(pkg_cfg.packages["api-utils"].root_dir,
+                             "lib", "cuddlefish.js")
+    mxt = build_manifest(target_cfg, pkg_cfg, deps, scan_tests=True,
+                         extra_modules=[("api-utils", "lib", "cuddlefish",
+                                         loader_js)])
+    return mxt.get_harness_options_manifest()
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ["--bench"]:
+        env_root = os.environ.get('CUDDLEFISH_ROOT', os.getcwd())
+        manifest = get_sdk_test_manifest(env_root)
+        print "%d modules" % len(manifest)
+        for (name, size, elapsed) in benchmark_manifest_formats(manifest):
+            print "%-20s %8d bytes  parse %.4fs" % (name, size, elapsed)
+        sys.exit(0)
     for fn in sys.argv[1:]:
         requires, problems, locations = scan_module(fn, open(fn).readlines())
         print
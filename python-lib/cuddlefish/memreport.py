@@ -0,0 +1,262 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Turn the memory samples that `cfx test --profile-memory` gets from the
+# test harness into a report: what each test leaves behind, which tests
+# look like they leak, and how memory grows from one run of the tests to
+# the next (with --times). Reports are written as JSON and HTML, and an
+# earlier JSON report can serve as a baseline for later runs.
+
+import os
+from xml.sax.saxutils import escape
+
+from cuddlefish import json_backend as json
+
+REPORT_VERSION = 1
+
+# what memory.getUsage() in api-utils/lib/memory.js measures
+METRICS = ("explicit", "resident", "trackedObjects")
+BYTE_METRICS = ("explicit", "resident")
+
+# A test that leaves at least this much more explicit memory allocated every
+# time it runs is a leak suspect, as is one that leaves tracked objects
+# alive. Smaller changes in bytes are too noisy to call regressions.
+LEAK_BYTES = 1024 * 1024
+NOISE_BYTES = 256 * 1024
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def get_slope(values):
+    """Return the least-squares growth per step of `values`."""
+    n = len(values)
+    if n < 2:
+        return 0
+    mean_x = (n - 1) / 2.0
+    mean_y = sum(values) / float(n)
+    num = sum([(x - mean_x) * (y - mean_y) for (x, y) in enumerate(values)])
+    den = sum([(x - mean_x) ** 2 for x in range(n)])
+    return num / den
+
+def get_deltas(memory):
+    """Return what changed between the 'before' and 'after' usage of a
+    test-end entry's 'memory', for each metric that both have."""
+    deltas = {}
+    for metric in METRICS:
+        before = memory["before"].get(metric)
+        after = memory["after"].get(metric)
+        if before is not None and after is not None:
+            deltas[metric] = after - before
+    return deltas
+
+def build_report(results, samples):
+    """Return the report of a run of the tests, given the test-end entries
+    of its TestResultStream and its "memory" entries, which the harness
+    writes before the first run of the tests and after each one."""
+    tests = {}
+    for entry in results:
+        if "memory" not in entry:
+            continue
+        runs = tests.setdefault(entry["test"], [])
+        runs.append(get_deltas(entry["memory"]))
+
+    report_tests = {}
+    suspects = []
+    for name in sorted(tests):
+        runs = tests[name]
+        test = {"runs": len(runs), "median": {}, "max": {}}
+        for metric in METRICS:
+            values = [deltas[metric] for deltas in runs if metric in deltas]
+            if values:
+                test["median"][metric] = median(values)
+                test["max"][metric] = max(values)
+        reasons = []
+        if min([deltas.get("trackedObjects", 0) for deltas in runs]) > 0:
+            reasons.append("leaves tracked objects alive")
+        if min([deltas.get("explicit", 0) for deltas in runs]) >= LEAK_BYTES:
+            reasons.append("leaves explicit memory allocated")
+        if reasons:
+            suspects.append({"test": name, "reasons": reasons})
+        report_tests[name] = test
+
+    iterations = [entry["usage"] for entry in
+                  sorted(samples, key=lambda entry: entry["iteration"])]
+    trends = {}
+    for metric in METRICS:
+        values = [usage[metric] for usage in iterations
+                  if usage.get(metric) is not None]
+        if len(values) > 1:
+            trends[metric] = get_slope(values)
+    # bins of tracked objects that have more live objects after every run
+    growing_bins = []
+    if len(iterations) > 2:
+        for name in sorted(iterations[-1].get("bins", {})):
+            counts = [usage.get("bins", {}).get(name, 0)
+                      for usage in iterations]
+            if [a for (a, b) in zip(counts, counts[1:]) if b <= a]:
+                continue
+            growing_bins.append(name)
+
+    return {"tests": report_tests,
+            "suspects": suspects,
+            "iterations": iterations,
+            "trends": trends,
+            "growingBins": growing_bins}
+
+def compare(report, baseline, threshold=10.0):
+    """Return what got worse in `report` than in `baseline`, an earlier
+    report of the same tests, as a list of sentences. Bytes count as worse
+    when they grow by more than `threshold` percent and NOISE_BYTES."""
+    def worse(metric, new, old):
+        if metric not in BYTE_METRICS:
+            return new - old >= 1
+        return (new - old > NOISE_BYTES and
+                new > old + abs(old) * threshold / 100.0)
+
+    regressions = []
+    old_suspects = set([s["test"] for s in baseline.get("suspects", [])])
+    for suspect in report["suspects"]:
+        if suspect["test"] not in old_suspects:
+            regressions.append("%s %s" % (suspect["test"],
+                                          " and ".join(suspect["reasons"])))
+    for name in sorted(report["tests"]):
+        if name not in baseline.get("tests", {}):
+            continue
+        new = report["tests"][name]["median"]
+        old = baseline["tests"][name]["median"]
+        for metric in METRICS:
+            if (metric in new and metric in old and
+                worse(metric, new[metric], old[metric])):
+                regressions.append("%s: %s grew by %s, was %s" %
+                                   (name, metric,
+                                    format_value(metric, new[metric]),
+                                    format_value(metric, old[metric])))
+    for metric in METRICS:
+        new = report["trends"].get(metric)
+        old = baseline.get("trends", {}).get(metric)
+        if new is not None and old is not None and worse(metric, new, old):
+            regressions.append("%s grew by %s per run of the tests, was %s" %
+                               (metric, format_value(metric, new),
+                                format_value(metric, old)))
+    for name in report["growingBins"]:
+        if name not in baseline.get("growingBins", []):
+            regressions.append("tracked %s objects pile up from one run of "
+                               "the tests to the next" % name)
+    return regressions
+
+def format_value(metric, value):
+    if metric not in BYTE_METRICS:
+        return "%+g" % value
+    for (unit, scale) in (("MB", 1024 * 1024.0), ("KB", 1024.0)):
+        if abs(value) >= scale:
+            return "%+.1f%s" % (value / scale, unit)
+    return "%+dB" % value
+
+def get_summary(report):
+    """Return lines that tell what is most worth knowing about `report`."""
+    lines = ["Memory profile: %d tests, %d leak suspects"
+             % (len(report["tests"]), len(report["suspects"]))]
+    for suspect in report["suspects"]:
+        lines.append("  %s %s" % (suspect["test"],
+                                  " and ".join(suspect["reasons"])))
+    if report["trends"]:
+        lines.append("  growth per run of the tests: " + ", ".join(
+            ["%s %s" % (metric, format_value(metric,
+                                             report["trends"][metric]))
+             for metric in METRICS if metric in report["trends"]]))
+    for name in report["growingBins"]:
+        lines.append("  tracked %s objects grow with every run" % name)
+    return lines
+
+def make_html(suites):
+    """Return an HTML page that shows the reports in `suites`, a dict that
+    maps the name of each package to its report."""
+    lines = ['<!DOCTYPE html>',
+             '<html><head><meta charset="utf-8">',
+             '<title>Memory profile</title>',
+             '<style>td, th { padding: 0 1em; text-align: right; } '
+             'td:first-child, th:first-child { text-align: left; } '
+             '.suspect { color: #c00; }</style>',
+             '</head><body>']
+    for name in sorted(suites):
+        report = suites[name]
+        lines.append('<h1>%s</h1>' % escape(name))
+        for line in get_summary(report):
+            lines.append('<p>%s</p>' % escape(line.strip()))
+        suspects = set([s["test"] for s in report["suspects"]])
+        lines.append('<table><tr><th>test</th><th>runs</th>' +
+                     ''.join(['<th>%s</th>' % metric for metric in METRICS])
+                     + '</tr>')
+        for test_name in sorted(report["tests"]):
+            test = report["tests"][test_name]
+            cells = []
+            for metric in METRICS:
+                value = test["median"].get(metric)
+                if value is None:
+                    cells.append('<td></td>')
+                else:
+                    cells.append('<td>%s</td>' %
+                                 escape(format_value(metric, value)))
+            lines.append('<tr%s><td>%s</td><td>%d</td>%s</tr>' %
+                         (test_name in suspects and ' class="suspect"' or '',
+                          escape(test_name), test["runs"], ''.join(cells)))
+        lines.append('</table>')
+        if len(report["iterations"]) > 1:
+            lines.append('<h2>After each run of the tests</h2>')
+            lines.append('<table><tr><th>run</th>' +
+                         ''.join(['<th>%s</th>' % metric
+                                  for metric in METRICS]) + '</tr>')
+            for (i, usage) in enumerate(report["iterations"]):
+                cells = []
+                for metric in METRICS:
+                    value = usage.get(metric)
+                    if value is None:
+                        value = ''
+                    cells.append('<td>%s</td>' % value)
+                lines.append('<tr><td>%d</td>%s</tr>' % (i, ''.join(cells)))
+            lines.append('</table>')
+    lines.append('</body></html>')
+    return "\n".join(lines).encode("utf-8") + "\n"
+
+def get_html_path(path):
+    # never the JSON report itself, even if it is called report.html
+    (root, ext) = os.path.splitext(path)
+    if ext.lower() == ".html":
+        return path + ".html"
+    return root + ".html"
+
+def write_report(path, suites):
+    """Write `suites` to `path` as JSON, and as HTML next to it."""
+    for (filename, data) in ((path, json.dumps({"version": REPORT_VERSION,
+                                                "suites": suites},
+                                               indent=1, sort_keys=True)),
+                             (get_html_path(path), make_html(suites))):
+        tmp = filename + ".tmp"
+        f = open(tmp, "w")
+        f.write(data)
+        f.close()
+        if os.path.exists(filename):
+            os.remove(filename) # windows can't rename over a file
+        os.rename(tmp, filename)
+
+def load_report(path):
+    """Return the suites of the JSON report at `path`."""
+    data = json.load(open(path, "r"))
+    if data.get("version") != REPORT_VERSION:
+        raise ValueError("%s is not a version %d memory report"
+                         % (path, REPORT_VERSION))
+    return data["suites"]
+
+# The suites of each --memory-report written by this process, so that
+# `cfx testall`, which runs each package separately, reports them all.
+report_suites = {}
+
+def add_report_suite(path, name, report):
+    suites = report_suites.setdefault(path, {})
+    suites[name] = report
+    write_report(path, suites)
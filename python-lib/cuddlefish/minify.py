@@ -0,0 +1,379 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Shrink the modules that `cfx xpi --minify` ships: drop comments and the
+# whitespace between tokens. Every line stays on the line it started on, so
+# line numbers in error messages and stack traces still match the sources,
+# and a source map gives the original column of every token.
+#
+# The minifier only ever removes text between tokens, and checks that the
+# tokens of its output are exactly the tokens of its input, so a source it
+# cannot tokenize the same way twice is shipped unchanged.
+
+import os
+import re
+import hashlib
+
+from cuddlefish import json_backend as json
+
+# part of every cache key: change it whenever minify_js() output changes
+MINIFY_VERSION = "2"
+CACHE_DIRNAME = ".minify-cache"
+SOURCEMAPS_DIRNAME = "%s-sourcemaps"
+
+WORD_RE = re.compile(r"(?:[\w$]|\\u[0-9a-fA-F]{4})+", re.U)
+NUMBER_RE = re.compile(r"0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+GAP_RE = re.compile(u"[ \t\v\f\u00a0\ufeff\r\n\u2028\u2029]+")
+LINE_TERMINATORS = u"\r\n\u2028\u2029"
+LINE_TERMINATOR_RE = re.compile(u"\r\n|[\r\n\u2028\u2029]")
+PUNCTUATORS = sorted(""">>>= ... === !== **= <<= >>= >>> <= >= == != ++ -- << >>
+    && || += -= *= %= &= |= ^= /= => ** { } ( ) [ ] ; , < > + - * % & | ^ !
+    ~ ? : = . / @ #""".split(), key=len, reverse=True)
+PUNCTUATOR_RE = re.compile("|".join(map(re.escape, PUNCTUATORS)))
+# after these words, a "/" starts a regular expression, not a division
+REGEX_AFTER_WORDS = frozenset("""return typeof instanceof in of new delete
+    void throw case do else yield""".split())
+# and after the ")" that closes the condition of these statements
+CONDITION_WORDS = frozenset(["if", "while", "for", "with"])
+# the comments minifiers conventionally keep, like license blocks
+KEEP_COMMENT_RE = re.compile(r"^/\*!|@license|@preserve")
+
+class TokenizeError(Exception):
+    pass
+
+def is_word_char(c):
+    return c.isalnum() or c in u"_$\\" or ord(c) > 127
+
+def count_lines(text):
+    # "\r\n" is one line terminator
+    return len(LINE_TERMINATOR_RE.findall(text))
+
+def last_line_length(text):
+    return len(LINE_TERMINATOR_RE.split(text)[-1])
+
+def scan_string(source, i):
+    quote = source[i]
+    j = i + 1
+    while j < len(source):
+        c = source[j]
+        if c == "\\":
+            # a line continuation may be "\\\r\n"
+            j += 3 if source.startswith("\r\n", j + 1) else 2
+            continue
+        if c == quote:
+            return j + 1
+        if c in LINE_TERMINATORS and quote != "`":
+            break
+        j += 1
+    raise TokenizeError("unterminated string")
+
+def scan_regex(source, i):
+    # returns the end of the regular expression literal at `i`, or None if
+    # there is none there
+    j = i + 1
+    in_class = False
+    while j < len(source):
+        c = source[j]
+        if c in LINE_TERMINATORS:
+            return None
+        if c == "\\":
+            j += 2
+            continue
+        if c == "[":
+            in_class = True
+        elif c == "]":
+            in_class = False
+        elif c == "/" and not in_class:
+            mo = WORD_RE.match(source, j + 1)
+            return mo.end() if mo else j + 1
+        j += 1
+    return None
+
+def regex_allowed(previous):
+    if previous is None:
+        return True
+    kind, text = previous
+    if kind == "word":
+        return text in REGEX_AFTER_WORDS
+    if kind in ("number", "string", "regex"):
+        return False
+    if kind == "condition":
+        return True
+    return text not in (")", "]")
+
+def tokenize(source):
+    """Yield (kind, text, line, column) for the tokens of the JavaScript in
+    `source`, where kind is "gap" for the comments and whitespace between
+    them, and "comment" for the comments that must be kept."""
+    i = 0
+    line = column = 0
+    previous = None
+    # for each open "(", whether it starts the condition of an if, while,
+    # for or with statement
+    parens = []
+    while i < len(source):
+        c = source[i]
+        start = i
+        kind = None
+        mo = GAP_RE.match(source, i)
+        if mo:
+            kind = "gap"
+            i = mo.end()
+        elif source.startswith("//", i):
+            kind = "gap"
+            while i < len(source) and source[i] not in LINE_TERMINATORS:
+                i += 1
+        elif source.startswith("/*", i):
+            end = source.find("*/", i + 2)
+            if end == -1:
+                raise TokenizeError("unterminated comment")
+            i = end + 2
+            kind = "gap"
+            if KEEP_COMMENT_RE.search(source[start:i]):
+                kind = "comment"
+        elif c in "'\"`":
+            kind = "string"
+            i = scan_string(source, i)
+        elif c == "/" and regex_allowed(previous):
+            end = scan_regex(source, i)
+            if end is not None:
+                kind = "regex"
+                i = end
+        if kind is None:
+            mo = NUMBER_RE.match(source, i)
+            if mo and (c.isdigit() or mo.end() > i + 1):
+                kind = "number"
+                i = mo.end()
+        if kind is None and is_word_char(c):
+            mo = WORD_RE.match(source, i)
+            if not mo:
+                raise TokenizeError("unexpected character %r" % c)
+            kind = "word"
+            i = mo.end()
+        if kind is None:
+            mo = PUNCTUATOR_RE.match(source, i)
+            if not mo:
+                raise TokenizeError("unexpected character %r" % c)
+            kind = "punctuator"
+            i = mo.end()
+        text = source[start:i]
+        yield (kind, text, line, column)
+        if kind == "punctuator" and text == "(":
+            parens.append(previous is not None and previous[0] == "word"
+                          and previous[1] in CONDITION_WORDS)
+        if kind == "punctuator" and text == ")" and parens and parens.pop():
+            previous = ("condition", text)
+        elif kind not in ("gap", "comment"):
+            previous = (kind, text)
+        lines = count_lines(text)
+        if lines:
+            line += lines
+            column = last_line_length(text)
+        else:
+            column += len(text)
+
+def needs_space(before, after):
+    # would `before` and `after` run together into other tokens?
+    a, b = before[-1], after[0]
+    if is_word_char(a) and is_word_char(b):
+        return True
+    if NUMBER_RE.match(before) and b == ".":
+        return True
+    return (a + b) in ("++", "--", "//", "/*", "<!", "->")
+
+def code_tokens(source):
+    return [(kind, text) for (kind, text, line, column) in tokenize(source)
+            if kind != "gap"]
+
+def minify_js(source):
+    """Return the minified version of the unicode JavaScript `source`, and
+    the mappings of its source map: (generated line, generated column,
+    original line, original column) for each token, all 0-based."""
+    output = []
+    mappings = []
+    out_line = out_column = 0
+    pending_lines = 0
+    pending_space = False
+    last = None
+    for (kind, text, line, column) in tokenize(source):
+        if kind == "gap":
+            lines = count_lines(text)
+            pending_lines += lines
+            pending_space = pending_space or not lines
+            continue
+        if pending_lines:
+            output.append(u"\n" * pending_lines)
+            out_line += pending_lines
+            out_column = 0
+        elif last is not None and pending_space and needs_space(last, text):
+            output.append(u" ")
+            out_column += 1
+        pending_lines = 0
+        pending_space = False
+        mappings.append((out_line, out_column, line, column))
+        output.append(text)
+        lines = count_lines(text)
+        if lines:
+            out_line += lines
+            out_column = last_line_length(text)
+        else:
+            out_column += len(text)
+        last = text
+    if pending_lines:
+        output.append(u"\n" * pending_lines)
+    minified = u"".join(output)
+    if code_tokens(minified) != code_tokens(source):
+        raise TokenizeError("minified tokens differ from the source")
+    return minified, mappings
+
+BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+def encode_vlq(value):
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    digits = []
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digit |= 32
+        digits.append(BASE64[digit])
+        if not value:
+            return "".join(digits)
+
+def encode_mappings(mappings):
+    # the "mappings" string of a version 3 source map with a single source
+    lines = []
+    previous_line = previous_column = 0
+    segments = None
+    out_line = -1
+    for (gen_line, gen_column, line, column) in mappings:
+        while out_line < gen_line:
+            segments = []
+            lines.append(segments)
+            out_line += 1
+            previous_gen_column = 0
+        segments.append(encode_vlq(gen_column - previous_gen_column) +
+                        encode_vlq(0) +
+                        encode_vlq(line - previous_line) +
+                        encode_vlq(column - previous_column))
+        previous_gen_column = gen_column
+        previous_line, previous_column = line, column
+    return ";".join([",".join(segments) for segments in lines])
+
+def make_source_map(path, source, mappings):
+    return json.dumps({"version": 3,
+                       "file": path.split("/")[-1],
+                       "sources": [path],
+                       "sourcesContent": [source],
+                       "names": [],
+                       "mappings": mappings}, sort_keys=True)
+
+class MinifyCache(object):
+    """Minified modules and their source map mappings, keyed on a hash of
+    the module's bytes. Entries are kept in memory, and under `cache_dir`
+    when it is given, so modules that did not change since the last build
+    are not minified again."""
+    def __init__(self, cache_dir=None, transform=minify_js,
+                 version=MINIFY_VERSION):
+        self.cache_dir = cache_dir
+        self.transform = transform
+        self.version = version
+        self.entries = {}
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, data):
+        key = hashlib.sha256(self.version)
+        key.update("\0" + self.transform.__name__)
+        key.update("\0" + data)
+        return key.hexdigest()
+
+    def _store(self, path, data):
+        # like apirenderer.RenderCache._store
+        tmp_path = path + ".tmp"
+        open(tmp_path, "wb").write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def get(self, data):
+        """Return the minified bytes and the encoded source map mappings
+        for the UTF-8 bytes `data`, or None if they cannot be minified."""
+        key = self.key(data)
+        if key in self.entries:
+            return self.entries[key]
+        entry = None
+        path = self.cache_dir and os.path.join(self.cache_dir, key + ".json")
+        if path and os.path.exists(path):
+            cached = json.loads(open(path, "rb").read().decode("utf-8"))
+            if cached is not None:
+                entry = (cached[0].encode("utf-8"), cached[1])
+        else:
+            try:
+                minified, mappings = self.transform(data.decode("utf-8"))
+                entry = (minified.encode("utf-8"), encode_mappings(mappings))
+            except (UnicodeDecodeError, TokenizeError):
+                pass
+            if path:
+                cached = entry and [entry[0].decode("utf-8"), entry[1]]
+                self._store(path, json.dumps(cached))
+        self.entries[key] = entry
+        return entry
+
+class MinifiedModule:
+    def __init__(self, path, data, source_map):
+        self.path = path # like "api-utils/lib/loader.js"
+        self.data = data
+        self.source_map = source_map
+
+def minify_modules(manifest, cache, stdout=None):
+    """Minify the modules of a ManifestBuilder, update their jsSHA256 to
+    describe the minified bytes, and return a dict that maps the filename
+    of each one that could be minified to a MinifiedModule. Prints how many
+    bytes that saved for each package."""
+    minified = {}
+    sizes = {} # package name -> [modules, bytes before, bytes after]
+    for me in sorted(manifest.get_module_entries(),
+                     key=lambda me: me.get_path()):
+        filename = me.js_filename
+        if filename not in minified:
+            original = open(filename, "rb").read()
+            entry = cache.get(original)
+            if entry is None:
+                minified[filename] = None
+            else:
+                data, mappings = entry
+                source_map = make_source_map(me.get_path(),
+                                             original.decode("utf-8"),
+                                             mappings)
+                minified[filename] = MinifiedModule(me.get_path(), data,
+                                                    source_map)
+                counts = sizes.setdefault(me.packageName, [0, 0, 0])
+                counts[0] += 1
+                counts[1] += len(original)
+                counts[2] += len(data)
+        if minified[filename] is not None:
+            me.js_hash = hashlib.sha256(minified[filename].data).hexdigest()
+    if stdout and sizes:
+        total_before = total_after = 0
+        for package in sorted(sizes):
+            modules, before, after = sizes[package]
+            total_before += before
+            total_after += after
+            print >>stdout, ("  %s: %d modules, %d -> %d bytes"
+                             % (package, modules, before, after))
+        print >>stdout, ("Minified modules: %d -> %d bytes (saved %d)"
+                         % (total_before, total_after,
+                            total_before - total_after))
+    return dict([(filename, module) for (filename, module)
+                 in minified.items() if module is not None])
+
+def write_source_maps(minified, maps_dir):
+    # one map for each module, at its path in the XPI plus ".map"
+    for module in minified.values():
+        path = os.path.join(maps_dir, "resources",
+                            *module.path.split("/")) + ".map"
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "wb").write(module.source_map)
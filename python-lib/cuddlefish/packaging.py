@@ -7,7 +7,7 @@ import sys
 import re
 import copy
 
-import simplejson as json
+from cuddlefish import json_backend as json
 from cuddlefish.bunch import Bunch
 
 MANIFEST_NAME = 'package.json'
@@ -279,11 +279,41 @@ def get_deps_for_targets(pkg_cfg, targets):
 
     return visited
 
+class Locale(dict):
+    """
+    The translations for one language, merged from the .properties files of
+    every package that has some. Later packages win when two of them
+    translate the same key.
+
+    `sources` lists the SHA-256 of each of those files in merge order, which
+    is enough to tell whether two Locale objects hold the same translations
+    without comparing them.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.sources = []
+        self.packages = {} # maps each key to the package it came from
+
+    def merge(self, pairs, pairs_hash, package):
+        """Add the `pairs` parsed from a file of `package` in place, and
+        return the (key, previous package) of every key that `package`
+        translates differently from an earlier one."""
+        collisions = []
+        for key, value in pairs.iteritems():
+            if key in self and self[key] != value:
+                collisions.append((key, self.packages[key]))
+            self[key] = value
+            self.packages[key] = package
+        self.sources.append(pairs_hash)
+        return sorted(collisions)
+
 def generate_build_for_target(pkg_cfg, target, deps,
                               include_tests=True,
                               include_dep_tests=False,
                               is_running_tests=False,
-                              default_loader=DEFAULT_LOADER):
+                              default_loader=DEFAULT_LOADER,
+                              stderr=sys.stderr):
 
     build = Bunch(# Contains section directories for all packages:
                   packages=Bunch(),
@@ -328,9 +358,10 @@ def generate_build_for_target(pkg_cfg, target, deps,
             if os.path.isfile(fullpath) and filename.endswith('.properties'):
                 language = filename[:-len('.properties')]
 
-                from property_parser import parse_file, MalformedLocaleFileError
+                from property_parser import parse_file_with_hash, \
+                                            MalformedLocaleFileError
                 try:
-                    content = parse_file(fullpath)
+                    content, content_hash = parse_file_with_hash(fullpath)
                 except MalformedLocaleFileError, msg:
                     print msg[0]
                     sys.exit(1)
@@ -339,12 +370,15 @@ def generate_build_for_target(pkg_cfg, target, deps,
                 # Locale files only contains one big JSON object
                 # that act as an hastable of:
                 # "keys to translate" => "translated keys"
-                if language in build.locale:
-                    merge = (build.locale[language].items() +
-                             content.items())
-                    build.locale[language] = Bunch(merge)
-                else:
-                    build.locale[language] = content
+                if language not in build.locale:
+                    build.locale[language] = Locale()
+                collisions = build.locale[language].merge(content,
+                                                          content_hash,
+                                                          cfg.name)
+                for (key, previous) in collisions:
+                    print >>stderr, ("Warning: package '%s' overrides the %s "
+                                     "translation of '%s' from package '%s'"
+                                     % (cfg.name, language, key, previous))
 
     def add_dep_to_build(dep):
         dep_cfg = pkg_cfg.packages[dep]
@@ -4,7 +4,7 @@
 
 import os, sys
 import base64
-import simplejson as json
+from cuddlefish import json_backend as json
 
 def create_jid():
     """Return 'jid1-XYZ', where 'XYZ' is a randomly-generated string. (in the
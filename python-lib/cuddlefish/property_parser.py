@@ -3,22 +3,49 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import re
-import codecs
+import hashlib
 
 class MalformedLocaleFileError(Exception):
     pass
 
+# maps the SHA-256 of a .properties file to what parse() made of it, so
+# that building several add-ons in one process (like 'cfx testall' does)
+# only parses each file once
+_parsed_files = {}
+
 def parse_file(path):
-    return parse(read_file(path), path)
+    return parse_file_with_hash(path)[0]
 
-def read_file(path):
+def parse_file_with_hash(path):
+    """Parse the .properties file at `path`, and return the pairs along with
+    the SHA-256 of the file's contents."""
+    data = open(path, "rb").read()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest not in _parsed_files:
+        _parsed_files[digest] = parse(decode_lines(data, path), path)
+    return copy_pairs(_parsed_files[digest]), digest
+
+def copy_pairs(pairs):
+    # the cached pairs must survive whatever callers do to theirs, including
+    # the dicts that hold plural forms
+    result = {}
+    for key, value in pairs.iteritems():
+        if isinstance(value, dict):
+            value = value.copy()
+        result[key] = value
+    return result
+
+def decode_lines(data, path=None):
     try:
-        return codecs.open( path, "r", "utf-8" ).readlines()
+        return data.decode("utf-8").splitlines(True)
     except UnicodeDecodeError, e:
         raise MalformedLocaleFileError(
           'Following locale file is not a valid ' +
           'UTF-8 file: %s\n%s"' % (path, str(e)))
 
+def read_file(path):
+    return decode_lines(open(path, "rb").read(), path)
+
 COMMENT = re.compile(r'\s*#')
 EMPTY = re.compile(r'^\s+$')
 KEYVALUE = re.compile(r"\s*([^=:]+)(=|:)\s*(.*)")
@@ -9,9 +9,14 @@ import tempfile
 import atexit
 import shlex
 import subprocess
+import tarfile
 import re
+import hashlib
+import ConfigParser
 
 import mozrunner
+from cuddlefish import json_backend as json
+from cuddlefish import memreport
 from cuddlefish.prefs import DEFAULT_COMMON_PREFS
 from cuddlefish.prefs import DEFAULT_FIREFOX_PREFS
 from cuddlefish.prefs import DEFAULT_THUNDERBIRD_PREFS
@@ -71,6 +76,121 @@ def follow_file(filename):
                 f.close()
         yield newstuff
 
+class TestResultStream:
+    """The results that the test harness writes to the resultStreamFile of
+    harness-options.json while it runs, one JSON object per line:
+
+      {"action": "test-start", "test": NAME}
+      {"action": "test-end", "test": NAME, "passed": N, "failed": N,
+       "errors": [REASON, ...], "messages": [MESSAGE, ...],
+       "duration": MILLISECONDS}
+
+    and, for `cfx bench`:
+
+      {"action": "bench-start", "bench": NAME}
+      {"action": "bench-end", "bench": NAME, "iterations": N,
+       "samples": [MILLISECONDS PER CALL, ...]}
+      {"action": "bench-end", "bench": NAME, "error": MESSAGE}
+
+    With --profile-memory, test-end entries also have the "memory" in use
+    "before" and "after" the test, and there are entries like
+
+      {"action": "memory", "iteration": N, "usage": {...}}
+
+    before the first run of the tests and after each one (see
+    memory.getUsage() in api-utils).
+
+    read() returns the entries written since it was last called."""
+    def __init__(self, filename):
+        self.tail = follow_file(filename)
+        self.partial = ""
+        self.running = None
+        self.results = []
+        self.benchmarks = []
+        self.memory = []
+
+    def read(self):
+        new_chars = self.tail.next()
+        if not new_chars:
+            return []
+        # the last line may not have been written completely yet
+        lines = (self.partial + new_chars).split("\n")
+        self.partial = lines.pop()
+        entries = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("action") == "test-start":
+                self.running = entry["test"]
+            elif entry.get("action") == "test-end":
+                self.running = None
+                self.results.append(entry)
+            elif entry.get("action") == "bench-start":
+                self.running = entry["bench"]
+            elif entry.get("action") == "bench-end":
+                self.running = None
+                self.benchmarks.append(entry)
+            elif entry.get("action") == "memory":
+                self.memory.append(entry)
+            entries.append(entry)
+        return entries
+
+def get_timing_summary(results, slowest=5):
+    """Return lines that tell how long the tests in `results` (test-end
+    entries) took."""
+    if not results:
+        return []
+    total = sum([entry["duration"] for entry in results])
+    lines = ["Test timings: %d tests, %.2fs total, %.3fs mean" %
+             (len(results), total / 1000.0, total / 1000.0 / len(results))]
+    by_duration = sorted(results, key=lambda entry: -entry["duration"])
+    for entry in by_duration[:slowest]:
+        lines.append("  %8.3fs  %s" % (entry["duration"] / 1000.0,
+                                       entry["test"]))
+    return lines
+
+def make_junit_xml(suites):
+    """Return a JUnit XML report of `suites`, a list of (name, results)
+    pairs, where results are test-end entries of a TestResultStream."""
+    from xml.sax.saxutils import escape, quoteattr
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<testsuites>']
+    for (name, results) in suites:
+        failures = len([entry for entry in results if entry["failed"]])
+        total = sum([entry["duration"] for entry in results]) / 1000.0
+        lines.append('  <testsuite name=%s tests="%d" failures="%d" '
+                     'errors="0" time="%.3f">' %
+                     (quoteattr(name), len(results), failures, total))
+        for entry in results:
+            # "test-foo.testBar" is the test testBar of the module test-foo
+            classname, dot, testname = entry["test"].rpartition(".")
+            attrs = ('classname=%s name=%s time="%.3f"' %
+                     (quoteattr(classname or name), quoteattr(testname),
+                      entry["duration"] / 1000.0))
+            if not entry["failed"]:
+                lines.append('    <testcase %s/>' % attrs)
+                continue
+            lines.append('    <testcase %s>' % attrs)
+            lines.append('      <failure message=%s>%s</failure>' %
+                         (quoteattr(", ".join(entry["errors"])),
+                          escape("\n".join(entry["messages"]))))
+            lines.append('    </testcase>')
+        lines.append('  </testsuite>')
+    lines.append('</testsuites>')
+    return "\n".join(lines).encode("utf-8") + "\n"
+
+# The suites of each --junit-xml report written by this process, so that
+# `cfx testall`, which runs each package separately, reports them all.
+junit_suites = {}
+
+def add_junit_suite(path, name, results):
+    suites = junit_suites.setdefault(path, [])
+    suites.append((name, results))
+    f = open(path, "w")
+    f.write(make_junit_xml(suites))
+    f.close()
+
 # subprocess.check_output only appeared in python2.7, so this code is taken
 # from python source code for compatibility with py2.5/2.6
 class CalledProcessError(Exception):
@@ -95,6 +215,138 @@ def check_output(*popenargs, **kwargs):
     return output
 
 
+BINARY_CACHE_FILENAME = ".binary-cache.json"
+ADDON_STORE_DIRNAME = ".addon-store"
+
+def get_application_ini_path(binary):
+    """Return the path of the application.ini that goes with `binary`, or
+    None if there is none. Newer Firefox builds keep it in a browser/
+    subdirectory."""
+    dirname = os.path.dirname(os.path.realpath(binary))
+    if dirname.endswith("/Contents/MacOS"):
+        dirname = os.path.join(os.path.dirname(dirname), "Resources")
+    for path in [os.path.join(dirname, "application.ini"),
+                 os.path.join(dirname, "browser", "application.ini")]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def get_application_ini(binary):
+    """Return the sections of the application.ini of `binary` as a dict of
+    dicts, or None."""
+    path = get_application_ini_path(binary)
+    if not path:
+        return None
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str # keep the case of the keys
+    try:
+        config.read(path)
+    except ConfigParser.Error:
+        return None
+    return dict([(section, dict(config.items(section)))
+                 for section in config.sections()])
+
+def get_version_output(info):
+    # `firefox -v` prints nothing on Windows, where it is a GUI program
+    output = info["version_output"]
+    app = (info["application_ini"] or {}).get("App", {})
+    if not output.strip() and app.get("Name") and app.get("Version"):
+        output = "Mozilla %s %s" % (app["Name"], app["Version"])
+    return output
+
+class BinaryInfoCache:
+    """What run_app learns about application binaries, kept in one JSON
+    file so the next run doesn't have to learn it again: where the binary
+    for each kind of runner was found, and what each binary said its
+    version was, along with its application.ini.
+
+    Version information is stored per binary, and only reused while the
+    binary and its application.ini keep the same size and modification
+    time. Found binaries are reused while they exist and the directories
+    that were searched are unchanged."""
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {"binaries": {}, "found": {}}
+        if path and os.path.exists(path):
+            try:
+                data = json.load(open(path, "r"))
+                if isinstance(data, dict):
+                    self.data.update(data)
+            except (ValueError, EnvironmentError):
+                pass
+
+    def save(self):
+        if not self.path:
+            return
+        # write to a temporary file first, so that an interrupted run, or
+        # another one running at the same time, never leaves a partial file
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            f = open(tmp_path, "w")
+            json.dump(self.data, f, indent=1, sort_keys=True)
+            f.close()
+            if os.path.exists(self.path) and sys.platform == "win32":
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except EnvironmentError:
+            pass
+
+    def get_stamp(self, binary):
+        stamp = []
+        paths = [os.path.realpath(binary)]
+        app_ini = get_application_ini_path(binary)
+        if app_ini:
+            paths.append(app_ini)
+        for path in paths:
+            st = os.stat(path)
+            stamp.append("%s:%r:%d" % (path, st.st_mtime, st.st_size))
+        return " ".join(stamp)
+
+    def get_info(self, binary, probe):
+        """Return a dict with the 'version_output' and 'application_ini' of
+        `binary`, calling probe() for its version output only when the
+        binary has changed since it was last asked."""
+        path = os.path.realpath(binary)
+        stamp = self.get_stamp(binary)
+        info = self.data["binaries"].get(path)
+        if info and info.get("stamp") == stamp:
+            return info
+        info = {"stamp": stamp,
+                "version_output": probe(),
+                "application_ini": get_application_ini(binary)}
+        self.data["binaries"][path] = info
+        self.save()
+        return info
+
+    def get_search_key(self, runner_class):
+        search = [runner_class.__name__, sys.platform,
+                  os.path.expanduser("~"), os.environ.get("PATH", "")]
+        return hashlib.sha1("\0".join(search)).hexdigest()
+
+    def get_search_stamp(self):
+        # a new binary in one of the searched directories changes its mtime
+        stamp = []
+        for dirname in os.environ.get("PATH", "").split(os.pathsep):
+            if os.path.isdir(dirname):
+                stamp.append("%s:%r" % (dirname, os.stat(dirname).st_mtime))
+        return " ".join(stamp)
+
+    def get_found_binary(self, runner_class):
+        """Return the binary that was found for `runner_class` last time,
+        if it is still there and nothing else could have been found instead,
+        or None."""
+        found = self.data["found"].get(self.get_search_key(runner_class))
+        if (found and found["stamp"] == self.get_search_stamp() and
+            os.path.isfile(found["binary"])):
+            return found["binary"]
+        return None
+
+    def set_found_binary(self, runner_class, binary):
+        self.data["found"][self.get_search_key(runner_class)] = {
+            "stamp": self.get_search_stamp(),
+            "binary": binary}
+        self.save()
+
 class FennecProfile(mozrunner.Profile):
     preferences = {}
     names = ['fennec']
@@ -124,6 +376,88 @@ class FennecRunner(mozrunner.Runner):
         return self.__real_binary
 
 
+class AdbShell(object):
+    """A single `adb shell` process that runs device commands one after
+    another, so that each of them costs a round trip instead of a new adb
+    process and connection.
+
+    Each command is framed by two markers that it echoes, the second one
+    followed by the command's exit status. The markers are written with an
+    empty "" inside them, so that the terminal echo of the command line,
+    which adb gives on devices that run the shell in a pty, never matches.
+    Commands run in a subshell with no input, so that they can't read the
+    next ones. If the session dies, commands fall back to one `adb shell`
+    process each."""
+
+    _MARKER = '__cfx""_%s_%d__'
+
+    def __init__(self, adb_path):
+        self.adb_path = adb_path
+        self.process = None
+        self.count = 0
+        self.failed = False
+
+    def _start(self):
+        self.process = subprocess.Popen([self.adb_path, "shell"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+
+    def _runOnce(self, command):
+        p = subprocess.Popen([self.adb_path, "shell", command],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return None, p.communicate()[0].replace("\r\n", "\n")
+
+    def run(self, command):
+        """Run the shell `command` on the device, and return its exit status
+        (None when it is not known) and its output."""
+        if self.failed:
+            return self._runOnce(command)
+        if self.process is None:
+            self._start()
+        self.count += 1
+        start = (self._MARKER % ("start", self.count)).replace('""', "")
+        end = re.compile(re.escape((self._MARKER % ("end", self.count))
+                                   .replace('""', "")) + r"(\d+)")
+        try:
+            self.process.stdin.write(
+                "echo %s; ( %s ) </dev/null; echo %s$?\n" %
+                (self._MARKER % ("start", self.count), command,
+                 self._MARKER % ("end", self.count)))
+            self.process.stdin.flush()
+            lines = None
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    raise IOError("adb shell session ended")
+                line = line.rstrip("\r\n")
+                if lines is None:
+                    # what comes before is the echo of earlier input
+                    if line.endswith(start):
+                        lines = []
+                    continue
+                mo = end.search(line)
+                if mo:
+                    if mo.start():
+                        lines.append(line[:mo.start()])
+                    return int(mo.group(1)), "".join([line + "\n"
+                                                      for line in lines])
+                lines.append(line)
+        except (IOError, OSError):
+            self.close()
+            self.failed = True
+            return self._runOnce(command)
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+            self.process = None
+
+
 class RemoteFennecRunner(mozrunner.Runner):
     profile_class = FennecProfile
 
@@ -151,11 +485,12 @@ class RemoteFennecRunner(mozrunner.Runner):
         mobile_app_name = kwargs['cmdargs'][0]
         self.profile = kwargs['profile']
         self._adb_path = binary
+        # every device command of this run goes through it
+        self._shell = AdbShell(binary)
 
         # This pref has to be set to `false` otherwise, we do not receive
         # output of adb commands!
-        subprocess.call([self._adb_path, "shell",
-                        "setprop log.redirect-stdio false"])
+        self._adbShell("setprop log.redirect-stdio false")
 
         # Android apps are launched by their "intent" name,
         # Automatically detect already installed firefox by using `pm` program
@@ -187,8 +522,7 @@ class RemoteFennecRunner(mozrunner.Runner):
         pid = self.getProcessPID(self._intent_name)
         if pid != None:
             print "Killing running Firefox instance ..."
-            subprocess.call([self._adb_path, "shell",
-                             "am force-stop " + self._intent_name])
+            self._adbShell("am force-stop " + self._intent_name)
             time.sleep(2)
             if self.getProcessPID(self._intent_name) != None:
                 raise Exception("Unable to automatically kill running Firefox" +
@@ -196,37 +530,61 @@ class RemoteFennecRunner(mozrunner.Runner):
                                 "executing cfx.")
 
         print "Pushing the addon to your device"
+        self.pushProfile(self.profile.profile, self._REMOTE_PATH)
+
+    # printed by the shell command that unpacks the profile, if it did
+    _EXTRACTED_MARKER = "cfx-profile-extracted"
+
+    def _adbShell(self, command):
+        return self._shell.run(command)[1]
+
+    def _adbPush(self, localPath, remotePath):
+        subprocess.Popen([self._adb_path, "push", localPath, remotePath],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+
+    def pushProfile(self, localDir, remoteDir):
+        """Replace `remoteDir` on the device with a copy of the profile in
+        `localDir`. The profile goes as one tar archive, which a single
+        shell command unpacks, so that the number of adb calls does not
+        grow with the number of files. Devices without `tar` get the whole
+        directory pushed at once instead, and then the empty directories in
+        it, which `adb push` skips, in one more shell command."""
+        fd, archive = tempfile.mkstemp(suffix=".tar")
+        os.close(fd)
+        try:
+            tar = tarfile.open(archive, "w", dereference=True)
+            tar.add(localDir, arcname=".")
+            tar.close()
+            remoteArchive = remoteDir + ".tar"
+            self._adbPush(archive, remoteArchive)
+        finally:
+            os.remove(archive)
+        output = self._adbShell(
+            "rm -r %(dir)s; mkdir %(dir)s && cd %(dir)s && "
+            "tar -xf %(archive)s && echo %(marker)s; rm %(archive)s" %
+            {"dir": remoteDir, "archive": remoteArchive,
+             "marker": self._EXTRACTED_MARKER})
+        if self._EXTRACTED_MARKER in output:
+            return
 
-        # Create a clean empty profile on the sd card
-        subprocess.call([self._adb_path, "shell", "rm -r " + self._REMOTE_PATH])
-        subprocess.call([self._adb_path, "shell", "mkdir " + self._REMOTE_PATH])
-
-        # Push the profile folder created by mozrunner to the device
-        # (we can't simply use `adb push` as it doesn't copy empty folders)
-        localDir = self.profile.profile
-        remoteDir = self._REMOTE_PATH
-        for root, dirs, files in os.walk(localDir, followlinks='true'):
-            relRoot = os.path.relpath(root, localDir)
-            # Note about os.path usage below:
-            # Local files may be using Windows `\` separators but
-            # remote are always `/`, so we need to convert local ones to `/`
-            for file in files:
-                localFile = os.path.join(root, file)
-                remoteFile = remoteDir.replace("/", os.sep)
-                if relRoot != ".":
-                    remoteFile = os.path.join(remoteFile, relRoot)
-                remoteFile = os.path.join(remoteFile, file)
-                remoteFile = "/".join(remoteFile.split(os.sep))
-                subprocess.Popen([self._adb_path, "push", localFile, remoteFile],
-                                 stderr=subprocess.PIPE).wait()
-            for dir in dirs:
-                targetDir = remoteDir.replace("/", os.sep)
-                if relRoot != ".":
-                    targetDir = os.path.join(targetDir, relRoot)
-                targetDir = os.path.join(targetDir, dir)
-                targetDir = "/".join(targetDir.split(os.sep))
-                # `-p` option is not supported on all devices!
-                subprocess.call([self._adb_path, "shell", "mkdir " + targetDir])
+        self._adbPush(localDir, remoteDir)
+        # Local paths may be using Windows `\` separators but remote ones
+        # are always `/`. `mkdir -p` is not supported on all devices, so
+        # parents are made before their children.
+        emptyDirs = []
+        hasFiles = set()
+        for root, dirs, files in os.walk(localDir, topdown=False,
+                                         followlinks=True):
+            if files or [dir for dir in dirs
+                         if os.path.join(root, dir) in hasFiles]:
+                hasFiles.add(root)
+            elif root != localDir:
+                relDir = os.path.relpath(root, localDir)
+                emptyDirs.append("/".join([remoteDir] + relDir.split(os.sep)))
+        if emptyDirs:
+            self._adbShell("; ".join(["mkdir " + dir
+                                      for dir in sorted(emptyDirs)]))
 
     @property
     def command(self):
@@ -240,26 +598,26 @@ class RemoteFennecRunner(mozrunner.Runner):
         ]
 
     def start(self):
-        subprocess.call(self.command)
+        sys.stdout.write(self._adbShell(self.command[2]))
+
+    def closeShell(self):
+        """End the adb shell session, once the application is started."""
+        self._shell.close()
 
     def getProcessPID(self, processName):
-        p = subprocess.Popen([self._adb_path, "shell", "ps"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        line = p.stdout.readline()
-        while line:
+        for line in self._adbShell("ps").splitlines():
             columns = line.split()
+            if len(columns) < 2:
+                continue
             pid = columns[1]
             name = columns[-1]
-            line = p.stdout.readline()
             if processName in name:
                 return pid
         return None
 
     def getIntentNames(self):
-        p = subprocess.Popen([self._adb_path, "shell", "pm list packages"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         names = []
-        for line in p.stdout.readlines():
+        for line in self._adbShell("pm list packages").splitlines():
             line = re.sub("(^package:)|\s", "", line)
             if self._INTENT_PREFIX in line:
                 names.append(line.replace(self._INTENT_PREFIX, ""))
@@ -374,16 +732,38 @@ class XulrunnerAppRunner(mozrunner.Runner):
                 self.names = runner.names
         return self.__real_binary
 
+def get_addon_store(store_dir, addons):
+    # the same --addons get installed run after run, so XPIs are unpacked
+    # once into the store, and linked into each profile from there. Runs
+    # without XPIs, or where store_dir cannot be written, go without one.
+    if not store_dir or not [addon for addon in addons
+                             if addon.endswith(".xpi")]:
+        return None
+    try:
+        return mozrunner.AddonStore(store_dir)
+    except EnvironmentError:
+        return None
+
 def run_app(harness_root_dir, manifest_rdf, harness_options,
             app_type, binary=None, profiledir=None, verbose=False,
             enforce_timeouts=False,
             logfile=None, addons=None, args=None, extra_environment={},
             norun=None,
             used_files=None, enable_mobile=False,
-            mobile_app_name=None):
+            mobile_app_name=None, binary_cache=None, addon_store=None,
+            stop_on_error=False, junit_xml=None, bench_results=None,
+            memory_report=None, memory_baseline=None, memory_threshold=10.0):
     if binary:
         binary = os.path.expanduser(binary)
 
+    # read the baseline now, rather than find out it's missing after the run
+    baseline_suites = None
+    if memory_baseline:
+        if not os.path.exists(memory_baseline):
+            raise ValueError("There is no memory report at %s."
+                             % memory_baseline)
+        baseline_suites = memreport.load_report(memory_baseline)
+
     if addons is None:
         addons = []
     else:
@@ -443,6 +823,14 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
         fileno,resultfile = tempfile.mkstemp(prefix="harness-result-")
         os.close(fileno)
         harness_options['resultFile'] = resultfile
+        # the results of each test, as they happen
+        fileno,streamfile = tempfile.mkstemp(prefix="harness-results-")
+        os.close(fileno)
+        harness_options['resultStreamFile'] = streamfile
+        def maybe_remove_streamfile():
+            if os.path.exists(streamfile):
+                os.remove(streamfile)
+        atexit.register(maybe_remove_streamfile)
 
     def maybe_remove_logfile():
         if os.path.exists(logfile):
@@ -484,7 +872,6 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
               xpi_path=xpi_path,
               harness_options=harness_options,
               limit_to=used_files)
-    addons.append(xpi_path)
 
     starttime = last_output_time = time.time()
 
@@ -512,20 +899,34 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
         addon_dir = os.path.join(mydir, "mobile-utils")
         addons.append(addon_dir)
 
-    # the XPI file is copied into the profile here
+    store = get_addon_store(addon_store, addons)
     profile = profile_class(addons=addons,
                             profile=profiledir,
-                            preferences=preferences)
+                            preferences=preferences,
+                            addon_store=store)
+    # the XPI file is copied into the profile here
+    profile.install_addon(xpi_path)
 
     # Delete the temporary xpi file
     os.remove(xpi_path)
 
+    # looking for the binary, and asking it for its version, is only done
+    # again when something has changed
+    binary_info = BinaryInfoCache(binary_cache)
+    search_binary = not binary and app_type != "fennec-on-device"
+    if search_binary:
+        binary = binary_info.get_found_binary(runner_class)
+        search_binary = binary is None
+
     runner = runner_class(profile=profile,
                           binary=binary,
                           env=env,
                           cmdargs=cmdargs,
                           kp_kwargs=popen_kwargs)
 
+    if search_binary:
+        binary_info.set_found_binary(runner_class, runner.binary)
+
     sys.stdout.flush(); sys.stderr.flush()
 
     if app_type == "fennec-on-device":
@@ -544,6 +945,7 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
 
         # Launch adb command
         runner.start()
+        runner.closeShell()
 
         # We can immediatly remove temporary profile folder
         # as it has been uploaded to the device
@@ -586,7 +988,9 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
     # Ensure cfx is being used with Firefox 4.0+.
     # TODO: instead of dying when Firefox is < 4, warn when Firefox is outside
     # the minVersion/maxVersion boundaries.
-    version_output = check_output(runner.command + ["-v"])
+    info = binary_info.get_info(runner.binary,
+                                lambda: check_output(runner.command + ["-v"]))
+    version_output = get_version_output(info)
     # Note: this regex doesn't handle all valid versions in the Toolkit Version
     # Format <https://developer.mozilla.org/en/Toolkit_version_format>, just the
     # common subset that we expect Mozilla apps to use.
@@ -649,8 +1053,10 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
 
     runner.start()
 
+    results = TestResultStream(streamfile)
     done = False
     result = None
+    stopped_on_error = None
     try:
         while not done:
             time.sleep(0.05)
@@ -661,6 +1067,19 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
                         last_output_time = time.time()
                         sys.stderr.write(new_chars)
                         sys.stderr.flush()
+            for entry in results.read():
+                if not stop_on_error:
+                    continue
+                if entry["action"] == "test-end" and entry["failed"]:
+                    stopped_on_error = entry["test"]
+                elif entry["action"] == "bench-end" and "error" in entry:
+                    stopped_on_error = entry["bench"]
+                if stopped_on_error:
+                    # no need to wait for the harness to wind down
+                    result = 'FAIL'
+                    done = True
+            if done:
+                break
             if os.path.exists(resultfile):
                 result = open(resultfile).read()
                 if result:
@@ -670,23 +1089,68 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
                         sys.stderr.write("Hrm, resultfile (%s) contained something weird (%d bytes)\n" % (resultfile, len(result)))
                         sys.stderr.write("'"+result+"'\n")
             if enforce_timeouts:
+                running = ""
+                if results.running:
+                    running = " Running test: %s" % results.running
                 if time.time() - last_output_time > OUTPUT_TIMEOUT:
-                    raise Exception("Test output exceeded timeout (%ds)." %
-                                    OUTPUT_TIMEOUT)
+                    raise Exception("Test output exceeded timeout (%ds).%s" %
+                                    (OUTPUT_TIMEOUT, running))
                 if time.time() - starttime > RUN_TIMEOUT:
-                    raise Exception("Test run exceeded timeout (%ds)." %
-                                    RUN_TIMEOUT)
+                    raise Exception("Test run exceeded timeout (%ds).%s" %
+                                    (RUN_TIMEOUT, running))
     except:
         runner.stop()
         raise
     else:
-        runner.wait(10)
+        if stopped_on_error:
+            print >>sys.stderr, ("\nStopping: %s failed and --stop-on-error "
+                                 "was specified." % stopped_on_error)
+            runner.stop()
+        else:
+            runner.wait(10)
+        teardown_time = runner.process_handler.teardown_time
+        if teardown_time is not None:
+            print >>sys.stderr, ("The application did not exit within 10 "
+                                 "seconds; stopping it took %.2f seconds." %
+                                 teardown_time)
     finally:
         outf.close()
         if profile:
             profile.cleanup()
 
     print >>sys.stderr, "Total time: %f seconds" % (time.time() - starttime)
+    if verbose:
+        for line in get_timing_summary(results.results):
+            print >>sys.stderr, line
+    if junit_xml:
+        add_junit_suite(junit_xml, harness_options.get("name", "tests"),
+                        results.results)
+    if bench_results is not None:
+        bench_results.extend(results.benchmarks)
+    if results.memory:
+        name = harness_options.get("name", "tests")
+        report = memreport.build_report(results.results, results.memory)
+        for line in memreport.get_summary(report):
+            print >>sys.stderr, line
+        if memory_report:
+            memreport.add_report_suite(memory_report, name, report)
+            print >>sys.stderr, ("Wrote the memory report to %s and %s." %
+                                 (memory_report,
+                                  memreport.get_html_path(memory_report)))
+        if baseline_suites is not None:
+            if name not in baseline_suites:
+                print >>sys.stderr, ("%s has no report of %s to compare "
+                                     "with." % (memory_baseline, name))
+            else:
+                regressions = memreport.compare(report,
+                                                baseline_suites[name],
+                                                memory_threshold)
+                if regressions:
+                    print >>sys.stderr, ("Memory use got worse than in %s:" %
+                                         memory_baseline)
+                    for regression in regressions:
+                        print >>sys.stderr, "  " + regression
+                    result = 'FAIL'
 
     if result == 'OK':
         print >>sys.stderr, "Program terminated successfully."
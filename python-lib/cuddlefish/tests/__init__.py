@@ -3,12 +3,24 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import shutil
 import unittest
 import doctest
 import glob
 
 env_root = os.environ['CUDDLEFISH_ROOT']
 
+def make_basedir(testcase):
+    """Return the absolute path of .test_tmp/<id of testcase>, a directory
+    that starts out empty each time this is called."""
+    basedir = os.path.abspath(os.path.join(".test_tmp", testcase.id()))
+    if os.path.isdir(basedir):
+        here = os.path.abspath(os.getcwd())
+        assert basedir.startswith(here) # safety
+        shutil.rmtree(basedir)
+    os.makedirs(basedir)
+    return basedir
+
 def get_tests():
     import cuddlefish
     import cuddlefish.tests
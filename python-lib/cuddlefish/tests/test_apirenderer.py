@@ -5,7 +5,9 @@
 
 import os
 import unittest
-from cuddlefish.docs.apirenderer import md_to_html
+from cuddlefish.docs import apiparser
+from cuddlefish.docs.apirenderer import md_to_html, md_to_div, RenderCache
+from cuddlefish.tests import make_basedir
 
 tests_path = os.path.abspath(os.path.dirname(__file__))
 static_files_path = os.path.join(tests_path, "static-files")
@@ -27,5 +29,52 @@ class ParserTests(unittest.TestCase):
                              "line %d: expected '%s', got '%s'"
                              % (x+1, reference_lines[x], test_lines[x]))
 
+class RenderCacheTests(unittest.TestCase):
+    def pathname(self, filename):
+        return os.path.join(static_files_path, "docs", filename)
+
+    def test_cached_div_matches(self):
+        cache = RenderCache(os.path.join(make_basedir(self), "cache"))
+        md_path = self.pathname("APIsample.md")
+        expected = md_to_div(md_path)
+        self.assertEqual(md_to_div(md_path, cache), expected)
+        # the second time around, nothing should be parsed at all
+        original_parse_hunks = apiparser.parse_hunks
+        def fail(text):
+            raise AssertionError("parse_hunks called for a cached file")
+        apiparser.parse_hunks = fail
+        try:
+            self.assertEqual(md_to_div(md_path, cache), expected)
+            # a fresh cache object reads the entries back from disk
+            cache = RenderCache(cache.cache_dir)
+            self.assertEqual(md_to_div(md_path, cache), expected)
+        finally:
+            apiparser.parse_hunks = original_parse_hunks
+
+    def test_version_invalidates(self):
+        cache = RenderCache(os.path.join(make_basedir(self), "cache"))
+        contents = open(self.pathname("APIsample.md")).read().decode('utf8')
+        hunks = cache.get_hunks(contents)
+        self.assertEqual(list(hunks[0]), ["version", apiparser.VERSION])
+        original_version = apiparser.VERSION
+        apiparser.VERSION = original_version + 1
+        try:
+            hunks = cache.get_hunks(contents)
+            self.assertEqual(list(hunks[0]), ["version", original_version + 1])
+        finally:
+            apiparser.VERSION = original_version
+
+    def test_renderer_invalidates(self):
+        cache = RenderCache(os.path.join(make_basedir(self), "cache"))
+        md_path = self.pathname("APIsample.md")
+        div = md_to_div(md_path, cache)
+        self.assertEqual(len(os.listdir(cache.cache_dir)), 2)
+        self.assertEqual(RenderCache(cache.cache_dir).renderer_hash,
+                         cache.renderer_hash)
+        # a changed renderer renders the DIV again from the cached hunks
+        cache.renderer_hash = "changed"
+        self.assertEqual(md_to_div(md_path, cache), div)
+        self.assertEqual(len(os.listdir(cache.cache_dir)), 3)
+
 if __name__ == "__main__":
     unittest.main()
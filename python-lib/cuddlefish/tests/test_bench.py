@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+from StringIO import StringIO
+
+from cuddlefish import bench
+from cuddlefish.tests import make_basedir
+
+def entry(name, samples):
+    return {"action": "bench-end", "bench": name, "iterations": 100,
+            "samples": samples}
+
+class BenchTests(unittest.TestCase):
+    def test_stats(self):
+        samples = range(1, 21)
+        self.assertEqual(bench.percentile(samples, 95), 19)
+        self.assertEqual(bench.percentile(samples, 100), 20)
+        self.assertEqual(bench.percentile([5], 95), 5)
+        stats = bench.get_stats(entry("a", [4, 1, 3, 2]))
+        self.assertEqual(stats, {"mean": 2.5, "median": 2.5, "p95": 4,
+                                 "iterations": 100, "samples": 4})
+        self.assertEqual(bench.get_stats(entry("a", [3, 1, 2]))["median"], 2)
+        self.assertEqual([bench.format_time(ms) for ms in
+                          [2500, 1.5, 0.0125, 0.0000254]],
+                         ["2.500s", "1.500ms", "12.500us", "25.4ns"])
+
+    def test_compare(self):
+        stats = {"a": {"median": 1.2}, "b": {"median": 0.5},
+                 "c": {"median": 1.0}}
+        baseline = {"a": {"median": 1.0}, "b": {"median": 1.0}}
+        changes, regressions = bench.compare(stats, baseline, 10)
+        self.assertEqual(sorted(changes), ["a", "b"])
+        self.assertAlmostEqual(changes["a"], 20.0)
+        self.assertAlmostEqual(changes["b"], -50.0)
+        self.assertEqual(regressions, ["a"])
+        self.assertEqual(bench.compare(stats, baseline, 25)[1], [])
+
+    def test_baseline(self):
+        path = os.path.join(make_basedir(self), "baseline.json")
+        self.assertEqual(bench.load_baseline(path), {})
+        out = StringIO()
+        rc = bench.report_benchmarks([entry("a", [1.0]), entry("b", [2.0]),
+                                      {"bench": "c", "error": "boom"}],
+                                     path, save=True, stdout=out)
+        self.assertEqual(rc, 0)
+        self.assertEqual(sorted(bench.load_baseline(path)), ["a", "b"])
+        # benchmarks that did not run keep their baseline
+        out = StringIO()
+        rc = bench.report_benchmarks([entry("a", [1.5])], path, stdout=out)
+        self.assertEqual(rc, 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1], "  a: median 1.500ms, mean 1.500ms, "
+                         "p95 1.500ms (1 x 100), +50.0% vs baseline "
+                         "REGRESSION")
+        self.assertEqual(lines[-1], "1 of 1 benchmarks are more than 10% "
+                         "slower than the baseline.")
+        self.assertEqual(bench.report_benchmarks([entry("a", [1.5])], path,
+                                                 save=True), 0)
+        baseline = bench.load_baseline(path)
+        self.assertEqual(baseline["a"]["median"], 1.5)
+        self.assertEqual(baseline["b"]["median"], 2.0)
+
+        open(path, "w").write('{"version": 99, "benchmarks": {}}')
+        self.assertRaises(ValueError, bench.load_baseline, path)
+
+if __name__ == "__main__":
+    unittest.main()
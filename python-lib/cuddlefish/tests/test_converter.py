@@ -0,0 +1,46 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+import unittest
+import markdown
+
+from cuddlefish.docs import converter
+from cuddlefish.tests import env_root
+
+def get_guide_docs():
+    return converter.read_docs(os.path.join(env_root, "doc",
+                                            "dev-guide-source"))
+
+class ConverterTests(unittest.TestCase):
+    def test_reused_converter_matches(self):
+        docs = get_guide_docs()
+        self.assertTrue(docs)
+        for text in docs:
+            self.assertEqual(converter.convert(text), markdown.markdown(text))
+        # references from one document must not leak into the next
+        first = converter.convert(u"[a link][1]\n\n[1]: http://example.com/\n")
+        self.assertTrue('href="http://example.com/"' in first)
+        second = converter.convert(u"[a link][1]\n")
+        self.assertEqual(second, markdown.markdown(u"[a link][1]\n"))
+
+    def test_pool(self):
+        docs = get_guide_docs()
+        expected = [markdown.markdown(text) for text in docs]
+        pool = converter.MarkdownPool()
+        results = {}
+        def work(n):
+            results[n] = [pool.convert(text) for text in docs]
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for n in range(4):
+            self.assertEqual(results[n], expected)
+        self.assertTrue(1 <= len(pool.idle) <= 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+import simplejson
+
+from cuddlefish import json_backend
+from cuddlefish.tests import env_root
+
+SAMPLES = [
+    {"utf8 bytes": "caf\xc3\xa9"},
+    {u"b": u"caf\xe9", "c": u"\x00\x1f\x7f\"\\"},
+    {"numbers": [0, -1, 3L, 1.5, 1e100, 0.1], "nested": {"x": [{}, []]}},
+    {2: "int key", "z": None, "y": True, "x": False},
+    [],
+    u"just a string",
+    ]
+
+class Backend(unittest.TestCase):
+    def check_same(self, obj, **kwargs):
+        expected = simplejson.dumps(obj, **kwargs)
+        got = json_backend.dumps(obj, **kwargs)
+        self.failUnlessEqual(type(got), type(expected))
+        self.failUnlessEqual(got, expected)
+        self.failUnlessEqual(json_backend.loads(got), simplejson.loads(got))
+
+    def test_same_output(self):
+        # these are the options that build_xpi and preflight use
+        options = [{}, {"indent": 1, "sort_keys": True},
+                   {"indent": 1, "sort_keys": True, "ensure_ascii": False},
+                   {"indent": 4}]
+        for sample in SAMPLES + [json_backend.make_manifest(200)]:
+            for kwargs in options:
+                self.check_same(sample, **kwargs)
+
+    def test_package_json(self):
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(env_root,
+                                                                 "packages")):
+            if "package.json" in filenames:
+                data = open(os.path.join(dirpath, "package.json")).read()
+                parsed = json_backend.loads(data)
+                self.failUnlessEqual(parsed, simplejson.loads(data))
+                self.check_same(parsed, indent=1, sort_keys=True)
+                count += 1
+        self.failUnless(count >= 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+from StringIO import StringIO
+
+from cuddlefish import l10n, packaging
+from cuddlefish.tests import env_root
+
+PLURAL_RULES = os.path.join(env_root, "packages", "api-utils", "lib",
+                            "l10n", "plural-rules.js")
+
+def make_locale(pairs):
+    locale = packaging.Locale()
+    locale.merge(pairs, "hash", "pkg")
+    return locale
+
+class L10nTests(unittest.TestCase):
+    def test_plural_rules(self):
+        forms = l10n.parse_plural_rules(PLURAL_RULES)
+        self.assertEqual(forms["en"], set(["one", "other"]))
+        self.assertEqual(forms["ja"], set(["other"]))
+        self.assertEqual(forms["ar"], set(["zero", "one", "two", "few",
+                                           "many", "other"]))
+        self.assertEqual(l10n.get_used_plural_forms("fr-FR", forms),
+                         set(["zero", "one", "two", "other"]))
+        self.assertEqual(l10n.get_used_plural_forms("xx", forms),
+                         set(["zero", "one", "two", "other"]))
+        self.assertTrue("few" in l10n.get_used_plural_forms("ru", forms))
+
+    def test_strip(self):
+        forms = l10n.parse_plural_rules(PLURAL_RULES)
+        pairs = {u"used": u"oui",
+                 u"unused": u"non",
+                 u"count": {u"one": u"1", u"few": u"f", u"other": u"n"}}
+        locales = {"fr-FR": make_locale(pairs), "ru": make_locale(pairs)}
+        stdout = StringIO()
+        l10n.strip_locales(locales, set([u"used", u"count"]), forms, stdout)
+        self.assertEqual(locales["fr-FR"],
+                         {u"used": u"oui",
+                          u"count": {u"one": u"1", u"other": u"n"}})
+        self.assertEqual(locales["ru"],
+                         {u"used": u"oui",
+                          u"count": {u"one": u"1", u"few": u"f",
+                                     u"other": u"n"}})
+        self.assertEqual(pairs[u"count"][u"few"], u"f")
+        report = stdout.getvalue()
+        self.assertTrue("fr-FR: 2 of 3 keys kept" in report)
+        self.assertTrue(report.startswith("  fr-FR:"))
+        self.assertTrue("Stripped locales:" in report)
+        # stripped locales don't share packaged JSON with unstripped ones
+        self.assertNotEqual(locales["fr-FR"].sources, ["hash"])
+        self.assertNotEqual(locales["fr-FR"].sources, locales["ru"].sources)
+
+if __name__ == "__main__":
+    unittest.main()
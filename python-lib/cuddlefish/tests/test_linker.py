@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os.path
+import sys
 import shutil
 import zipfile
 from StringIO import StringIO
@@ -94,6 +95,70 @@ class Basic(unittest.TestCase):
         reqs = m["five/lib/main.js"]["requirements"]
         self.failUnlessEqual(reqs, {});
 
+    def test_compact_manifest(self):
+        target_cfg = self.get_pkg("one")
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-kit"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps, scan_tests=False)
+        full = m.get_harness_options_manifest()
+        # main.js requires both "./two" and "two.js"
+        self.failUnlessEqual(full["one/lib/two.js"]["moduleName"], "two")
+        compact = m.get_harness_options_manifest(compact=True)
+        self.failUnlessEqual(compact["format"], 2)
+        strings = compact["strings"]
+        self.failUnlessEqual(strings, sorted(set(strings)))
+        self.failUnlessEqual(len(compact["modules"]), len(full))
+        # it survives a trip through harness-options.json
+        compact = json.loads(json.dumps(compact))
+        expanded = manifest.expand_manifest(compact)
+        self.failUnlessEqual(sorted(expanded.keys()), sorted(full.keys()))
+        for path, entry in full.items():
+            for key in ("requirements", "jsSHA256", "docsSHA256"):
+                self.failUnlessEqual(expanded[path][key], entry[key])
+        reqs = expanded["one/lib/main.js"]["requirements"]
+        self.failUnlessEqual(reqs["./two"]["path"], "one/lib/two.js")
+        self.failUnlessEqual(reqs["panel"]["path"], "addon-kit/lib/panel.js")
+
+        bare = m.get_harness_options_manifest(compact=True,
+                                              include_hashes=False)
+        self.failIf("jsSHA256" in bare or "docsSHA256" in bare)
+        self.failUnlessEqual(bare["modules"], compact["modules"])
+        expanded = manifest.expand_manifest(bare)
+        self.failUnlessEqual(expanded["one/lib/main.js"]["jsSHA256"], None)
+        self.failUnlessEqual(expanded["one/lib/main.js"]["requirements"],
+                             full["one/lib/main.js"]["requirements"])
+        self.failUnless(len(json.dumps(compact)) < len(json.dumps(full)))
+
+    def test_load_order(self):
+        target_cfg = self.get_pkg("one")
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-kit"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps, scan_tests=False)
+        order = m.get_load_order("one/lib/main.js")
+        groups = order["loadOrder"]
+        paths = [path for group in groups for path in group]
+        self.failUnlessEqual(sorted(paths),
+                             sorted(m.get_harness_options_manifest().keys()))
+        # main, two and subdir/three require each other
+        cycle = ["one/lib/main.js", "one/lib/subdir/three.js",
+                 "one/lib/two.js"]
+        self.failUnlessEqual(groups[-1], cycle)
+        self.failUnless(["addon-kit/lib/panel.js"] in groups)
+        # everything else comes after what it requires
+        full = m.get_harness_options_manifest()
+        position = dict([(path, i) for (i, group) in enumerate(groups)
+                         for path in group])
+        for path, entry in full.items():
+            for req in entry["requirements"].values():
+                if req["path"] in position:
+                    self.failUnless(position[req["path"]] <= position[path],
+                                    (path, req["path"]))
+        self.failUnlessEqual(order["preload"], paths)
+        self.failUnlessEqual([me.get_path()
+                              for me in m.get_module_load_order()], paths)
+
     def test_unreachable_relative_main_in_top(self):
         target_cfg = self.get_pkg("six")
         package_path = []
@@ -229,6 +294,25 @@ class Contents(unittest.TestCase):
                             in names, names)
         self.run_in_subdir("x", _test)
 
+    def test_strip_data_without_stripping(self):
+        seven = get_linker_files_dir("seven")
+        def _test(basedir):
+            shutil.copytree(seven, "seven")
+            os.chdir("seven")
+            old_stderr = sys.stderr
+            sys.stderr = stderr = StringIO()
+            try:
+                cuddlefish.run(["xpi", "--strip-data", "--no-strip-xpi"],
+                               stdout=StringIO())
+            except SystemExit, e:
+                self.failUnlessEqual(e.args[0], 1)
+            finally:
+                sys.stderr = old_stderr
+            self.assertIn("--strip-data cannot be combined with "
+                          "--no-strip-xpi", stderr.getvalue())
+            self.failIf(os.path.exists("seven.xpi"))
+        self.run_in_subdir("x", _test)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,9 +3,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import os
+import shutil
 import unittest
 from StringIO import StringIO
-from cuddlefish.manifest import scan_module
+from cuddlefish.manifest import scan_module, scan_l10n_keys, \
+                                scan_html_l10n_ids, scan_data_refs, \
+                                find_used_datafiles
 
 class Extra:
     def failUnlessKeysAre(self, d, keys):
@@ -147,6 +151,88 @@ class Require(unittest.TestCase, Extra):
         requires = self.scan(mod)
         self.failUnlessKeysAre(requires, ["bar", "me"])
 
+class L10n(unittest.TestCase):
+    def scan(self, text):
+        return scan_l10n_keys("fake.js", StringIO(text).readlines())
+
+    def test_keys(self):
+        mod = """const _ = require("l10n").get;
+        let a = _("hello"), b = _('single', 3);
+        let c = _( "esc\\"aped" ) + _("caf\xc3\xa9");
+        let d = foo._("method") + my_("suffix") + _(computed);
+        """
+        self.failUnlessEqual(self.scan(mod),
+                             set([u"hello", u"single", u'esc"aped',
+                                  u"caf\xe9"]))
+        self.failUnlessEqual(self.scan("let a = require('b');"), set())
+
+    def test_html_ids(self):
+        html = """<p data-l10n-id="title">t</p><b data-l10n-id = 'x'/>"""
+        self.failUnlessEqual(scan_html_l10n_ids(html),
+                             set([u"title", u"x"]))
+
+class DataRefs(unittest.TestCase):
+    def scan(self, text):
+        return scan_data_refs("fake.js", StringIO(text).readlines())
+
+    def test_scan(self):
+        mod = """const data = require("self").data;
+        panel({ contentURL: data.url("panel.html"),
+                contentScriptFile: [data.url('a.js'), self.data.url("b/c.js")]});
+        let text = data.load( "readme.txt" ), dir = data.url();
+        let other = mydata.url("nope");
+        """
+        self.failUnlessEqual(self.scan(mod),
+                             (set(["panel.html", "a.js", "b/c.js",
+                                   "readme.txt", ""]), False))
+        self.failUnlessEqual(self.scan("data.url('img/' + name)"),
+                             (set(), True))
+        self.failUnlessEqual(self.scan("let a = 1;"), (set(), False))
+
+    def make_datafiles(self, names):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            here = os.path.abspath(os.getcwd())
+            assert os.path.abspath(basedir).startswith(here) # safety
+            shutil.rmtree(basedir)
+        datafiles = {}
+        for (name, contents) in names.items():
+            path = os.path.join(basedir, *name.split("/"))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").write(contents)
+            datafiles[name] = path
+        return datafiles
+
+    def test_reachable(self):
+        datafiles = self.make_datafiles({
+            "panel.html": """<link href="css/panel.css" rel="stylesheet">
+                <script src='./panel.js'></script>
+                <a href="http://example.com/x.js">x</a>
+                <img src="/abs.png"><a href="#top">top</a>""",
+            "panel.js": "",
+            "css/panel.css": "body { background: url(../img/bg.png?1) }",
+            "img/bg.png": "",
+            "img/unused.png": "",
+            "abs.png": "",
+            "vendor/lib/a.js": "",
+            "vendor/lib/b.js": "",
+            "icons/1.png": "",
+            "unused.txt": "",
+            })
+        def used(refs, allowlist=[]):
+            paths = find_used_datafiles(datafiles, refs, allowlist)
+            return sorted([n for n in datafiles if datafiles[n] in paths])
+        self.failUnlessEqual(used(set(["panel.html"])),
+                             ["css/panel.css", "img/bg.png", "panel.html",
+                              "panel.js"])
+        self.failUnlessEqual(used(set(["vendor/", "missing.js"])),
+                             ["vendor/lib/a.js", "vendor/lib/b.js"])
+        self.failUnlessEqual(used(set(["./icons/../panel.js"]),
+                                  ["icons/*", "*.txt"]),
+                             ["icons/1.png", "panel.js", "unused.txt"])
+        self.failUnlessEqual(used(set([""])), sorted(datafiles))
+
 def scan2(text, fn="fake.js"):
     stderr = StringIO()
     lines = StringIO(text).readlines()
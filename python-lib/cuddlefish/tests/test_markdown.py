@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+import copy
+import markdown
+from markdown import inlinepatterns
+from markdown.odict import OrderedDict
+from markdown.extensions import codehilite
+
+from cuddlefish.tests import env_root, make_basedir
+
+# inline markup that exercises every built-in pattern, and the way they
+# interact with each other
+INLINE_SAMPLES = [
+    u"plain text with no markup at all",
+    u"`code *not emphasis*` and *emphasis `code`*",
+    u"\\*escaped\\* and \\`escaped\\` and ***strong em*** and ___too___",
+    u"**strong** __strong__ *em* _em_ snake_case_name a * b",
+    u"[link](http://example.com/ \"title\") and ![img](/a.png) and [ref][1]",
+    u"<http://example.com/> <me@example.com> <span>html</span> &amp; &copy;",
+    u"line one  \nline two  ",
+    u"[unknown ref][nope] and [[nested] brackets](url)",
+    u"[ref][1] and [Ref][]\n\n[1]: http://example.com/ \"Example\"\n",
+]
+
+def get_sdk_docs():
+    docs = []
+    for top in [os.path.join(env_root, "packages"),
+                os.path.join(env_root, "doc", "dev-guide-source")]:
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            for filename in sorted(filenames):
+                if filename.endswith(".md"):
+                    path = os.path.join(dirpath, filename)
+                    docs.append(open(path).read().decode('utf8'))
+    return docs
+
+class InlineTriggerTests(unittest.TestCase):
+    def make_reference_converter(self):
+        # without triggers, every pattern is tried on every piece of text,
+        # which is how the inline processor has always worked
+        saved = inlinepatterns.PATTERN_TRIGGERS.copy()
+        inlinepatterns.PATTERN_TRIGGERS.clear()
+        try:
+            md = markdown.Markdown()
+        finally:
+            inlinepatterns.PATTERN_TRIGGERS.update(saved)
+        for pattern in md.inlinePatterns.values():
+            self.assertEqual(pattern.triggers, None)
+        return md
+
+    def test_triggers(self):
+        md = markdown.Markdown()
+        for key, pattern in md.inlinePatterns.items():
+            self.assertTrue(pattern.triggers, key)
+            self.assertFalse(pattern.mayMatch(u"plain text"), key)
+        self.assertTrue(md.inlinePatterns["strong"].mayMatch(u"a __b__"))
+        self.assertFalse(md.inlinePatterns["strong"].mayMatch(u"a _b_"))
+
+    def test_sdk_docs_unchanged(self):
+        # the SDK's own docs are the golden corpus: skipping patterns must
+        # not change a single byte of the output
+        corpus = INLINE_SAMPLES + [u"\n\n".join(INLINE_SAMPLES)]
+        corpus += get_sdk_docs()
+        self.assertTrue(len(corpus) > 100)
+        md = markdown.Markdown()
+        reference = self.make_reference_converter()
+        for text in corpus:
+            expected = reference.convert(text)
+            reference.reset()
+            self.assertEqual(md.convert(text), expected)
+            md.reset()
+
+class OrderedDictTests(unittest.TestCase):
+    def check(self, d, keys):
+        self.assertEqual(d.keys(), keys)
+        self.assertEqual(list(d), keys)
+        self.assertEqual(list(d.iterkeys()), keys)
+        self.assertEqual(d.values(), [d[k] for k in keys])
+        self.assertEqual(list(d.itervalues()), [d[k] for k in keys])
+        self.assertEqual(d.items(), [(k, d[k]) for k in keys])
+        self.assertEqual(list(d.iteritems()), [(k, d[k]) for k in keys])
+        self.assertEqual(len(d), len(keys))
+        for i, k in enumerate(keys):
+            self.assertEqual(d.index(k), i)
+            self.assertEqual(d.value_for_index(i), d[k])
+
+    def test_insertion_order(self):
+        d = OrderedDict()
+        for k in "dbca":
+            d[k] = k.upper()
+        self.check(d, list("dbca"))
+        d["b"] = "new"
+        self.check(d, list("dbca"))
+        self.assertEqual(d["b"], "new")
+        del d["c"]
+        self.check(d, list("dba"))
+        self.assertEqual(d.pop("d"), "D")
+        self.assertEqual(d.pop("missing", None), None)
+        self.check(d, list("ba"))
+        self.assertEqual(d.setdefault("z", 1), 1)
+        self.assertEqual(d.setdefault("z", 2), 1)
+        self.check(d, list("baz"))
+        d.update({"q": 0})
+        self.check(d, list("bazq"))
+        self.assertEqual(repr(d), "{'b': 'new', 'a': 'A', 'z': 1, 'q': 0}")
+        d.clear()
+        self.check(d, [])
+        d = OrderedDict([("x", 1), ("y", 2), ("x", 3)])
+        self.check(d, ["x", "y"])
+        self.assertEqual(d["x"], 3)
+
+    def test_locations(self):
+        d = OrderedDict()
+        d["b"] = 1
+        d.add("a", 0, "_begin")
+        d.add("z", 9, "_end")
+        d.add("c", 2, ">b")
+        d.add("y", 8, "<z")
+        self.check(d, list("abcyz"))
+        self.assertEqual(d.index_for_location("_begin"), 0)
+        self.assertEqual(d.index_for_location("_end"), None)
+        self.assertEqual(d.index_for_location("<c"), 2)
+        self.assertEqual(d.index_for_location(">c"), 3)
+        # adding an existing key moves it, except when adding at the end
+        d.add("a", 10, ">c")
+        self.check(d, list("bcayz"))
+        self.assertEqual(d["a"], 10)
+        d.add("b", 11, "_end")
+        self.check(d, list("bcayz"))
+        self.assertEqual(d["b"], 11)
+        d.insert(0, "z", 12)
+        self.check(d, list("zbcay"))
+        d.insert(3, "b", 13)
+        self.check(d, list("zcbay"))
+        d.insert(100, "n", 14)
+        self.check(d, list("zcbayn"))
+        d.link("n", "_begin")
+        self.check(d, list("nzcbay"))
+        d.link("n", ">a")
+        self.check(d, list("zcbany"))
+        self.assertRaises(ValueError, d.add, "q", 0, "<missing")
+        self.assertRaises(ValueError, d.add, "q", 0, "nowhere")
+        self.assertRaises(ValueError, d.link, "n", ">missing")
+        self.check(d, list("zcbany"))
+        self.assertRaises(ValueError, d.index, "missing")
+
+    def test_copies(self):
+        d = OrderedDict()
+        for k in "cab":
+            d[k] = [k]
+        c = d.copy()
+        c["d"] = ["d"]
+        self.check(d, list("cab"))
+        self.check(c, list("cabd"))
+        self.assertTrue(c["a"] is d["a"])
+        deep = copy.deepcopy(d)
+        self.check(deep, list("cab"))
+        self.assertFalse(deep["a"] is d["a"])
+
+HILITE_DOC = u"""Some code:
+
+    :::js
+    var a = "<b>" && 1;
+
+More code:
+
+    #!python
+    def f():
+        return 1
+"""
+
+class HiliteCacheTests(unittest.TestCase):
+    def test_same_output(self):
+        cache_dir = os.path.join(make_basedir(self), "hilite")
+        expected = markdown.markdown(HILITE_DOC,
+                                     ["codehilite(use_cache=False)"])
+        self.assertTrue('<div class="codehilite">' in expected)
+        cached = ["codehilite(cache_dir=%s)" % cache_dir]
+        self.assertEqual(markdown.markdown(HILITE_DOC, cached), expected)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        # a hit must not run the highlighter again
+        original_hilite = codehilite.CodeHilite._hilite
+        def fail(self):
+            raise AssertionError("highlighted a cached block")
+        codehilite.CodeHilite._hilite = fail
+        try:
+            self.assertEqual(markdown.markdown(HILITE_DOC, cached), expected)
+            # and the files on disk work without the in-memory entries
+            del codehilite._caches[cache_dir]
+            self.assertEqual(markdown.markdown(HILITE_DOC, cached), expected)
+        finally:
+            codehilite.CodeHilite._hilite = original_hilite
+
+    def test_options_in_key(self):
+        cache = codehilite.HiliteCache()
+        plain = codehilite.CodeHilite(u"x = 1", cache=cache).hilite()
+        numbered = codehilite.CodeHilite(u"x = 1", linenos=True,
+                                         cache=cache).hilite()
+        self.assertNotEqual(plain, numbered)
+        self.assertEqual(numbered,
+                         codehilite.CodeHilite(u"x = 1", linenos=True).hilite())
+
+    def test_eviction(self):
+        cache_dir = os.path.join(make_basedir(self), "hilite")
+        cache = codehilite.HiliteCache(cache_dir, max_entries=3)
+        keys = []
+        for i in range(5):
+            key = cache.key(u"code %d" % i, "js", False, "codehilite")
+            cache.set(key, u"<pre>%d</pre>" % i)
+            keys.append(key)
+            # make sure each file gets a distinct modification time
+            path = os.path.join(cache_dir, key + ".html")
+            os.utime(path, (i * 10, i * 10))
+        self.assertEqual(cache.entries.keys(), keys[2:])
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         sorted([k + ".html" for k in keys[2:]]))
+        # the least recently used entry goes first
+        self.assertEqual(cache.get(keys[2]), u"<pre>2</pre>")
+        cache.set(cache.key(u"new", "js", False, "codehilite"), u"new")
+        self.assertEqual(cache.get(keys[3]), None)
+        self.assertEqual(cache.get(keys[2]), u"<pre>2</pre>")
+
+    def test_eviction_is_batched(self):
+        cache_dir = os.path.join(make_basedir(self), "hilite")
+        cache = codehilite.HiliteCache(cache_dir, max_entries=8)
+        listed = []
+        original_listdir = os.listdir
+        def listdir(path):
+            listed.append(path)
+            return original_listdir(path)
+        os.listdir = listdir
+        try:
+            for i in range(15):
+                key = cache.key(u"code %d" % i, "js", False, "codehilite")
+                cache.set(key, u"<pre>%d</pre>" % i)
+                os.utime(os.path.join(cache_dir, key + ".html"),
+                         (i * 10, i * 10))
+                # writing an entry again does not count as a new file
+                cache.set(key, u"<pre>%d</pre>" % i)
+        finally:
+            os.listdir = original_listdir
+        # counted once, then evicted down to 8 at the 11th and 14th files
+        self.assertEqual(len(listed), 3)
+        self.assertEqual(len(os.listdir(cache_dir)), 9)
+        self.assertEqual(cache.file_count, 9)
+
+if __name__ == "__main__":
+    unittest.main()
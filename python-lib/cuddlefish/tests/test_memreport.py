@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+
+from cuddlefish import memreport
+from cuddlefish.tests import make_basedir
+
+MB = 1024 * 1024
+
+def usage(explicit, tracked=0, bins=None):
+    return {"explicit": explicit, "resident": None, "trackedObjects": tracked,
+            "bins": bins or {}}
+
+def end_entry(name, before, after):
+    return {"action": "test-end", "test": name, "passed": 1, "failed": 0,
+            "memory": {"before": before, "after": after}}
+
+def sample(iteration, usage):
+    return {"action": "memory", "iteration": iteration, "usage": usage}
+
+def make_run(leak=0, tracked=0):
+    # three runs of two tests, where test-b leaves `leak` bytes and
+    # `tracked` tracked objects behind
+    results = []
+    samples = [sample(0, usage(100 * MB, 5, {"Loader": 5}))]
+    explicit = 100 * MB
+    objects = 5
+    for i in range(3):
+        results.append(end_entry("test-a.testA", usage(explicit, objects),
+                                 usage(explicit + 1000, objects)))
+        results.append(end_entry("test-b.testB", usage(explicit, objects),
+                                 usage(explicit + leak, objects + tracked)))
+        explicit += leak
+        objects += tracked
+        samples.append(sample(i + 1, usage(explicit, objects,
+                                           {"Loader": objects})))
+    return results, samples
+
+class MemoryReportTests(unittest.TestCase):
+    def test_build_report(self):
+        self.assertEqual(memreport.get_slope([1, 3, 5, 7]), 2)
+        self.assertEqual(memreport.get_slope([4]), 0)
+
+        report = memreport.build_report(*make_run())
+        self.assertEqual(report["suspects"], [])
+        self.assertEqual(report["tests"]["test-a.testA"],
+                         {"runs": 3, "median": {"explicit": 1000,
+                                                "trackedObjects": 0},
+                          "max": {"explicit": 1000, "trackedObjects": 0}})
+        self.assertEqual(report["trends"],
+                         {"explicit": 0, "trackedObjects": 0})
+        self.assertEqual(report["growingBins"], [])
+
+        results, samples = make_run(leak=2 * MB, tracked=1)
+        # samples may come in any order
+        samples.reverse()
+        report = memreport.build_report(results, samples)
+        self.assertEqual(report["suspects"],
+                         [{"test": "test-b.testB",
+                           "reasons": ["leaves tracked objects alive",
+                                       "leaves explicit memory allocated"]}])
+        self.assertEqual(report["trends"]["explicit"], 2 * MB)
+        self.assertEqual(report["growingBins"], ["Loader"])
+        self.assertEqual(memreport.get_summary(report), [
+            "Memory profile: 2 tests, 1 leak suspects",
+            "  test-b.testB leaves tracked objects alive and leaves "
+            "explicit memory allocated",
+            "  growth per run of the tests: explicit +2.0MB, "
+            "trackedObjects +1",
+            "  tracked Loader objects grow with every run"])
+
+    def test_compare(self):
+        baseline = memreport.build_report(*make_run(leak=512 * 1024))
+        self.assertEqual(memreport.compare(baseline, baseline), [])
+        # small changes are noise
+        report = memreport.build_report(*make_run(leak=600 * 1024))
+        self.assertEqual(memreport.compare(report, baseline), [])
+        report = memreport.build_report(*make_run(leak=MB, tracked=1))
+        self.assertEqual(memreport.compare(report, baseline), [
+            "test-b.testB leaves tracked objects alive and leaves explicit "
+            "memory allocated",
+            "test-b.testB: explicit grew by +1.0MB, was +512.0KB",
+            "test-b.testB: trackedObjects grew by +1, was +0",
+            "explicit grew by +1.0MB per run of the tests, was +512.0KB",
+            "trackedObjects grew by +1 per run of the tests, was +0",
+            "tracked Loader objects pile up from one run of the tests to "
+            "the next"])
+        self.assertEqual(len(memreport.compare(report, baseline, 150)), 4)
+        # tests that the baseline does not know about are not compared
+        self.assertEqual(len(memreport.compare(report, {})), 2)
+
+    def test_write_report(self):
+        path = os.path.join(make_basedir(self), "memory.json")
+        report = memreport.build_report(*make_run(leak=2 * MB))
+        report["tests"]["test-<c>.test&"] = {"runs": 1, "median": {},
+                                             "max": {}}
+        memreport.add_report_suite(path, "one", report)
+        memreport.add_report_suite(path, "two", report)
+        suites = memreport.load_report(path)
+        self.assertEqual(sorted(suites), ["one", "two"])
+        self.assertEqual(suites["one"]["suspects"], report["suspects"])
+        html = open(os.path.join(os.path.dirname(path),
+                                 "memory.html")).read()
+        self.assertEqual(html.count("<h1>"), 2)
+        self.assertTrue("<td>test-&lt;c&gt;.test&amp;</td>" in html)
+        self.assertTrue('<tr class="suspect"><td>test-b.testB</td><td>3</td>'
+                        '<td>+2.0MB</td><td></td><td>+0</td></tr>' in html,
+                        html)
+
+        open(path, "w").write('{"version": 99, "suites": {}}')
+        self.assertRaises(ValueError, memreport.load_report, path)
+
+        self.assertEqual(memreport.get_html_path("memory"), "memory.html")
+        path = os.path.join(os.path.dirname(path), "memory.html")
+        memreport.write_report(path, {"one": report})
+        self.assertEqual(sorted(memreport.load_report(path)), ["one"])
+        self.assertEqual(open(path + ".html").read().count("<h1>"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import hashlib
+import unittest
+from StringIO import StringIO
+
+from cuddlefish import minify, packaging, manifest
+from cuddlefish.tests import env_root, make_basedir
+
+SOURCE = u"""/* This Source Code Form is subject to the terms of the MPL */
+"use strict";
+
+/*! keep me */
+// a "line" comment
+const URL = "http://example.com/*not a comment*/"; // it's a string
+let re = /\\/\\/[/]x/g, a = b / c / d;
+function f(x, y) {
+  return x + +y - -1 .toFixed(2) /* gone */ + x++ + ++y;
+}
+if (a)
+  /* multi
+     line */ return
+    f(1, 2);
+exports.f = f;
+"""
+
+EXPECTED = u"""
+"use strict";
+
+/*! keep me */
+
+const URL="http://example.com/*not a comment*/";
+let re=/\\/\\/[/]x/g,a=b/c/d;
+function f(x,y){
+return x+ +y- -1 .toFixed(2)+x++ + ++y;
+}
+if(a)
+
+return
+f(1,2);
+exports.f=f;
+"""
+
+class MinifyTests(unittest.TestCase):
+    def test_minify(self):
+        minified, mappings = minify.minify_js(SOURCE)
+        self.assertEqual(minified, EXPECTED)
+        self.assertEqual(minified.count("\n"), SOURCE.count("\n"))
+        self.assertEqual(minify.minify_js(u"a\r\n\r\n  b")[0], u"a\n\nb")
+        # a "/" after the condition of an if statement starts a regex
+        self.assertEqual(minify.minify_js(u"if (ok)  /a   b/.test(s);")[0],
+                         u"if(ok)/a   b/.test(s);")
+        self.assertEqual(minify.minify_js(u"while (f(x) ) /a  b/g.exec(s)")[0],
+                         u"while(f(x))/a  b/g.exec(s)")
+        self.assertEqual(minify.minify_js(u"x = (a)  / b  / c;")[0],
+                         u"x=(a)/b/c;")
+        # every token maps back to where it was
+        source_lines = SOURCE.split("\n")
+        minified_lines = minified.split("\n")
+        self.assertEqual(len(mappings), 68)
+        for (line, column, orig_line, orig_column) in mappings:
+            self.assertEqual(line, orig_line)
+            self.assertEqual(minified_lines[line][column],
+                             source_lines[orig_line][orig_column])
+        self.assertRaises(minify.TokenizeError, minify.minify_js, u"'open")
+
+    def test_source_map(self):
+        self.assertEqual([minify.encode_vlq(n) for n in [0, 1, -1, 15, 16]],
+                         ["A", "C", "D", "e", "gB"])
+        minified, mappings = minify.minify_js(u"a  =\n  b;")
+        self.assertEqual(minified, u"a=\nb;")
+        self.assertEqual(minify.encode_mappings(mappings), "AAAA,CAAG;AACD,CAAC")
+
+    def test_cache(self):
+        calls = []
+        def transform(source):
+            calls.append(source)
+            return minify.minify_js(source)
+        cache_dir = os.path.join(make_basedir(self), "cache")
+        cache = minify.MinifyCache(cache_dir, transform)
+        data = SOURCE.encode("utf-8")
+        entry = cache.get(data)
+        self.assertEqual(entry[0], EXPECTED.encode("utf-8"))
+        self.assertEqual(cache.get(data), entry)
+        self.assertEqual(cache.get("'open"), None)
+        self.assertEqual(cache.get("'open"), None)
+        self.assertEqual(len(calls), 2)
+        # a new process finds them on disk
+        cache = minify.MinifyCache(cache_dir, transform)
+        self.assertEqual(cache.get(data), entry)
+        self.assertEqual(cache.get("'open"), None)
+        self.assertEqual(len(calls), 2)
+
+    def test_minify_modules(self):
+        target_cfg = packaging.get_config_in_dir(
+            os.path.join(env_root, "examples", "reading-data"))
+        pkg_cfg = packaging.build_config(env_root, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-kit"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps,
+                                    scan_tests=False)
+        stdout = StringIO()
+        minified = minify.minify_modules(m, minify.MinifyCache(), stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[-1].startswith("Minified modules: "))
+        self.assertTrue([line for line in lines
+                         if line.startswith("  reading-data: 1 modules, ")])
+        entries = m.get_harness_options_manifest()
+        main = m.get_manifest_entry("reading-data", "lib", "main")
+        module = minified[main.js_filename]
+        self.assertEqual(module.path, "reading-data/lib/main.js")
+        self.assertTrue(len(module.data) < os.path.getsize(main.js_filename))
+        self.assertEqual(entries[module.path]["jsSHA256"],
+                         hashlib.sha256(module.data).hexdigest())
+
+        maps_dir = os.path.join(make_basedir(self), "maps")
+        minify.write_source_maps(minified, maps_dir)
+        source_map = minify.json.load(open(os.path.join(
+            maps_dir, "resources", "reading-data", "lib", "main.js.map")))
+        self.assertEqual(source_map["sources"], ["reading-data/lib/main.js"])
+        self.assertEqual(source_map["sourcesContent"],
+                         [open(main.js_filename).read().decode("utf-8")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,8 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import unittest
 
+from cuddlefish import property_parser
 from cuddlefish.property_parser import parse, MalformedLocaleFileError
 
 class TestParser(unittest.TestCase):
@@ -89,5 +91,22 @@ class TestParser(unittest.TestCase):
         self.failUnlessRaises(MalformedLocaleFileError, parse,
                               ["   =only spaces in key"])
 
+    def test_parse_file_cache(self):
+        path = os.path.join(os.path.dirname(__file__), "linker-files",
+                            "three-deps", "three-c", "locale",
+                            "fr-FR.properties")
+        first, digest = property_parser.parse_file_with_hash(path)
+        self.assertEqual(len(digest), 64)
+        self.assertTrue(digest in property_parser._parsed_files)
+        self.assertEqual(first["uft8_value"], u"\u00e9")
+        # callers get their own copy, plural forms included
+        first["plural"]["one"] = "changed"
+        first["No"] = "changed"
+        second, second_digest = property_parser.parse_file_with_hash(path)
+        self.assertEqual(second_digest, digest)
+        self.assertEqual(second["No"], "Nein")
+        self.assertEqual(second["plural"], {"one": "one", "other": "other"})
+        self.assertEqual(property_parser.parse_file(path), second)
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,6 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import sys
+import time
+import signal
+import zipfile
+import subprocess
+import unittest
+from StringIO import StringIO
+
+from cuddlefish import runner, memreport
+from cuddlefish.tests import make_basedir
+import mozrunner
+from mozrunner import killableprocess, proctree
 
 def xulrunner_app_runner_doctests():
     """
@@ -25,3 +38,867 @@ def xulrunner_app_runner_doctests():
     """
 
     pass
+
+# Logs its arguments, and acts like adb with a device whose file system is
+# the local one. Shell commands find the fake device tools that
+# FakeDevice.make_tools() writes first in their PATH. The interactive shell
+# echoes its input, like the pty that adb gives it on older devices.
+FAKE_ADB = '''#!%(python)s
+import os, sys, shutil, subprocess, threading
+args = sys.argv[1:]
+def log(entry):
+    open(os.environ["FAKE_ADB_LOG"], "a").write(repr(entry) + "\\n")
+log(args)
+os.environ["PATH"] = os.environ["FAKE_ADB_TOOLS"] + os.pathsep + \\
+                     os.environ["PATH"]
+if not args:
+    print "Android Debug Bridge version 1.0.31"
+elif args[0] == "push":
+    local, remote = args[1:]
+    if os.path.isdir(local):
+        # like adb, copy files but not empty directories
+        for root, dirs, files in os.walk(local):
+            for name in files:
+                path = os.path.join(root, name)
+                dest = os.path.join(remote, os.path.relpath(path, local))
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                shutil.copyfile(path, dest)
+    else:
+        shutil.copyfile(local, remote)
+elif args == ["shell"]:
+    sh = subprocess.Popen(["sh"], stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lock = threading.Lock()
+    def write(data):
+        lock.acquire()
+        sys.stdout.write(data.replace("\\n", "\\r\\n"))
+        sys.stdout.flush()
+        lock.release()
+    def copy_output():
+        for line in iter(sh.stdout.readline, ""):
+            write(line)
+    thread = threading.Thread(target=copy_output)
+    thread.start()
+    for line in iter(sys.stdin.readline, ""):
+        log(["input", line])
+        write("$ " + line)
+        sh.stdin.write(line)
+        sh.stdin.flush()
+    sh.stdin.close()
+    thread.join()
+else:
+    p = subprocess.Popen(["sh", "-c", args[1]], stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    sys.stdout.write(p.communicate()[0])
+'''
+
+FAKE_TOOLS = {
+    "setprop": "",
+    "pm": "echo package:org.mozilla.firefox",
+    "ps": """echo "USER     PID   PPID  VSIZE  RSS     WCHAN    PC         NAME"
+if [ -f "$FAKE_DEVICE_STATE" ]; then
+  echo "app_45    4242  1234  222680 43972 ffffffff 00000000 S org.mozilla.firefox"
+fi""",
+    "am": """case "$1" in
+  start) touch "$FAKE_DEVICE_STATE"; echo "Starting: Intent { $* }";;
+  force-stop) rm -f "$FAKE_DEVICE_STATE";;
+esac""",
+    }
+
+class FakeDevice:
+    def __init__(self, basedir, without_tar=False):
+        self.adb = os.path.join(basedir, "adb")
+        open(self.adb, "w").write(FAKE_ADB % {"python": sys.executable})
+        os.chmod(self.adb, 0755)
+        self.tools = os.path.join(basedir, "tools")
+        self.log = os.path.join(basedir, "adb.log")
+        self.state = os.path.join(basedir, "firefox-running")
+        tools = dict(FAKE_TOOLS)
+        if without_tar:
+            tools["tar"] = "echo tar: not found; exit 127"
+        os.makedirs(self.tools)
+        for (name, script) in tools.items():
+            path = os.path.join(self.tools, name)
+            open(path, "w").write("#!/bin/sh\n" + script + "\n")
+            os.chmod(path, 0755)
+        self.environ = {"FAKE_ADB_LOG": self.log,
+                        "FAKE_ADB_TOOLS": self.tools,
+                        "FAKE_DEVICE_STATE": self.state}
+
+    def __enter__(self):
+        os.environ.update(self.environ)
+        return self
+
+    def __exit__(self, *exc_info):
+        for name in self.environ:
+            del os.environ[name]
+
+    def get_calls(self):
+        if not os.path.exists(self.log):
+            return []
+        return [eval(line) for line in open(self.log)]
+
+    def get_spawns(self):
+        # the adb processes that were started
+        return [call for call in self.get_calls() if call[:1] != ["input"]]
+
+class FakeProfile:
+    def __init__(self, profile):
+        self.profile = profile
+
+def list_tree(top):
+    tree = []
+    for root, dirs, files in os.walk(top):
+        for name in dirs:
+            tree.append((os.path.relpath(os.path.join(root, name), top), None))
+        for name in files:
+            path = os.path.join(root, name)
+            tree.append((os.path.relpath(path, top), open(path).read()))
+    return sorted(tree)
+
+class RemoteFennecTests(unittest.TestCase):
+    def make_runner(self, device, remote_dir, profile):
+        class Runner(runner.RemoteFennecRunner):
+            _REMOTE_PATH = remote_dir
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return Runner(binary=device.adb, cmdargs=[None],
+                          profile=FakeProfile(profile))
+        finally:
+            sys.stdout = stdout
+
+    def push(self, without_tar):
+        basedir = make_basedir(self)
+        profile = os.path.join(basedir, "profile")
+        for i in range(20):
+            subdir = os.path.join(profile, "dir%d" % (i % 4))
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+            open(os.path.join(subdir, "file%d" % i), "w").write(str(i))
+        open(os.path.join(profile, "prefs.js"), "w").write("prefs")
+        os.makedirs(os.path.join(profile, "empty", "deeper", "deepest"))
+        os.makedirs(os.path.join(profile, "dir1", "empty"))
+
+        sdcard = os.path.join(basedir, "sdcard")
+        remote_dir = os.path.join(sdcard, "jetpack-profile")
+        os.makedirs(remote_dir)
+        open(os.path.join(remote_dir, "stale"), "w").write("old profile")
+
+        device = FakeDevice(basedir, without_tar)
+        with device:
+            r = self.make_runner(device, remote_dir, profile)
+            r.closeShell()
+        self.assertEqual(list_tree(remote_dir), list_tree(profile))
+        self.assertEqual(os.listdir(sdcard), ["jetpack-profile"])
+        return device
+
+    def test_push_profile(self):
+        device = self.push(without_tar=False)
+        # checking adb, one shell session, and the archive
+        self.assertEqual([call[:1] for call in device.get_spawns()],
+                         [[], ["shell"], ["push"]])
+
+    def test_push_profile_without_tar(self):
+        device = self.push(without_tar=True)
+        self.assertEqual([call[:1] for call in device.get_spawns()],
+                         [[], ["shell"], ["push"], ["push"]])
+        mkdirs = [call[1] for call in device.get_calls()
+                  if call[:1] == ["input"]][-1]
+        self.assertEqual(mkdirs.count("mkdir"), 4)
+
+    def test_shell_session(self):
+        basedir = make_basedir(self)
+        with FakeDevice(basedir) as device:
+            shell = runner.AdbShell(device.adb)
+            self.assertEqual(shell.run("echo one; echo two"),
+                             (0, "one\ntwo\n"))
+            self.assertEqual(shell.run("ls /nonexistent >/dev/null 2>&1")[0],
+                             2)
+            self.assertEqual(shell.run("cd /; printf unterminated"),
+                             (0, "unterminated\n"))
+            # commands don't get to read the ones that follow
+            self.assertEqual(shell.run("cat"), (0, ""))
+            self.assertEqual(shell.run("exit 3"), (3, ""))
+            self.assertEqual(shell.run("pwd"),
+                             (0, os.path.abspath(os.getcwd()) + "\n"))
+            self.assertEqual(len(device.get_spawns()), 1)
+            # when the session dies, commands still run, one adb each
+            shell.process.kill()
+            shell.process.wait()
+            self.assertEqual(shell.run("echo three"), (None, "three\n"))
+            self.assertEqual(shell.run("echo four"), (None, "four\n"))
+            self.assertEqual(len(device.get_spawns()), 3)
+            shell.close()
+
+    def test_device_commands(self):
+        basedir = make_basedir(self)
+        profile = os.path.join(basedir, "profile")
+        os.makedirs(profile)
+        remote_dir = os.path.join(basedir, "sdcard", "jetpack-profile")
+        os.makedirs(os.path.dirname(remote_dir))
+        with FakeDevice(basedir) as device:
+            r = self.make_runner(device, remote_dir, profile)
+            self.assertEqual(r.getIntentNames(), ["firefox"])
+            self.assertEqual(r.getProcessPID("org.mozilla.firefox"), None)
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                r.start()
+                started = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertTrue(started.startswith("Starting: Intent"), started)
+            self.assertEqual(r.getProcessPID("org.mozilla.firefox"), "4242")
+            r.closeShell()
+            self.assertEqual(r._shell.process, None)
+            # everything went through the one session
+            self.assertEqual([call[:1] for call in device.get_spawns()],
+                             [[], ["shell"], ["push"]])
+
+class BinaryInfoTests(unittest.TestCase):
+    def test_version_info(self):
+        basedir = make_basedir(self)
+        app_dir = os.path.join(basedir, "firefox")
+        os.makedirs(os.path.join(app_dir, "browser"))
+        binary = os.path.join(app_dir, "firefox")
+        open(binary, "w").write("binary")
+        open(os.path.join(app_dir, "browser", "application.ini"), "w").write(
+            "[App]\nName=Firefox\nVersion=20.0\nBuildID=20130326150557\n")
+        cache_path = os.path.join(basedir, "binary-cache.json")
+        probes = []
+        def probe():
+            probes.append(binary)
+            return "Mozilla Firefox 20.0\n"
+
+        cache = runner.BinaryInfoCache(cache_path)
+        info = cache.get_info(binary, probe)
+        self.assertEqual(info["version_output"], "Mozilla Firefox 20.0\n")
+        self.assertEqual(info["application_ini"]["App"]["BuildID"],
+                         "20130326150557")
+        self.assertEqual(cache.get_info(binary, probe), info)
+        # the next run finds it on disk
+        cache = runner.BinaryInfoCache(cache_path)
+        self.assertEqual(cache.get_info(binary, probe), info)
+        self.assertEqual(len(probes), 1)
+        # an upgrade changes the binary
+        open(binary, "w").write("new binary")
+        cache.get_info(binary, probe)
+        self.assertEqual(len(probes), 2)
+
+        # on Windows, `firefox -v` prints nothing
+        info = {"version_output": "",
+                "application_ini": {"App": {"Name": "Firefox",
+                                            "Version": "20.0"}}}
+        self.assertEqual(runner.get_version_output(info),
+                         "Mozilla Firefox 20.0")
+        # a broken cache file is ignored
+        open(cache_path, "w").write("{")
+        cache = runner.BinaryInfoCache(cache_path)
+        cache.get_info(binary, probe)
+        self.assertEqual(len(probes), 3)
+
+    def test_found_binary(self):
+        basedir = make_basedir(self)
+        bin_dir = os.path.join(basedir, "bin")
+        os.makedirs(bin_dir)
+        binary = os.path.join(bin_dir, "firefox")
+        open(binary, "w").write("binary")
+        cache_path = os.path.join(basedir, "binary-cache.json")
+        path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir
+        try:
+            cache = runner.BinaryInfoCache(cache_path)
+            Runner = runner.mozrunner.FirefoxRunner
+            self.assertEqual(cache.get_found_binary(Runner), None)
+            cache.set_found_binary(Runner, binary)
+            cache = runner.BinaryInfoCache(cache_path)
+            self.assertEqual(cache.get_found_binary(Runner), binary)
+            self.assertEqual(cache.get_found_binary(runner.FennecRunner),
+                             None)
+            # something new in PATH might be found first
+            open(os.path.join(bin_dir, "firefox-bin"), "w").write("other")
+            os.utime(bin_dir, (0, 0))
+            self.assertEqual(cache.get_found_binary(Runner), None)
+            cache.set_found_binary(Runner, binary)
+            os.remove(binary)
+            self.assertEqual(cache.get_found_binary(Runner), None)
+        finally:
+            os.environ["PATH"] = path
+
+# Starts a child in its own session, and so its own process group, and a
+# grandchild, then sleeps.
+DUMMY_TREE = """
+import os, sys, time, subprocess
+detach = "import os, time; os.setsid(); time.sleep(60)"
+subprocess.Popen([sys.executable, "-c", detach])
+subprocess.Popen(["sh", "-c", "sleep 60; true"])
+time.sleep(float(sys.argv[1]))
+"""
+
+class ProcessTreeTests(unittest.TestCase):
+    def start_tree(self, duration):
+        p = killableprocess.runCommand([sys.executable, "-c", DUMMY_TREE,
+                                        str(duration)])
+        tree = proctree.ProcessTree(p.pid, pgid=p.pid)
+        # python, its two children, and the sleep
+        deadline = time.time() + 10
+        while len(tree.update()) < 4 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(tree.update()), 4)
+        return p, tree
+
+    def test_read_stat(self):
+        if not proctree.is_supported():
+            return # no /proc here
+        ppid, pgrp, state, starttime = proctree.read_stat(os.getpid())
+        self.assertEqual((ppid, pgrp), (os.getppid(), os.getpgrp()))
+        self.assertEqual(proctree.read_stat(2**22 + 1), None)
+
+    def test_kill_tree(self):
+        if not proctree.is_supported():
+            return # no /proc here
+        # looks like part of the tree to `ps ax | grep sleep`, but isn't
+        bystander = subprocess.Popen(["sleep", "60"])
+        try:
+            p, tree = self.start_tree(60)
+            pids = tree.update()
+            self.assertTrue(p.pid in pids)
+            self.assertFalse(bystander.pid in pids)
+            self.assertFalse(tree.wait(0.2))
+            # the detached child is still known once its parent is gone
+            os.kill(p.pid, signal.SIGKILL)
+            p.wait()
+            self.assertEqual(len(tree.update()), 3)
+            self.assertEqual(len(tree.kill()), 3)
+            self.assertTrue(tree.wait(10))
+            self.assertEqual(tree.update(), [])
+            self.assertEqual(bystander.poll(), None)
+        finally:
+            bystander.kill()
+            bystander.wait()
+
+    def test_wait_tree(self):
+        if not proctree.is_supported():
+            return # no /proc here
+        p, tree = self.start_tree(0.5)
+        # the root exits on its own, its children don't
+        deadline = time.time() + 10
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(tree.update()), 3)
+        self.assertFalse(tree.wait(0.2))
+        tree.kill(signal.SIGTERM)
+        self.assertTrue(tree.wait(10))
+
+IGNORE_SIGTERM = """
+import signal, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+print "ready"
+import sys; sys.stdout.flush()
+time.sleep(60)
+"""
+
+class KillableProcessTests(unittest.TestCase):
+    def run_python(self, code, **kwargs):
+        return killableprocess.runCommand([sys.executable, "-c", code],
+                                          **kwargs)
+
+    def test_wait(self):
+        if sys.platform == "win32":
+            return
+        for group in [True, False]:
+            p = self.run_python("import time; time.sleep(0.2)")
+            start = time.time()
+            self.assertEqual(p.wait(timeout=10, group=group), 0)
+            # no polling interval to wait out
+            self.assertTrue(time.time() - start < 0.45)
+            self.assertEqual(p.teardown_time, None)
+        p = self.run_python("import sys; sys.exit(3)")
+        self.assertEqual(p.wait(), 3)
+        self.assertEqual(p.wait(timeout=1), 3)
+
+    def test_wait_in_thread(self):
+        # only the main thread gets signals, others poll
+        if sys.platform == "win32":
+            return
+        import threading
+        p = self.run_python("import time; time.sleep(0.2)")
+        results = []
+        thread = threading.Thread(target=lambda:
+                                  results.append(p.wait(timeout=10)))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [0])
+
+    def test_timeout(self):
+        if sys.platform == "win32":
+            return
+        p = self.run_python("import time; time.sleep(60)")
+        start = time.time()
+        self.assertEqual(p.wait(timeout=0.3), -signal.SIGTERM)
+        self.assertTrue(0.3 <= time.time() - start < 2)
+        self.assertTrue(p.teardown_time < 1)
+
+    def test_timeout_escalation(self):
+        if sys.platform == "win32":
+            return
+        p = self.run_python(IGNORE_SIGTERM, stdout=subprocess.PIPE)
+        self.assertEqual(p.stdout.readline(), "ready\n")
+        p.terminate_grace = 0.3
+        start = time.time()
+        self.assertEqual(p.wait(timeout=0.3), -signal.SIGKILL)
+        self.assertTrue(0.6 <= time.time() - start < 2)
+        self.assertTrue(0.3 <= p.teardown_time < 1.5)
+
+    def test_timeout_kills_group(self):
+        if not proctree.is_supported():
+            return # no /proc here
+        p = killableprocess.runCommand([sys.executable, "-c", DUMMY_TREE,
+                                        "60"])
+        tree = proctree.ProcessTree(p.pid)
+        deadline = time.time() + 10
+        while len(tree.update()) < 4 and time.time() < deadline:
+            time.sleep(0.05)
+        p.wait(timeout=0.2)
+        # all but the child that left the group
+        self.assertEqual(len(tree.update()), 1)
+        tree.kill()
+        self.assertTrue(tree.wait(10))
+
+class UnpackAddonTests(unittest.TestCase):
+    def make_xpi(self, path):
+        zf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        def add(name, data, mode=None):
+            info = zipfile.ZipInfo(name)
+            if mode is not None:
+                info.external_attr = mode << 16
+            zf.writestr(info, data)
+        add("install.rdf", "<RDF/>", 0644)
+        add("empty/", "", 040755)
+        # no entries for the directories of these
+        for i in range(20):
+            add("resources/pkg%d/lib/module%d.js" % (i % 3, i),
+                "exports.n = %d;" % i, 0644)
+        add("bin/tool", "#!/bin/sh", 0755)
+        # zip files made on Windows have no Unix modes
+        add("nomode.txt", "readable")
+        # bigger than the copy buffer
+        add("data/big.bin", "".join([chr(i % 251) for i in
+                                     range(3 * mozrunner.UNPACK_BUFFER_SIZE
+                                           + 7)]), 0644)
+        zf.close()
+        return zipfile.ZipFile(path, "r")
+
+    def list_tree(self, root):
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, root)
+                if os.path.isdir(path):
+                    tree[relpath + "/"] = None
+                else:
+                    tree[relpath] = (open(path, "rb").read(),
+                                     os.stat(path).st_mode & 0777)
+        return tree
+
+    def test_unpack_addon(self):
+        basedir = make_basedir(self)
+        xpi = self.make_xpi(os.path.join(basedir, "addon.xpi"))
+        profile = mozrunner.Profile(profile=basedir)
+        profile.unpack_addon(xpi, os.path.join(basedir, "one"))
+        tree = self.list_tree(os.path.join(basedir, "one"))
+        for info in xpi.infolist():
+            if info.filename.endswith("/"):
+                self.assertEqual(tree[info.filename], None)
+            else:
+                self.assertEqual(tree[info.filename][0],
+                                 xpi.read(info.filename))
+        self.assertEqual(tree["bin/tool"][1], 0755)
+        self.assertEqual(tree["install.rdf"][1], 0644)
+        self.assertTrue(tree["nomode.txt"][1] & 0400)
+
+        profile.unpack_addon(xpi, os.path.join(basedir, "threads"), 4)
+        self.assertEqual(self.list_tree(os.path.join(basedir, "threads")),
+                         tree)
+
+    def test_unpack_error_in_thread(self):
+        basedir = make_basedir(self)
+        xpi = self.make_xpi(os.path.join(basedir, "addon.xpi"))
+        profile = mozrunner.Profile(profile=basedir)
+        addon_path = os.path.join(basedir, "addon")
+        # a file where a directory needs to be
+        open(addon_path, "w").write("")
+        self.assertRaises(EnvironmentError, profile.unpack_addon, xpi,
+                          addon_path, 4)
+
+INSTALL_RDF = """<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>%(id)s</em:id>
+    <em:version>1.0</em:version>
+    <em:name>Helper</em:name>
+    <em:unpack>%(unpack)s</em:unpack>
+  </Description>
+</RDF>
+"""
+
+class AddonStoreTests(unittest.TestCase):
+    def make_xpi(self, path, addon_id, unpack="true", data="data"):
+        zf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        zf.writestr("install.rdf", INSTALL_RDF % {"id": addon_id,
+                                                  "unpack": unpack})
+        zf.writestr("chrome/content/helper.js", data)
+        zf.close()
+        return path
+
+    def count_calls(self, module, name):
+        calls = []
+        original = getattr(module, name)
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return original(*args, **kwargs)
+        setattr(module, name, counted)
+        self.addCleanup(setattr, module, name, original)
+        return calls
+
+    def test_install_from_store(self):
+        basedir = make_basedir(self)
+        xpi = self.make_xpi(os.path.join(basedir, "helper.xpi"), "helper@x")
+        store = mozrunner.AddonStore(os.path.join(basedir, "store"))
+        details_calls = self.count_calls(mozrunner, "addon_details")
+        unpack_calls = self.count_calls(mozrunner, "unpack_xpi")
+        paths = []
+        for name in ["one", "two", "three"]:
+            mozrunner.Profile(profile=os.path.join(basedir, name),
+                              addons=[xpi], addon_store=store)
+            path = os.path.join(basedir, name, "extensions", "helper@x",
+                                "chrome", "content", "helper.js")
+            self.assertEqual(open(path).read(), "data")
+            paths.append(path)
+        self.assertEqual(len(details_calls), 1)
+        self.assertEqual(len(unpack_calls), 1)
+        if hasattr(os, "link"):
+            self.assertEqual(len(set([os.stat(path).st_ino
+                                      for path in paths])), 1)
+        # stored files are protected from whatever runs in a profile
+        self.assertFalse(os.stat(paths[0]).st_mode & 0222)
+        # a profile's copy can be replaced, and cleaned up
+        profile = mozrunner.Profile(profile=os.path.join(basedir, "one"),
+                                    addons=[xpi], addon_store=store)
+        profile.cleanup()
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+
+    def test_packed_addon(self):
+        basedir = make_basedir(self)
+        xpi = self.make_xpi(os.path.join(basedir, "helper.xpi"), "packed@x",
+                            unpack="false")
+        store = mozrunner.AddonStore(os.path.join(basedir, "store"))
+        profile_dir = os.path.join(basedir, "profile")
+        mozrunner.Profile(profile=profile_dir, addons=[xpi],
+                          addon_store=store)
+        self.assertEqual(os.listdir(os.path.join(profile_dir, "extensions")),
+                         ["packed@x.xpi"])
+        self.assertEqual(store.get(xpi)[1], None)
+
+    def test_keyed_on_content(self):
+        basedir = make_basedir(self)
+        xpi = os.path.join(basedir, "helper.xpi")
+        store_dir = os.path.join(basedir, "store")
+        store = mozrunner.AddonStore(store_dir, max_entries=2)
+        for data in ["one", "two", "three"]:
+            self.make_xpi(xpi, "helper@x", data=data)
+            details, tree = store.get(xpi)
+            self.assertEqual(details["id"], "helper@x")
+            self.assertEqual(open(os.path.join(tree, "chrome", "content",
+                                               "helper.js")).read(), data)
+        # the oldest one was evicted
+        self.assertEqual(len(os.listdir(store_dir)), 2)
+
+    def test_unwritable_store(self):
+        basedir = make_basedir(self)
+        xpi = self.make_xpi(os.path.join(basedir, "helper.xpi"), "helper@x")
+        self.assertEqual(runner.get_addon_store(
+            os.path.join(basedir, "store"), [basedir]), None)
+        self.assertFalse(os.path.exists(os.path.join(basedir, "store")))
+        # a file where the store's directory should be
+        not_a_dir = os.path.join(basedir, "file")
+        open(not_a_dir, "w").write("")
+        self.assertEqual(runner.get_addon_store(
+            os.path.join(not_a_dir, "store"), [xpi]), None)
+        store_dir = os.path.join(basedir, "store")
+        store = runner.get_addon_store(store_dir, [xpi])
+        os.rmdir(store_dir)
+        open(store_dir, "w").write("")
+        profile_dir = os.path.join(basedir, "profile")
+        mozrunner.Profile(profile=profile_dir, addons=[xpi],
+                          addon_store=store)
+        path = os.path.join(profile_dir, "extensions", "helper@x", "chrome",
+                            "content", "helper.js")
+        self.assertEqual(open(path).read(), "data")
+
+    def test_clone_without_links(self):
+        basedir = make_basedir(self)
+        xpi = self.make_xpi(os.path.join(basedir, "helper.xpi"), "helper@x")
+        store = mozrunner.AddonStore(os.path.join(basedir, "store"))
+        details, tree = store.get(xpi)
+        def link(src, dst):
+            raise OSError(18, "Invalid cross-device link")
+        if hasattr(os, "link"):
+            self.addCleanup(setattr, os, "link", os.link)
+        os.link = link
+        dest = os.path.join(basedir, "clone")
+        store.clone(tree, dest)
+        path = os.path.join(dest, "chrome", "content", "helper.js")
+        self.assertEqual(open(path).read(), "data")
+        self.assertTrue(os.stat(path).st_mode & 0200)
+
+# Stands in for Firefox running the test harness: writes the results of two
+# tests to the stream that cfx reads, then the final result. When the
+# second test fails, it hangs afterwards. For `cfx bench`, it reports the
+# benchmarks of each module instead, with the samples in FAKE_BENCH_SAMPLES.
+# With --profile-memory, it reports memory use too, and the second test
+# leaves FAKE_BROWSER_LEAK more bytes allocated every time it runs.
+FAKE_BROWSER = """#!PYTHON
+import os, sys, time, glob, json, zipfile
+args = sys.argv[1:]
+if "-v" in args:
+    print "Mozilla Firefox 20.0"
+    sys.exit(0)
+profile = args[args.index("-profile") + 1]
+addon = glob.glob(os.path.join(profile, "extensions", "*"))[0]
+if addon.endswith(".xpi"):
+    options = json.loads(zipfile.ZipFile(addon).read("harness-options.json"))
+else:
+    options = json.load(open(os.path.join(addon, "harness-options.json")))
+fail = int(os.environ.get("FAKE_BROWSER_FAIL", "0"))
+log = open(options["logFile"], "a")
+def report(entry):
+    f = open(options["resultStreamFile"], "a")
+    f.write(json.dumps(entry) + "\\n")
+    f.close()
+if options.get("benchmark"):
+    samples = json.loads(os.environ["FAKE_BENCH_SAMPLES"])
+    for module in options["allTestModules"]:
+        name = module + ".benchResolve"
+        report({"action": "bench-start", "bench": name})
+        report({"action": "bench-end", "bench": name, "iterations": 1000,
+                "samples": samples})
+        if fail:
+            report({"action": "bench-end", "bench": module + ".benchThrows",
+                    "error": "Error: boom"})
+    open(options["resultFile"], "w").write(fail and "FAIL" or "OK")
+    sys.exit(0)
+leak = int(os.environ.get("FAKE_BROWSER_LEAK", "0"))
+usage = {"explicit": 50000000, "resident": 80000000, "trackedObjects": 3,
+         "bins": {"Loader": 3}}
+if options.get("profileMemory"):
+    report({"action": "memory", "iteration": 0, "usage": usage})
+for iteration in range(options.get("iterations", 1)):
+    for (name, failed) in [("test-a.testOne", 0), ("test-a.testTwo", fail)]:
+        report({"action": "test-start", "test": name})
+        log.write("running %s\\n" % name)
+        log.flush()
+        entry = {"action": "test-end", "test": name, "passed": 1 - failed,
+                 "failed": failed, "errors": failed and ["failure"] or [],
+                 "messages": failed and ["1 < 2 & 3 > 2"] or [],
+                 "duration": 250}
+        if options.get("profileMemory"):
+            before = json.loads(json.dumps(usage))
+            if name.endswith("testTwo"):
+                usage["explicit"] += leak
+            entry["memory"] = {"before": before, "after": usage}
+        report(entry)
+    if options.get("profileMemory"):
+        report({"action": "memory", "iteration": iteration + 1,
+                "usage": usage})
+if fail:
+    time.sleep(60) # what is left of the run
+open(options["resultFile"], "w").write(fail and "FAIL" or "OK")
+"""
+
+class TestResultsTests(unittest.TestCase):
+    def test_stream(self):
+        path = os.path.join(make_basedir(self), "results")
+        stream = runner.TestResultStream(path)
+        self.assertEqual(stream.read(), [])
+        f = open(path, "w")
+        f.write('{"action": "test-start", "test": "a.b"}\n{"action": "te')
+        f.flush()
+        self.assertEqual(stream.read(),
+                         [{"action": "test-start", "test": "a.b"}])
+        self.assertEqual(stream.running, "a.b")
+        f.write('st-end", "test": "a.b", "failed": 0, "duration": 5}\n')
+        f.close()
+        self.assertEqual([entry["action"] for entry in stream.read()],
+                         ["test-end"])
+        self.assertEqual(stream.running, None)
+        self.assertEqual(len(stream.results), 1)
+
+    def test_junit_xml(self):
+        from xml.dom import minidom
+        results = [{"test": "test-a.testOne", "passed": 2, "failed": 0,
+                    "errors": [], "messages": [], "duration": 1500},
+                   {"test": "test-a.testTwo", "passed": 0, "failed": 2,
+                    "errors": ["failure", "exception"],
+                    "messages": [u"caf\xe9 < 1", "boom"], "duration": 20}]
+        doc = minidom.parseString(runner.make_junit_xml([("pkg", results)]))
+        suite = doc.getElementsByTagName("testsuite")[0]
+        self.assertEqual(suite.getAttribute("tests"), "2")
+        self.assertEqual(suite.getAttribute("failures"), "1")
+        self.assertEqual(suite.getAttribute("time"), "1.520")
+        cases = doc.getElementsByTagName("testcase")
+        self.assertEqual([(case.getAttribute("classname"),
+                           case.getAttribute("name")) for case in cases],
+                         [("test-a", "testOne"), ("test-a", "testTwo")])
+        failure = cases[1].getElementsByTagName("failure")[0]
+        self.assertEqual(failure.getAttribute("message"),
+                         "failure, exception")
+        self.assertEqual(failure.firstChild.data, u"caf\xe9 < 1\nboom")
+
+        # every run of `cfx testall` adds its suite to the same file
+        path = os.path.join(make_basedir(self), "junit.xml")
+        runner.add_junit_suite(path, "one", results[:1])
+        runner.add_junit_suite(path, "two", results[1:])
+        doc = minidom.parse(path)
+        self.assertEqual([suite.getAttribute("name") for suite in
+                          doc.getElementsByTagName("testsuite")],
+                         ["one", "two"])
+
+        lines = runner.get_timing_summary(results)
+        self.assertEqual(lines[0],
+                         "Test timings: 2 tests, 1.52s total, 0.760s mean")
+        self.assertTrue(lines[1].endswith("1.500s  test-a.testOne"))
+
+    def run_cfx(self, args, fail, command="test", addon_dir=None,
+                basedir=None):
+        import cuddlefish
+        from cuddlefish.tests import env_root
+        basedir = basedir or make_basedir(self)
+        binary = os.path.join(basedir, "firefox")
+        open(binary, "w").write(FAKE_BROWSER.replace("PYTHON",
+                                                     sys.executable))
+        os.chmod(binary, 0755)
+        junit_xml = os.path.join(basedir, "junit.xml")
+        old_cwd = os.getcwd()
+        os.chdir(addon_dir or os.path.join(env_root, "python-lib",
+                                           "cuddlefish", "tests", "addons",
+                                           "simplest-test"))
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = out = StringIO()
+        sys.stderr = err = StringIO()
+        os.environ["FAKE_BROWSER_FAIL"] = str(fail)
+        start = time.time()
+        try:
+            try:
+                if command == "test":
+                    args = args + ["--junit-xml", junit_xml]
+                cuddlefish.run(arguments=[command, "--binary", binary] + args,
+                               env_root=env_root, stdout=out)
+                rc = 0
+            except SystemExit, e:
+                rc = e.code
+        finally:
+            del os.environ["FAKE_BROWSER_FAIL"]
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            os.chdir(old_cwd)
+        if command != "test":
+            return rc, out.getvalue() + err.getvalue()
+        return (rc, out.getvalue() + err.getvalue(), time.time() - start,
+                open(junit_xml).read())
+
+    def test_run_results(self):
+        rc, output, elapsed, junit = self.run_cfx(["--verbose"], fail=0)
+        self.assertEqual(rc, 0, output)
+        self.assertTrue("running test-a.testTwo" in output, output)
+        self.assertTrue("Test timings: 2 tests, 0.50s total" in output,
+                        output)
+        self.assertEqual(junit.count("<testcase "), 2)
+        self.assertEqual(junit.count("<failure "), 0)
+
+    def test_stop_on_error(self):
+        rc, output, elapsed, junit = self.run_cfx(["--stop-on-error"],
+                                                  fail=1)
+        self.assertNotEqual(rc, 0, output)
+        self.assertTrue("Stopping: test-a.testTwo failed and "
+                        "--stop-on-error was specified." in output, output)
+        # long before the browser would have finished
+        self.assertTrue(elapsed < 30, elapsed)
+        self.assertEqual(junit.count("<failure "), 1)
+        self.assertTrue("1 &lt; 2 &amp; 3 &gt; 2" in junit, junit)
+
+    def test_memory_report(self):
+        basedir = make_basedir(self)
+        report = os.path.join(basedir, "memory.json")
+        rc, output, elapsed, junit = self.run_cfx(
+            ["--times", "3", "--memory-report", report], 0, basedir=basedir)
+        self.assertEqual(rc, 0, output)
+        self.assertTrue("Memory profile: 2 tests, 0 leak suspects" in output,
+                        output)
+        self.assertTrue(os.path.exists(os.path.join(basedir, "memory.html")))
+        suite = memreport.load_report(report)["simplest-test"]
+        self.assertEqual(suite["tests"]["test-a.testTwo"]["runs"], 3)
+        self.assertEqual(len(suite["iterations"]), 4)
+
+        os.environ["FAKE_BROWSER_LEAK"] = str(2 * 1024 * 1024)
+        try:
+            rc, output, elapsed, junit = self.run_cfx(
+                ["--times", "3", "--memory-baseline", report], 0,
+                basedir=basedir)
+        finally:
+            del os.environ["FAKE_BROWSER_LEAK"]
+        self.assertNotEqual(rc, 0, output)
+        self.assertTrue("Memory use got worse than in %s:\n"
+                        "  test-a.testTwo leaves explicit memory allocated"
+                        % report in output, output)
+        self.assertTrue("explicit grew by +2.0MB per run of the tests, "
+                        "was +0B" in output, output)
+
+    def test_bench(self):
+        from cuddlefish.tests import env_root
+        api_utils = os.path.join(env_root, "packages", "api-utils")
+        basedir = make_basedir(self)
+        baseline = os.path.join(basedir, "baseline.json")
+        def bench(args):
+            return self.run_cfx(["--bench-baseline", baseline] + args, 0,
+                                "bench", api_utils, basedir)
+        os.environ["FAKE_BENCH_SAMPLES"] = "[0.002, 0.001, 0.003]"
+        try:
+            rc, output = bench(["--bench-save"])
+            self.assertEqual(rc, 0, output)
+            self.assertTrue("bench-url.benchResolve: median 2.000us, "
+                            "mean 2.000us, p95 3.000us (3 x 1000)" in output,
+                            output)
+            self.assertTrue(os.path.exists(baseline))
+            # the same again is fine, a lot slower is a regression
+            rc, output = bench([])
+            self.assertEqual(rc, 0, output)
+            self.assertTrue("+0.0% vs baseline" in output, output)
+            os.environ["FAKE_BENCH_SAMPLES"] = "[0.003, 0.003, 0.003]"
+            rc, output = bench([])
+            self.assertEqual(rc, 1, output)
+            self.assertTrue("+50.0% vs baseline REGRESSION" in output, output)
+            rc, output = bench(["--bench-threshold", "60"])
+            self.assertEqual(rc, 0, output)
+            # a benchmark that throws fails the run, after the others are
+            # reported, and they are not saved
+            rc, output = self.run_cfx(["--bench-baseline", baseline,
+                                       "--bench-save"], 1, "bench", api_utils,
+                                      basedir)
+            self.assertNotEqual(rc, 0, output)
+            self.assertTrue("+50.0% vs baseline REGRESSION" in output, output)
+            self.assertFalse("Saved the baseline" in output, output)
+            rc, output = self.run_cfx(["--bench-save"], 0, "bench",
+                                      api_utils, basedir)
+            self.assertEqual(rc, 1, output)
+            self.assertTrue("--bench-save needs --bench-baseline" in output,
+                            output)
+        finally:
+            del os.environ["FAKE_BENCH_SAMPLES"]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,7 @@ import unittest
 import zipfile
 import pprint
 import shutil
+from StringIO import StringIO
 
 import simplejson as json
 from cuddlefish import xpi, packaging, manifest, buildJID
@@ -197,9 +198,14 @@ class SmallXPI(unittest.TestCase):
         self.failUnlessEqual(list(extra), [])
         used_deps = m.get_used_packages()
 
+        stderr = StringIO()
         build = packaging.generate_build_for_target(pkg_cfg, target_cfg.name,
                                                     used_deps,
-                                                    include_tests=False)
+                                                    include_tests=False,
+                                                    stderr=stderr)
+        self.failUnlessEqual(stderr.getvalue(),
+                             "Warning: package 'three-c' overrides the fr-FR "
+                             "translation of 'No' from package 'three-b'\n")
         options = {'main': target_cfg.main}
         options.update(build)
         basedir = self.make_basedir()
@@ -265,8 +271,8 @@ class SmallXPI(unittest.TestCase):
         content = x.read("locale/fr-FR.json")
         locales = json.loads(content)
         # Locale files are merged into one.
-        # Conflicts are silently resolved by taking last package translation,
-        # so that we get "No" translation from three-c instead of three-b one.
+        # Conflicts are resolved by taking last package translation, so that
+        # we get "No" translation from three-c instead of three-b one.
         self.failUnlessEqual(locales, json.loads(u'''
           {
             "No": "Nein",
@@ -280,6 +286,24 @@ class SmallXPI(unittest.TestCase):
             "uft8_value": "\u00e9"
           }'''))
 
+    def test_locale_json_cache(self):
+        first = packaging.Locale()
+        first.merge({"Yes": u"Oui"}, "hash-a", "a")
+        self.failUnlessEqual(first.merge({"Yes": u"Ja", "No": u"Nein"},
+                                         "hash-b", "b"),
+                             [("Yes", "a")])
+        self.failUnlessEqual(first, {"Yes": u"Ja", "No": u"Nein"})
+        data = xpi.get_locale_json(first)
+        self.failUnlessEqual(json.loads(data), first)
+        # the same sources in the same order give back the same bytes
+        second = packaging.Locale()
+        second.merge({"Yes": u"Oui"}, "hash-a", "a")
+        second.merge({"Yes": u"Ja", "No": u"Nein"}, "hash-b", "b")
+        self.failUnless(xpi.get_locale_json(second) is data)
+        # plain dicts are always encoded
+        self.failUnlessEqual(xpi.get_locale_json({"Yes": u"Oui"}),
+                             '{\n "Yes": "Oui"\n}')
+
     def test_scantests(self):
         target_cfg = self.get_pkg("three")
         package_path = [self.get_linker_files_dir("three-deps")]
@@ -300,7 +324,8 @@ class SmallXPI(unittest.TestCase):
 
         build = packaging.generate_build_for_target(pkg_cfg, target_cfg.name,
                                                     used_deps,
-                                                    include_tests=True)
+                                                    include_tests=True,
+                                                    stderr=StringIO())
         options = {'main': target_cfg.main}
         options.update(build)
         basedir = self.make_basedir()
@@ -322,6 +347,67 @@ class SmallXPI(unittest.TestCase):
         self.failUnless("resources/three/tests/test-two.js" in names, names)
         self.failUnless("resources/three/tests/nontest.js" in names, names)
 
+    def test_bundle(self):
+        target_cfg = self.get_pkg("three")
+        package_path = [self.get_linker_files_dir("three-deps")]
+        pkg_cfg = packaging.build_config(self.root, target_cfg,
+                                         packagepath=package_path)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-kit"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps, scan_tests=False)
+        order = [me.get_path() for me in m.get_module_load_order()]
+        self.failUnlessEqual(sorted(order),
+                             sorted(m.get_harness_options_manifest().keys()))
+        # everything main.js requires comes before it
+        self.failUnless(order.index("three/lib/main.js") >
+                        order.index("three-a/lib/main.js"))
+        self.failUnless(order.index("three-a/lib/main.js") >
+                        order.index("three-a/lib/subdir/subfile.js"))
+
+        basedir = self.make_basedir()
+        odd = os.path.join(basedir, "odd.js")
+        odd_source = u"let s = '\u00e9\U0001d11e';\n"
+        open(odd, "wb").write(odd_source.encode("utf-8"))
+        latin1 = os.path.join(basedir, "latin1.js")
+        open(latin1, "wb").write("// caf\xe9\n")
+        modules = [(me.get_path(), me.js_filename)
+                   for me in m.get_module_load_order()]
+        modules += [("odd/lib/odd.js", odd), ("odd/lib/latin1.js", latin1)]
+
+        used_deps = m.get_used_packages()
+        build = packaging.generate_build_for_target(pkg_cfg, target_cfg.name,
+                                                    used_deps,
+                                                    include_tests=False,
+                                                    stderr=StringIO())
+        options = {'main': target_cfg.main}
+        options.update(build)
+        xpi_name = os.path.join(basedir, "contents.xpi")
+        xpi.build_xpi(template_root_dir=xpi_template_path,
+                      manifest=fake_manifest,
+                      xpi_path=xpi_name,
+                      harness_options=options,
+                      limit_to=set(m.get_used_files()),
+                      bundle_modules=modules)
+        x = zipfile.ZipFile(xpi_name, "r")
+        harness_options = json.loads(x.read("harness-options.json"))
+        bundle = harness_options["bundle"]
+        self.failUnlessEqual(bundle["file"], xpi.BUNDLE_FILENAME)
+        offsets = bundle["offsets"]
+        # modules that are not UTF-8 are loaded from their own files
+        self.failIf("odd/lib/latin1.js" in offsets)
+        self.failUnlessEqual(len(offsets), len(modules) - 1)
+        # offsets count UTF-16 code units, like JavaScript's substr()
+        text = x.read(xpi.BUNDLE_FILENAME).decode("utf-8").encode("utf-16-le")
+        def substr(offset, length):
+            return text[offset*2:(offset+length)*2].decode("utf-16-le")
+        for (path, filename) in modules[:-1]:
+            source = open(filename, "rb").read().decode("utf-8")
+            self.failUnlessEqual(substr(*offsets[path]), source)
+        # 14 characters, one of which takes two code units
+        self.failUnlessEqual(offsets["odd/lib/odd.js"][1], 15)
+        # the modules are still in resources/ too
+        self.failUnless("resources/three/lib/main.js" in x.namelist())
+
     def test_scantests_filter(self):
         target_cfg = self.get_pkg("three")
         package_path = [self.get_linker_files_dir("three-deps")]
@@ -334,6 +420,16 @@ class SmallXPI(unittest.TestCase):
                                     test_filter_re=FILTER)
         self.failUnlessEqual(sorted(m.get_all_test_modules()),
                              sorted(["test-one"]))
+        # tests (and what only they need) are not preloaded
+        run_tests = m.get_manifest_entry("test-harness", "lib", "run-tests")
+        order = m.get_load_order(run_tests.get_path())
+        loaded = [path for group in order["loadOrder"] for path in group]
+        self.failUnless("three/tests/test-one.js" in loaded)
+        self.failIf("three/tests/test-one.js" in order["preload"])
+        self.failUnless("test-harness/lib/run-tests.js" in order["preload"])
+        self.failUnlessEqual([path for path in loaded
+                              if path in order["preload"]],
+                             order["preload"])
         # the current __init__.py code omits limit_to=used_files for 'cfx
         # test', so all test files are included in the XPI. But the test
         # runner will only execute the tests that m.get_all_test_modules()
@@ -343,7 +439,8 @@ class SmallXPI(unittest.TestCase):
 
         build = packaging.generate_build_for_target(pkg_cfg, target_cfg.name,
                                                     used_deps,
-                                                    include_tests=True)
+                                                    include_tests=True,
+                                                    stderr=StringIO())
         options = {'main': target_cfg.main}
         options.update(build)
         basedir = self.make_basedir()
@@ -365,6 +462,118 @@ class SmallXPI(unittest.TestCase):
         self.failUnless("resources/three/tests/test-two.js" in names, names)
         self.failUnless("resources/three/tests/nontest.js" in names, names)
 
+    def test_reproducible(self):
+        basedir = self.make_basedir()
+        template_dir = os.path.join(basedir, "template")
+        shutil.copytree(xpi_template_path, template_dir)
+        def build(xpi_name):
+            configs = test_packaging.get_configs("aardvark")
+            options = {'main': configs.target_cfg.main}
+            options.update(configs.build)
+            xpi_path = os.path.join(basedir, xpi_name)
+            xpi.build_xpi(template_root_dir=template_dir,
+                          manifest=fake_manifest,
+                          xpi_path=xpi_path,
+                          harness_options=options)
+            return open(xpi_path, "rb").read()
+        first = build("first.xpi")
+        for dirpath, dirnames, filenames in os.walk(template_dir):
+            for filename in filenames:
+                os.utime(os.path.join(dirpath, filename), (1e9, 1e9))
+        self.failUnlessEqual(build("second.xpi"), first)
+        x = zipfile.ZipFile(os.path.join(basedir, "first.xpi"), "r")
+        for info in x.infolist():
+            self.failUnlessEqual(info.date_time, xpi.ZIP_TIMESTAMP)
+
+    def test_template_layer(self):
+        basedir = self.make_basedir()
+        template_dir = os.path.join(basedir, "template")
+        shutil.copytree(xpi_template_path, template_dir)
+        cache_dir = os.path.join(basedir, "templates")
+        def build(xpi_name):
+            configs = test_packaging.get_configs("aardvark")
+            options = {'main': configs.target_cfg.main}
+            options.update(configs.build)
+            xpi_path = os.path.join(basedir, xpi_name)
+            xpi.build_xpi(template_root_dir=template_dir,
+                          manifest=fake_manifest,
+                          xpi_path=xpi_path,
+                          harness_options=options,
+                          template_cache_dir=cache_dir)
+            x = zipfile.ZipFile(xpi_path, "r")
+            self.failUnlessEqual(x.testzip(), None)
+            x.close()
+            return open(xpi_path, "rb").read()
+        xpi._template_layers.clear()
+        first = build("first.xpi")
+        self.failUnlessEqual(len(os.listdir(cache_dir)), 1)
+        layer = xpi.get_template_layer(template_dir, [], cache_dir)
+        self.failUnless(xpi.get_template_layer(template_dir, [],
+                                               cache_dir) is layer)
+        self.failUnlessEqual(sorted(layer.members), ["components/harness.js"])
+        # layers built by another process come from the cache directory
+        xpi._template_layers.clear()
+        self.failUnlessEqual(build("second.xpi"), first)
+        self.failUnlessEqual(build("third.xpi"), first)
+        self.failUnlessEqual(len(os.listdir(cache_dir)), 1)
+        # and a changed template makes a new one
+        harness_js = os.path.join(template_dir, "components", "harness.js")
+        open(harness_js, "a").write("// changed\n")
+        x = zipfile.ZipFile(os.path.join(basedir, "first.xpi"), "r")
+        old_harness_js = x.read("components/harness.js")
+        changed = build("changed.xpi")
+        self.failIfEqual(changed, first)
+        x = zipfile.ZipFile(os.path.join(basedir, "changed.xpi"), "r")
+        self.failUnlessEqual(x.read("components/harness.js"),
+                             old_harness_js + "// changed\n")
+        self.failUnlessEqual(len(os.listdir(cache_dir)), 2)
+        # without the zipfile internals, members are compressed again, to
+        # the same bytes
+        self.failUnless(xpi.SPLICE_DEFLATED)
+        xpi._template_layers.clear()
+        xpi.SPLICE_DEFLATED = False
+        try:
+            self.failUnlessEqual(build("fallback.xpi"), changed)
+        finally:
+            xpi.SPLICE_DEFLATED = True
+            xpi._template_layers.clear()
+
+    def test_build_cache(self):
+        basedir = self.make_basedir()
+        package_dir = os.path.join(basedir, "package")
+        template_dir = os.path.join(basedir, "template")
+        os.makedirs(os.path.join(package_dir, "lib"))
+        os.makedirs(template_dir)
+        main = os.path.join(package_dir, "lib", "main.js")
+        open(main, "w").write("exports.main = 1;\n")
+        xpi_path = os.path.join(package_dir, "package.xpi")
+        def key(options={}):
+            return xpi.get_build_key([package_dir], template_dir, options,
+                                     "1.0", ignored_paths=[xpi_path])
+        first = key()
+        self.failUnlessEqual(key(), first)
+        open(xpi_path, "w").write("built")
+        self.failUnlessEqual(key(), first)
+        self.failIfEqual(key({"bundle": True}), first)
+        self.failIfEqual(xpi.get_build_key([package_dir], template_dir, {},
+                                           "1.1", [xpi_path]), first)
+        open(main, "w").write("exports.main = 2;\n")
+        second = key()
+        self.failIfEqual(second, first)
+
+        cache = xpi.BuildCache(os.path.join(basedir, "cache"), max_entries=2)
+        self.failIf(cache.fetch(first, xpi_path))
+        cache.store(first, xpi_path)
+        os.remove(xpi_path)
+        self.failUnless(cache.fetch(first, xpi_path))
+        self.failUnlessEqual(open(xpi_path).read(), "built")
+        os.utime(cache.get_path(first), (1e9, 1e9))
+        cache.store(second, xpi_path)
+        cache.store("third", xpi_path)
+        # the least recently used entry goes first
+        self.failIf(cache.fetch(first, xpi_path))
+        self.failUnless(cache.fetch(second, xpi_path))
+
 
 def document_dir(name):
     if name in ['packages', 'xpi-template']:
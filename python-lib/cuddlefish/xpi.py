@@ -3,8 +3,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import stat
+import shutil
+import hashlib
+import struct
 import zipfile
-import simplejson as json
+from StringIO import StringIO
+from cuddlefish import json_backend as json
 from cuddlefish.util import filter_filenames, filter_dirnames
 
 class HarnessOptionAlreadyDefinedError(Exception):
@@ -16,25 +21,248 @@ ZIPSEP = "/" # always use "/" in zipfiles
 def make_zipfile_path(localroot, localpath):
     return ZIPSEP.join(localpath[len(localroot)+1:].split(os.sep))
 
+# Every entry gets the same timestamp (ZipInfo's default), and files get
+# one of two modes, so that building the same add-on twice gives the same
+# XPI, byte for byte, wherever and whenever it is built.
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
 def mkzipdir(zf, path):
-    dirinfo = zipfile.ZipInfo(path)
+    dirinfo = zipfile.ZipInfo(path, ZIP_TIMESTAMP)
     dirinfo.external_attr = int("040755", 8) << 16L
     zf.writestr(dirinfo, "")
 
+def zipfile_write(zf, filename, arcname):
+    # like zf.write(filename, arcname), but reproducible
+    info = zipfile.ZipInfo(arcname, ZIP_TIMESTAMP)
+    if os.stat(filename).st_mode & stat.S_IXUSR:
+        info.external_attr = 0755 << 16L
+    else:
+        info.external_attr = 0644 << 16L
+    info.compress_type = zf.compression
+    zf.writestr(info, open(filename, "rb").read())
+
+def zipfile_write_deflated(zf, info, data):
+    # like zf.writestr(info, ...), for data that `info` describes and that
+    # is already deflated
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.external_attr = info.external_attr
+    zinfo.compress_type = info.compress_type
+    zinfo.CRC = info.CRC
+    zinfo.file_size = info.file_size
+    zinfo.compress_size = info.compress_size
+    zinfo.header_offset = zf.fp.tell()
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+def read_deflated(zf, info):
+    # the raw (still deflated) data of a member of a zip file
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    zf.fp.seek(info.header_offset + 30 + name_length + extra_length)
+    return zf.fp.read(info.compress_size)
+
+def can_splice_deflated():
+    # zipfile_write_deflated() and read_deflated() rely on the internals of
+    # zipfile, so try them once on a small zip file before trusting them
+    try:
+        output = StringIO()
+        zf = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
+        zf.writestr(zipfile.ZipInfo("probe", ZIP_TIMESTAMP), "probe " * 10)
+        zf.close()
+        zf = zipfile.ZipFile(StringIO(output.getvalue()), "r")
+        info = zf.getinfo("probe")
+        spliced = StringIO()
+        zf2 = zipfile.ZipFile(spliced, "w", zipfile.ZIP_DEFLATED)
+        zipfile_write_deflated(zf2, info, read_deflated(zf, info))
+        zf2.close()
+        zf = zipfile.ZipFile(StringIO(spliced.getvalue()), "r")
+        return zf.testzip() is None and zf.read("probe") == "probe " * 10
+    except Exception:
+        return False
+
+# when False, TemplateLayer falls back to compressing each member again
+SPLICE_DEFLATED = can_splice_deflated()
+
+TEMPLATE_CACHE_DIRNAME = os.path.join(".xpi-cache", "templates")
+MAX_TEMPLATE_LAYERS = 5
+
+class TemplateLayer:
+    """The files of an XPI template (like cuddlefish/app-extension), zipped
+    once, so that build_xpi() can copy their deflated data into each XPI
+    instead of compressing them again (unless SPLICE_DEFLATED is False).
+    `data` is a zip file of the template, the same bytes for the same
+    template files."""
+    def __init__(self, data):
+        self.data = data
+        zf = zipfile.ZipFile(StringIO(data), "r")
+        self.dirs = set()
+        self.members = {} # maps zipfile path to (ZipInfo, deflated data)
+        for info in zf.infolist():
+            if info.filename.endswith("/"):
+                self.dirs.add(info.filename[:-1])
+            elif SPLICE_DEFLATED:
+                self.members[info.filename] = (info, read_deflated(zf, info))
+            else:
+                self.members[info.filename] = (info, zf.read(info))
+        zf.close()
+
+    def write(self, zf, name):
+        info, data = self.members[name]
+        if SPLICE_DEFLATED:
+            zipfile_write_deflated(zf, info, data)
+        else:
+            zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+            zinfo.external_attr = info.external_attr
+            zinfo.compress_type = info.compress_type
+            zf.writestr(zinfo, data)
+
+def walk_template(template_root_dir, ignored_files):
+    # returns the directories (zipfile paths) and files (zipfile path to
+    # local-disk abspath) that an XPI gets from the template
+    dirs = set()
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(template_root_dir):
+        filenames = list(filter_filenames(filenames, ignored_files))
+        dirnames[:] = filter_dirnames(dirnames)
+        for dirname in dirnames:
+            arcpath = make_zipfile_path(template_root_dir,
+                                        os.path.join(dirpath, dirname))
+            dirs.add(arcpath)
+        for filename in filenames:
+            abspath = os.path.join(dirpath, filename)
+            arcpath = make_zipfile_path(template_root_dir, abspath)
+            files[arcpath] = abspath
+    return dirs, files
+
+# maps template keys to TemplateLayers built by this process
+_template_layers = {}
+
+def get_template_layer(template_root_dir, ignored_files, cache_dir=None):
+    """Return the TemplateLayer for the template in `template_root_dir`,
+    reusing the one built by this process, or stored under `cache_dir` by
+    another one, when the template files have not changed."""
+    dirs, files = walk_template(template_root_dir, ignored_files)
+    key = hashlib.sha256()
+    for name in sorted(dirs):
+        key.update("\0dir:" + name)
+    for name in sorted(files):
+        key.update("\0" + name + "\0")
+        key.update(hashlib.sha256(open(files[name], "rb").read()).digest())
+        key.update(str(bool(os.stat(files[name]).st_mode & stat.S_IXUSR)))
+    key = key.hexdigest()
+    if key in _template_layers:
+        return _template_layers[key]
+    path = cache_dir and os.path.join(cache_dir, key + ".zip")
+    if path and os.path.exists(path):
+        layer = TemplateLayer(open(path, "rb").read())
+        os.utime(path, None) # recently used
+    else:
+        output = StringIO()
+        zf = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
+        for name in sorted(dirs.union(files)):
+            if name in dirs:
+                mkzipdir(zf, name + "/")
+            if name in files:
+                zipfile_write(zf, files[name], name)
+        zf.close()
+        layer = TemplateLayer(output.getvalue())
+        if path:
+            store_template_layer(cache_dir, path, layer)
+    _template_layers[key] = layer
+    return layer
+
+def store_template_layer(cache_dir, path, layer):
+    # the cache is only an optimization: a read-only SDK still builds XPIs
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = path + ".tmp"
+        open(tmp_path, "wb").write(layer.data)
+        os.rename(tmp_path, path)
+        layers = [os.path.join(cache_dir, filename)
+                  for filename in os.listdir(cache_dir)
+                  if filename.endswith(".zip")]
+        layers.sort(key=lambda path: os.stat(path).st_mtime)
+        for old in layers[:-MAX_TEMPLATE_LAYERS]:
+            os.remove(old)
+    except EnvironmentError:
+        pass
+
+# maps the sources of a packaging.Locale to its locale/<language>.json
+_locale_json_cache = {}
+
+def get_locale_json(locale):
+    # Locales merged from the same .properties files always encode to the
+    # same bytes, so only the first build in a process has to encode them
+    sources = getattr(locale, "sources", None)
+    if sources:
+        key = tuple(sources)
+        if key in _locale_json_cache:
+            return _locale_json_cache[key]
+    # Be carefull about strings, we need to always ensure working with UTF-8
+    jsonStr = json.dumps(locale, indent=1, sort_keys=True, ensure_ascii=False)
+    data = jsonStr.encode("utf-8")
+    if sources:
+        _locale_json_cache[key] = data
+    return data
+
+BUNDLE_FILENAME = "modules-bundle.js"
+
+def js_length(text):
+    # the length of a unicode string as JavaScript counts it, in UTF-16
+    # code units, whatever the width of this Python's unicode
+    return len(text.encode("utf-16-le")) / 2
+
+def make_bundle(modules, minified_modules={}):
+    """Concatenate modules into one bundle. `modules` is a list of (path,
+    local filename) pairs, in load order, where the path is the module's
+    manifest path, like 'api-utils/lib/loader.js'. Modules that are in
+    `minified_modules` (see minify.minify_modules()) are bundled minified.
+
+    Returns the UTF-8 bytes of the bundle, and a dict that maps each path
+    to the [offset, length] of that module's source in the decoded bundle,
+    counted in UTF-16 code units so that the loader can substr() them out
+    of the text it reads. Modules that are not valid UTF-8 are left out,
+    and keep being loaded from their own files."""
+    chunks = []
+    offsets = {}
+    position = 0
+    for (path, filename) in modules:
+        if filename in minified_modules:
+            data = minified_modules[filename].data
+        else:
+            data = open(filename, "rb").read()
+        try:
+            source = data.decode("utf-8")
+        except UnicodeDecodeError:
+            continue
+        length = js_length(source)
+        offsets[path] = [position, length]
+        chunks.append(source)
+        chunks.append(u"\n")
+        position += length + 1
+    return u"".join(chunks).encode("utf-8"), offsets
+
 def build_xpi(template_root_dir, manifest, xpi_path,
-              harness_options, limit_to=None, extra_harness_options={}):
+              harness_options, limit_to=None, extra_harness_options={},
+              bundle_modules=None, minified_modules=None,
+              template_cache_dir=None):
     zf = zipfile.ZipFile(xpi_path, "w", zipfile.ZIP_DEFLATED)
 
     open('.install.rdf', 'w').write(str(manifest))
-    zf.write('.install.rdf', 'install.rdf')
+    zipfile_write(zf, '.install.rdf', 'install.rdf')
     os.remove('.install.rdf')
 
     if 'icon' in harness_options:
-        zf.write(str(harness_options['icon']), 'icon.png')
+        zipfile_write(zf, str(harness_options['icon']), 'icon.png')
         del harness_options['icon']
 
     if 'icon64' in harness_options:
-        zf.write(str(harness_options['icon64']), 'icon64.png')
+        zipfile_write(zf, str(harness_options['icon64']), 'icon64.png')
         del harness_options['icon64']
 
     if 'preferences' in harness_options:
@@ -45,7 +273,7 @@ def build_xpi(template_root_dir, manifest, xpi_path,
         opts_xul = parse_options(harness_options["preferences"],
                                  harness_options["jetpackID"])
         open('.options.xul', 'wb').write(opts_xul.encode("utf-8"))
-        zf.write('.options.xul', 'options.xul')
+        zipfile_write(zf, '.options.xul', 'options.xul')
         os.remove('.options.xul')
 
         from options_defaults import parse_options_defaults
@@ -56,7 +284,7 @@ def build_xpi(template_root_dir, manifest, xpi_path,
     else:
         open('.prefs.js', 'wb').write("")
 
-    zf.write('.prefs.js', 'defaults/preferences/prefs.js')
+    zipfile_write(zf, '.prefs.js', 'defaults/preferences/prefs.js')
     os.remove('.prefs.js')
 
 
@@ -66,17 +294,10 @@ def build_xpi(template_root_dir, manifest, xpi_path,
     files_to_copy = {} # maps zipfile path to local-disk abspath
     dirs_to_create = set() # zipfile paths, no trailing slash
 
-    for dirpath, dirnames, filenames in os.walk(template_root_dir):
-        filenames = list(filter_filenames(filenames, IGNORED_FILES))
-        dirnames[:] = filter_dirnames(dirnames)
-        for dirname in dirnames:
-            arcpath = make_zipfile_path(template_root_dir,
-                                        os.path.join(dirpath, dirname))
-            dirs_to_create.add(arcpath)
-        for filename in filenames:
-            abspath = os.path.join(dirpath, filename)
-            arcpath = make_zipfile_path(template_root_dir, abspath)
-            files_to_copy[arcpath] = abspath
+    # the template files are already deflated, in the layer
+    template = get_template_layer(template_root_dir, IGNORED_FILES,
+                                  template_cache_dir)
+    dirs_to_create.update(template.dirs)
 
     # `packages` attribute contains a dictionnary of dictionnary
     # of all packages sections directories
@@ -114,11 +335,9 @@ def build_xpi(template_root_dir, manifest, xpi_path,
     for language in sorted(harness_options['locale']):
         locales_json_data["locales"].append(language)
         locale = harness_options['locale'][language]
-        # Be carefull about strings, we need to always ensure working with UTF-8
-        jsonStr = json.dumps(locale, indent=1, sort_keys=True, ensure_ascii=False)
         info = zipfile.ZipInfo('locale/' + language + '.json')
         info.external_attr = 0644 << 16L
-        zf.writestr(info, jsonStr.encode( "utf-8" ))
+        zf.writestr(info, get_locale_json(locale))
     del harness_options['locale']
 
     jsonStr = json.dumps(locales_json_data, ensure_ascii=True) +"\n"
@@ -135,13 +354,35 @@ def build_xpi(template_root_dir, manifest, xpi_path,
 
     # create zipfile in alphabetical order, with each directory before its
     # files
-    for name in sorted(dirs_to_create.union(set(files_to_copy))):
+    names = dirs_to_create.union(files_to_copy, template.members)
+    for name in sorted(names):
         if name in dirs_to_create:
             mkzipdir(zf, name+"/")
-        if name in files_to_copy:
-            zf.write(files_to_copy[name], name)
+        if name in template.members and name not in files_to_copy:
+            template.write(zf, name)
+        elif name in files_to_copy:
+            abspath = files_to_copy[name]
+            if minified_modules and abspath in minified_modules:
+                info = zipfile.ZipInfo(name)
+                info.external_attr = 0644 << 16L
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zf.writestr(info, minified_modules[abspath].data)
+            else:
+                zipfile_write(zf, abspath, name)
 
     harness_options = harness_options.copy()
+
+    if bundle_modules is not None:
+        # the modules stay in resources/ too, for the code that loads some
+        # of them by URI (like content scripts)
+        bundle, offsets = make_bundle(bundle_modules, minified_modules or {})
+        info = zipfile.ZipInfo(BUNDLE_FILENAME)
+        info.external_attr = 0644 << 16L
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zf.writestr(info, bundle)
+        harness_options['bundle'] = {"file": BUNDLE_FILENAME,
+                                     "offsets": offsets}
+
     for key,value in extra_harness_options.items():
         if key in harness_options:
             msg = "Can't use --harness-option for existing key '%s'" % key
@@ -149,7 +390,122 @@ def build_xpi(template_root_dir, manifest, xpi_path,
         harness_options[key] = value
     open('.options.json', 'w').write(json.dumps(harness_options, indent=1,
                                                 sort_keys=True))
-    zf.write('.options.json', 'harness-options.json')
+    zipfile_write(zf, '.options.json', 'harness-options.json')
     os.remove('.options.json')
 
     zf.close()
+
+BUILD_CACHE_DIRNAME = ".xpi-cache"
+MAX_CACHED_XPIS = 20
+
+def hash_tree(key, root, ignored_paths):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted([dirname for dirname
+                              in filter_dirnames(dirnames)
+                              if os.path.join(dirpath, dirname)
+                              not in ignored_paths])
+        for filename in sorted(filter_filenames(filenames)):
+            path = os.path.join(dirpath, filename)
+            if path in ignored_paths:
+                continue
+            key.update("\0" + make_zipfile_path(root, path) + "\0")
+            key.update(hashlib.sha256(open(path, "rb").read()).digest())
+
+def get_build_key(package_dirs, template_root_dir, options, sdk_version,
+                  ignored_paths=[]):
+    """Return a hash of everything an XPI is built from: the files of the
+    packages in `package_dirs` (package.json included), the template, the
+    cfx code itself, the command-line `options` (a dict) and the SDK
+    version. Files in `ignored_paths`, like the XPI being built, are left
+    out, so that writing it does not change the key."""
+    key = hashlib.sha256(sdk_version)
+    key.update("\0" + json.dumps(options, sort_keys=True, default=repr))
+    ignored_paths = set([os.path.abspath(path) for path in ignored_paths])
+    cfx_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(os.listdir(cfx_dir)):
+        if filename.endswith(".py"):
+            key.update("\0cfx:" + filename + "\0")
+            key.update(hashlib.sha256(open(os.path.join(cfx_dir, filename),
+                                           "rb").read()).digest())
+    for root in [template_root_dir] + sorted(set(package_dirs)):
+        key.update("\0tree:" + os.path.abspath(root))
+        hash_tree(key, os.path.abspath(root), ignored_paths)
+    return key.hexdigest()
+
+class BuildCache:
+    """The last MAX_CACHED_XPIS XPIs that cfx built, keyed on
+    get_build_key(). XPIs are copied in and out rather than hard-linked,
+    since build_xpi() rewrites its output file in place."""
+    def __init__(self, cache_dir, max_entries=MAX_CACHED_XPIS):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".xpi")
+
+    def _copy(self, src, dst):
+        # copy to a temporary file first, so an interrupted run can never
+        # leave a truncated XPI behind
+        tmp_path = dst + ".tmp"
+        shutil.copyfile(src, tmp_path)
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(tmp_path, dst)
+
+    def fetch(self, key, xpi_path):
+        """Copy the XPI built for `key` to `xpi_path`, and return True, or
+        return False if there is none."""
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return False
+        self._copy(path, xpi_path)
+        os.utime(path, None) # recently used
+        return True
+
+    def store(self, key, xpi_path):
+        self._copy(xpi_path, self.get_path(key))
+        entries = [os.path.join(self.cache_dir, filename)
+                   for filename in os.listdir(self.cache_dir)
+                   if filename.endswith(".xpi")]
+        entries.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in entries[:-self.max_entries]:
+            os.remove(path)
+
+def benchmark_bundle(xpi_path, rounds=5):
+    # A cold start reads every module the add-on loads out of the XPI. Time
+    # that both ways: one zip member per module, like resource:// URLs for
+    # resources/ do, and one read of the bundle that is then sliced up.
+    import time
+    zf = zipfile.ZipFile(xpi_path, "r")
+    options = json.loads(zf.read("harness-options.json"))
+    if "bundle" not in options:
+        raise ValueError("%s was not built with --bundle" % xpi_path)
+    offsets = options["bundle"]["offsets"]
+    def per_file():
+        for path in offsets:
+            zf.read("resources/" + path).decode("utf-8")
+    def bundled():
+        text = zf.read(options["bundle"]["file"]).decode("utf-8")
+        for (offset, length) in offsets.values():
+            text[offset:offset+length]
+    results = []
+    for (name, read_all) in [("per-file", per_file), ("bundle", bundled)]:
+        best = None
+        for i in range(rounds):
+            start = time.time()
+            read_all()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, best))
+    zf.close()
+    return len(offsets), results
+
+if __name__ == '__main__':
+    import sys
+    count, results = benchmark_bundle(sys.argv[1])
+    print "%d modules" % count
+    for (name, elapsed) in results:
+        print "%-10s %.4fs" % (name, elapsed)
@@ -382,14 +382,14 @@ class Markdown:
 
         # Split into lines and run the line preprocessors.
         self.lines = source.split("\n")
-        for prep in self.preprocessors.values():
+        for prep in self.preprocessors.itervalues():
             self.lines = prep.run(self.lines)
 
         # Parse the high-level elements.
         root = self.parser.parseDocument(self.lines).getroot()
 
         # Run the tree-processors
-        for treeprocessor in self.treeprocessors.values():
+        for treeprocessor in self.treeprocessors.itervalues():
             newRoot = treeprocessor.run(root)
             if newRoot:
                 root = newRoot
@@ -402,7 +402,7 @@ class Markdown:
             output = output[start:end].strip()
 
         # Run the text post-processors
-        for pp in self.postprocessors.values():
+        for pp in self.postprocessors.itervalues():
             output = pp.run(output)
 
         return output.strip()
@@ -21,6 +21,9 @@ Dependencies:
 """
 
 import markdown
+import os
+import sys
+import hashlib
 
 # --------------- CONSTANTS YOU MIGHT WANT TO MODIFY -----------------
 
@@ -29,6 +32,131 @@ try:
 except AttributeError:
     TAB_LENGTH = 4
 
+CACHE_SIZE = 500    # highlighted blocks kept in memory and on disk
+
+
+# ------------------ The Highlighted Code Cache ----------------------
+class HiliteCache:
+    """
+    Keep highlighted HTML so that unchanged code blocks skip Pygments.
+
+    Entries are keyed on a hash of the code, its language and the options
+    that affect the output (and on the Pygments version, if it is
+    installed). The most recently used `max_entries` are kept in memory.
+    If `cache_dir` is given, entries are also written there, one file per
+    block. The files are counted in memory, and once there are a quarter
+    more than `max_entries` of them, the least recently used are removed
+    down to `max_entries`, so that most calls never list the directory.
+
+    """
+
+    def __init__(self, cache_dir=None, max_entries=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries = markdown.odict.OrderedDict()
+        self.file_count = None # counted when the first file is written
+        try:
+            import pygments
+            self.hiliter_version = "pygments-%s" % pygments.__version__
+        except ImportError:
+            self.hiliter_version = "none"
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, src, lang, linenos, css_class):
+        """ Return the cache key for a code block and its options. """
+        h = hashlib.sha1(self.hiliter_version)
+        for part in (lang or "", str(bool(linenos)), css_class, src):
+            h.update("\0" + part.encode('utf8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Return the cached html for `key`, or None. """
+        path = None
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, key + ".html")
+        if key in self.entries:
+            html = self.entries.pop(key)
+            self.entries[key] = html
+            if path:
+                self._touch(path)
+            return html
+        if path:
+            try:
+                html = open(path, "rb").read().decode('utf8')
+            except IOError:
+                return None
+            self._touch(path)
+            self._remember(key, html)
+            return html
+        return None
+
+    def _touch(self, path):
+        # the file modification time is its "last used" time
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass # evicted by another process
+
+    def set(self, key, html):
+        """ Store the highlighted html for `key`. """
+        self._remember(key, html)
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, key + ".html")
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            open(tmp_path, "wb").write(html.encode('utf8'))
+            if self.file_count is None:
+                self.file_count = len(self._list_files())
+            exists = os.path.exists(path)
+            if exists and sys.platform == "win32":
+                os.remove(path) # windows can't rename over a file
+            os.rename(tmp_path, path)
+            if not exists:
+                self.file_count += 1
+            if self.file_count > self.max_entries + self.max_entries // 4:
+                self._evict_files()
+
+    def _remember(self, key, html):
+        self.entries[key] = html
+        while len(self.entries) > self.max_entries:
+            del self.entries[self.entries.iterkeys().next()]
+
+    def _list_files(self):
+        return [n for n in os.listdir(self.cache_dir) if n.endswith(".html")]
+
+    def _evict_files(self):
+        paths = [os.path.join(self.cache_dir, n) for n in self._list_files()]
+        self.file_count = len(paths)
+        if len(paths) <= self.max_entries:
+            return
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = 0 # already removed by another process
+        paths.sort(key=mtimes.get)
+        for path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass # another process got there first
+        self.file_count = self.max_entries
+
+_caches = {}
+
+def get_cache(cache_dir=None, max_entries=CACHE_SIZE):
+    """
+    Return the shared HiliteCache for `cache_dir`, so that the in-memory
+    entries outlive any single Markdown instance.
+
+    """
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = HiliteCache(cache_dir, max_entries)
+    cache.max_entries = max_entries
+    return cache
+
 
 # ------------------ The Main CodeHilite Class ----------------------
 class CodeHilite:
@@ -44,6 +172,8 @@ class CodeHilite:
     * linenos: (Boolen) Turn line numbering 'on' or 'off' (off by default).
 
     * css_class: Set class name of wrapper div ('codehilite' by default).
+
+    * cache: A HiliteCache to reuse earlier results from (None by default).
       
     Low Level Usage:
         >>> code = CodeHilite()
@@ -53,11 +183,13 @@ class CodeHilite:
     
     """
 
-    def __init__(self, src=None, linenos=False, css_class="codehilite"):
+    def __init__(self, src=None, linenos=False, css_class="codehilite",
+                 cache=None):
         self.src = src
         self.lang = None
         self.linenos = linenos
         self.css_class = css_class
+        self.cache = cache
 
     def hilite(self):
         """
@@ -74,6 +206,18 @@ class CodeHilite:
         
         self._getLang()
 
+        if self.cache is None:
+            return self._hilite()
+        key = self.cache.key(self.src, self.lang, self.linenos,
+                             self.css_class)
+        html = self.cache.get(key)
+        if html is None:
+            html = self._hilite()
+            self.cache.set(key, html)
+        return html
+
+    def _hilite(self):
+        """ Highlight self.src, once the language has been determined. """
         try:
             from pygments import highlight
             from pygments.lexers import get_lexer_by_name, guess_lexer, \
@@ -186,7 +330,8 @@ class HiliteTreeprocessor(markdown.treeprocessors.Treeprocessor):
             if len(children) == 1 and children[0].tag == 'code':
                 code = CodeHilite(children[0].text, 
                             linenos=self.config['force_linenos'][0],
-                            css_class=self.config['css_class'][0])
+                            css_class=self.config['css_class'][0],
+                            cache=self.cache)
                 placeholder = self.markdown.htmlStash.store(code.hilite(), 
                                                             safe=True)
                 # Clear codeblock in etree instance
@@ -206,6 +351,9 @@ class CodeHiliteExtension(markdown.Extension):
             'force_linenos' : [False, "Force line numbers - Default: False"],
             'css_class' : ["codehilite", 
                            "Set class name for wrapper <div> - Default: codehilite"],
+            'use_cache' : [True, "Reuse earlier highlighting - Default: True"],
+            'cache_dir' : ["", "Also keep highlighted blocks in this directory - Default: none"],
+            'cache_size' : [CACHE_SIZE, "Blocks kept in memory and on disk - Default: %d" % CACHE_SIZE],
             }
         
         # Override defaults with user settings
@@ -216,6 +364,13 @@ class CodeHiliteExtension(markdown.Extension):
         """ Add HilitePostprocessor to Markdown instance. """
         hiliter = HiliteTreeprocessor(md)
         hiliter.config = self.config
+        hiliter.cache = None
+        use_cache = self.getConfig('use_cache')
+        if isinstance(use_cache, basestring): # from "codehilite(use_cache=..)"
+            use_cache = use_cache.lower() not in ("false", "0", "no", "")
+        if use_cache:
+            hiliter.cache = get_cache(self.getConfig('cache_dir') or None,
+                                      int(self.getConfig('cache_size')))
         md.treeprocessors.add("hilite", hiliter, "_begin") 
 
 
@@ -90,6 +90,31 @@ ENTITY_RE = r'(&[\#a-zA-Z0-9]*;)'               # &amp;
 LINE_BREAK_RE = r'  \n'                     # two spaces at end of line
 LINE_BREAK_2_RE = r'  $'                    # two spaces at end of text
 
+# Literal strings that any match of the built-in expressions must contain.
+# InlineProcessor uses these to skip, with one cheap substring test, every
+# pattern that cannot possibly match a piece of text, instead of running its
+# regular expression over the whole string. Expressions that are not listed
+# here (e.g. those added by extensions) are always tried.
+PATTERN_TRIGGERS = {
+    BACKTICK_RE: ('`',),
+    ESCAPE_RE: ('\\',),
+    EMPHASIS_RE: ('*',),
+    STRONG_RE: ('**', '__'),
+    STRONG_EM_RE: ('***', '___'),
+    EMPHASIS_2_RE: ('_',),
+    LINK_RE: ('](',),
+    IMAGE_LINK_RE: ('![',),
+    REFERENCE_RE: ('[',),
+    IMAGE_REFERENCE_RE: ('![',),
+    NOT_STRONG_RE: (' * ',),
+    AUTOLINK_RE: ('://',),
+    AUTOMAIL_RE: ('@',),
+    HTML_RE: ('<',),
+    ENTITY_RE: ('&',),
+    LINE_BREAK_RE: ('  \n',),
+    LINE_BREAK_2_RE: ('  ',),
+}
+
 
 def dequote(string):
     """Remove quotes from around a string."""
@@ -127,6 +152,7 @@ class Pattern:
         """
         self.pattern = pattern
         self.compiled_re = re.compile("^(.*?)%s(.*?)$" % pattern, re.DOTALL)
+        self.triggers = PATTERN_TRIGGERS.get(pattern)
 
         # Api for Markdown to pass safe_mode into instance
         self.safe_mode = False
@@ -137,6 +163,21 @@ class Pattern:
         """ Return a compiled regular expression. """
         return self.compiled_re
 
+    def mayMatch(self, text):
+        """
+        Return False if the pattern cannot match anywhere in `text`.
+
+        This only looks for the pattern's trigger strings, so a True result
+        does not mean that the regular expression will match.
+
+        """
+        if not self.triggers:
+            return True
+        for trigger in self.triggers:
+            if trigger in text:
+                return True
+        return False
+
     def handleMatch(self, m):
         """Return a ElementTree element from the given match.
 
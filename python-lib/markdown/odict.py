@@ -1,26 +1,110 @@
+# Indexes into the nodes of the linked list that keeps the key order.
+PREV, NEXT, KEY = 0, 1, 2
+
 class OrderedDict(dict):
     """
     A dictionary that keeps its keys in the order in which they're inserted.
-    
+
     Copied from Django's SortedDict with some modifications.
 
+    The order is kept in a doubly linked list of [prev, next, key] nodes,
+    found through a dict, so inserting, moving and deleting a key are O(1),
+    including `add()` relative to another key. The lists of keys and values
+    and the position of each key are built on demand and cached until the
+    dictionary changes, so iterating over a registry, or reading it by
+    index, is as cheap as iterating over a list.
+
     """
     def __new__(cls, *args, **kwargs):
         instance = super(OrderedDict, cls).__new__(cls, *args, **kwargs)
-        instance.keyOrder = []
+        instance._clearLinks()
         return instance
 
     def __init__(self, data=None):
         if data is None:
             data = {}
         super(OrderedDict, self).__init__(data)
+        self._clearLinks()
         if isinstance(data, dict):
-            self.keyOrder = data.keys()
+            keys = data.keys()
         else:
-            self.keyOrder = []
-            for key, value in data:
-                if key not in self.keyOrder:
-                    self.keyOrder.append(key)
+            keys = [key for key, value in data]
+        for key in keys:
+            if key not in self._map:
+                self._link(key, self._root)
+
+    def _clearLinks(self):
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._map = {}
+        self._invalidate()
+
+    def _invalidate(self):
+        self._keys = None
+        self._values = None
+        self._positions = None
+
+    def _link(self, key, successor):
+        """ Link a new node for `key` in just before the node `successor`. """
+        prev = successor[PREV]
+        node = [prev, successor, key]
+        prev[NEXT] = node
+        successor[PREV] = node
+        self._map[key] = node
+        self._invalidate()
+
+    def _unlink(self, key):
+        node = self._map.pop(key)
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+        self._invalidate()
+        return node
+
+    def _keyList(self):
+        if self._keys is None:
+            keys = []
+            root = self._root
+            node = root[NEXT]
+            while node is not root:
+                keys.append(node[KEY])
+                node = node[NEXT]
+            self._keys = keys
+        return self._keys
+
+    def _valueList(self):
+        if self._values is None:
+            getitem = super(OrderedDict, self).__getitem__
+            self._values = [getitem(k) for k in self._keyList()]
+        return self._values
+
+    def _positionMap(self):
+        if self._positions is None:
+            self._positions = dict([(k, i) for i, k
+                                    in enumerate(self._keyList())])
+        return self._positions
+
+    def _successorForLocation(self, location):
+        """ Return the node that an item added at `location` goes before. """
+        if location == '_begin':
+            return self._root[NEXT]
+        elif location == '_end':
+            return self._root
+        elif location.startswith('<') or location.startswith('>'):
+            try:
+                node = self._map[location[1:]]
+            except KeyError:
+                raise ValueError('%r is not in list' % location[1:])
+            if location.startswith('>'):
+                return node[NEXT]
+            return node
+        else:
+            raise ValueError('Not a valid location: "%s". Location key '
+                             'must start with a ">" or "<".' % location)
+
+    @property
+    def keyOrder(self):
+        """ The keys, in order (read-only). """
+        return self.keys()
 
     def __deepcopy__(self, memo):
         from copy import deepcopy
@@ -29,80 +113,83 @@ class OrderedDict(dict):
 
     def __setitem__(self, key, value):
         super(OrderedDict, self).__setitem__(key, value)
-        if key not in self.keyOrder:
-            self.keyOrder.append(key)
+        if key not in self._map:
+            self._link(key, self._root)
+        else:
+            self._values = None
 
     def __delitem__(self, key):
         super(OrderedDict, self).__delitem__(key)
-        self.keyOrder.remove(key)
+        self._unlink(key)
 
     def __iter__(self):
-        for k in self.keyOrder:
-            yield k
+        return iter(self._keyList())
 
     def pop(self, k, *args):
         result = super(OrderedDict, self).pop(k, *args)
-        try:
-            self.keyOrder.remove(k)
-        except ValueError:
-            # Key wasn't in the dictionary in the first place. No problem.
-            pass
+        if k in self._map:
+            self._unlink(k)
         return result
 
     def popitem(self):
         result = super(OrderedDict, self).popitem()
-        self.keyOrder.remove(result[0])
+        self._unlink(result[0])
         return result
 
     def items(self):
-        return zip(self.keyOrder, self.values())
+        return zip(self._keyList(), self._valueList())
 
     def iteritems(self):
-        for key in self.keyOrder:
-            yield key, super(OrderedDict, self).__getitem__(key)
+        getitem = super(OrderedDict, self).__getitem__
+        for key in self._keyList():
+            yield key, getitem(key)
 
     def keys(self):
-        return self.keyOrder[:]
+        return self._keyList()[:]
 
     def iterkeys(self):
-        return iter(self.keyOrder)
+        return iter(self._keyList())
 
     def values(self):
-        return [super(OrderedDict, self).__getitem__(k) for k in self.keyOrder]
+        return self._valueList()[:]
 
     def itervalues(self):
-        for key in self.keyOrder:
-            yield super(OrderedDict, self).__getitem__(key)
+        return iter(self._valueList())
 
     def update(self, dict_):
         for k, v in dict_.items():
             self.__setitem__(k, v)
 
     def setdefault(self, key, default):
-        if key not in self.keyOrder:
-            self.keyOrder.append(key)
-        return super(OrderedDict, self).setdefault(key, default)
+        if key not in self._map:
+            self.__setitem__(key, default)
+        return super(OrderedDict, self).__getitem__(key)
 
     def value_for_index(self, index):
         """Return the value of the item at the given zero-based index."""
-        return self[self.keyOrder[index]]
+        return self._valueList()[index]
 
     def insert(self, index, key, value):
         """Insert the key, value pair before the item with the given index."""
-        if key in self.keyOrder:
-            n = self.keyOrder.index(key)
-            del self.keyOrder[n]
+        keys = self._keyList()
+        if key in self._map:
+            n = self.index(key)
+            keys = keys[:n] + keys[n+1:]
             if n < index:
                 index -= 1
-        self.keyOrder.insert(index, key)
+            self._unlink(key)
+        if index < 0:
+            index = max(len(keys) + index, 0)
+        if index < len(keys):
+            self._link(key, self._map[keys[index]])
+        else:
+            self._link(key, self._root)
         super(OrderedDict, self).__setitem__(key, value)
 
     def copy(self):
         """Return a copy of this object."""
         # This way of initializing the copy means it works for subclasses, too.
-        obj = self.__class__(self)
-        obj.keyOrder = self.keyOrder[:]
-        return obj
+        return self.__class__(self)
 
     def __repr__(self):
         """
@@ -113,11 +200,14 @@ class OrderedDict(dict):
 
     def clear(self):
         super(OrderedDict, self).clear()
-        self.keyOrder = []
+        self._clearLinks()
 
     def index(self, key):
         """ Return the index of a given key. """
-        return self.keyOrder.index(key)
+        try:
+            return self._positionMap()[key]
+        except KeyError:
+            raise ValueError('%r is not in list' % key)
 
     def index_for_location(self, location):
         """ Return index or None for a given location. """
@@ -140,23 +230,64 @@ class OrderedDict(dict):
 
     def add(self, key, value, location):
         """ Insert by key location. """
-        i = self.index_for_location(location)
-        if i is not None:
-            self.insert(i, key, value)
+        if location == '_end' or key not in self._map:
+            successor = self._successorForLocation(location)
+            if key in self._map:
+                # adding an existing key at the end just replaces its value
+                self.__setitem__(key, value)
+                return
+            self._link(key, successor)
+            super(OrderedDict, self).__setitem__(key, value)
         else:
-            self.__setitem__(key, value)
+            self.insert(self.index_for_location(location), key, value)
 
     def link(self, key, location):
         """ Change location of an existing item. """
-        n = self.keyOrder.index(key)
-        del self.keyOrder[n]
-        i = self.index_for_location(location)
+        successor = self._unlink(key)[NEXT]
         try:
-            if i is not None:
-                self.keyOrder.insert(i, key)
-            else:
-                self.keyOrder.append(key)
-        except Error:
+            new_successor = self._successorForLocation(location)
+        except ValueError:
             # restore to prevent data loss and reraise
-            self.keyOrder.insert(n, key)
-            raise Error
+            self._link(key, successor)
+            raise
+        self._link(key, new_successor)
+
+
+if __name__ == '__main__':
+    # micro-benchmarks for the operations the Markdown registries rely on
+    import sys, time
+
+    def bench(name, func, n):
+        start = time.time()
+        func(n)
+        print "%-32s n=%-6d %.4fs" % (name, n, time.time() - start)
+
+    def add_relative(n):
+        d = OrderedDict()
+        d['first'] = 0
+        for i in range(n):
+            d.add('k%d' % i, i, '>first')
+
+    def delete_all(n):
+        d = OrderedDict([('k%d' % i, i) for i in range(n)])
+        for i in range(n):
+            del d['k%d' % i]
+
+    def iterate_values(n):
+        d = OrderedDict([('k%d' % i, i) for i in range(20)])
+        for i in range(n):
+            for value in d.itervalues():
+                pass
+
+    def value_by_index(n):
+        d = OrderedDict([('k%d' % i, i) for i in range(20)])
+        for i in range(n):
+            for j in range(20):
+                d.value_for_index(j)
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    for n in sizes:
+        bench("add(key, value, '>first')", add_relative, n)
+        bench("__delitem__", delete_all, n)
+        bench("itervalues() on 20 items", iterate_values, n)
+        bench("value_for_index() on 20 items", value_by_index, n)
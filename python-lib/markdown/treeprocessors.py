@@ -90,9 +90,16 @@ class InlineProcessor(Treeprocessor):
         if not isinstance(data, markdown.AtomicString):
             startIndex = 0
             while patternIndex < len(self.markdown.inlinePatterns):
-                data, matched, startIndex = self.__applyPattern(
-                    self.markdown.inlinePatterns.value_for_index(patternIndex),
-                    data, patternIndex, startIndex)
+                pattern = self.markdown.inlinePatterns.value_for_index(
+                    patternIndex)
+                # Replacing a match only ever removes text or adds
+                # placeholders, so a pattern whose trigger strings are
+                # missing now can never match later on either.
+                if hasattr(pattern, "mayMatch") and not pattern.mayMatch(data):
+                    matched, startIndex = False, 0
+                else:
+                    data, matched, startIndex = self.__applyPattern(
+                        pattern, data, patternIndex, startIndex)
                 if not matched:
                     patternIndex += 1
         return data
@@ -11,6 +11,7 @@ import commands
 import zipfile
 import optparse
 import killableprocess
+import proctree
 import subprocess
 import platform
 import shutil
@@ -155,14 +156,205 @@ def addon_details(install_rdf_fh):
 
     return details
 
+UNPACK_BUFFER_SIZE = 64 * 1024
+
+def unpack_member(xpi_zipfile, info, path, default_mode):
+    src = xpi_zipfile.open(info)
+    try:
+        dst = open(path, 'wb')
+        try:
+            shutil.copyfileobj(src, dst, UNPACK_BUFFER_SIZE)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    mode = (info.external_attr >> 16) & 07777
+    if mode and mode != default_mode:
+        os.chmod(path, mode)
+
+def unpack_members_in_threads(xpi_path, members, default_mode, threads):
+    import threading
+    import Queue
+    queue = Queue.Queue()
+    for member in members:
+        queue.put(member)
+    errors = []
+    def work():
+        # ZipFile objects share one file position, so each thread has its own
+        xpi_zipfile = zipfile.ZipFile(xpi_path, "r")
+        try:
+            while not errors:
+                try:
+                    info, path = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                unpack_member(xpi_zipfile, info, path, default_mode)
+        except Exception:
+            errors.append(sys.exc_info())
+        xpi_zipfile.close()
+    workers = [threading.Thread(target=work)
+               for i in range(min(threads, len(members)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+def unpack_xpi(xpi_zipfile, addon_path, threads=1):
+    """Extracts every member of xpi_zipfile into addon_path. Files are
+    copied through a fixed-size buffer instead of being read whole, each
+    directory is only created once, and if threads is more than 1, files are
+    written by that many threads, each reading its own handle on the XPI."""
+    created = set()
+    members = []
+    for info in xpi_zipfile.infolist():
+        path = os.path.join(addon_path, info.filename)
+        if info.filename.endswith('/'):
+            dirname = path
+        else:
+            dirname = os.path.dirname(path)
+            members.append((info, path))
+        if dirname not in created:
+            makedirs(dirname)
+            created.add(dirname)
+
+    # files get their mode from the XPI, which only needs a chmod when
+    # the umask would give them a different one
+    umask = os.umask(0)
+    os.umask(umask)
+    default_mode = 0666 & ~umask
+
+    if threads > 1 and len(members) > 1 and xpi_zipfile.filename:
+        unpack_members_in_threads(xpi_zipfile.filename, members,
+                                  default_mode, threads)
+    else:
+        for info, path in members:
+            unpack_member(xpi_zipfile, info, path, default_mode)
+
+MAX_STORED_ADDONS = 20
+
+def remove_stored_tree(path):
+    # Windows won't delete the read-only files of an AddonStore entry
+    def make_writable(function, path, excinfo):
+        os.chmod(path, 0700)
+        function(path)
+    shutil.rmtree(path, False, make_writable)
+
+class AddonStore(object):
+    """Unpacked copies of XPIs, keyed on the SHA-256 of their contents, so
+    that installing the same add-on into many profiles neither parses its
+    install.rdf nor unpacks it again. Each entry is a directory holding the
+    addon_details() of the XPI as details.json and, for add-ons that are
+    installed unpacked, the unpacked tree as addon/.
+
+    Profiles get hard links to the stored files where the file system
+    allows it, and copies elsewhere. Stored files are made read-only, so
+    that nothing writing into a profile can change them for the others.
+    Only the max_entries most recently used add-ons are kept."""
+
+    def __init__(self, store_dir, max_entries=MAX_STORED_ADDONS):
+        self.store_dir = store_dir
+        self.max_entries = max_entries
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+    def get_key(self, xpi_path):
+        import hashlib
+        h = hashlib.sha256()
+        f = open(xpi_path, 'rb')
+        try:
+            for data in iter(lambda: f.read(UNPACK_BUFFER_SIZE), ''):
+                h.update(data)
+        finally:
+            f.close()
+        return h.hexdigest()
+
+    def get(self, xpi_path):
+        """Return the addon_details() of the XPI at xpi_path, and the path
+        of its stored unpacked tree (None if it is installed packed),
+        storing it first if it isn't already."""
+        entry = os.path.join(self.store_dir, self.get_key(xpi_path))
+        if not os.path.isdir(entry):
+            self.store(xpi_path, entry)
+        os.utime(entry, None) # recently used
+        details = simplejson.load(open(os.path.join(entry, 'details.json')))
+        tree = os.path.join(entry, 'addon')
+        if not os.path.isdir(tree):
+            tree = None
+        return details, tree
+
+    def store(self, xpi_path, entry):
+        # build it next to where it goes and rename it into place, so that
+        # an interrupted run, or one running at the same time, never leaves
+        # a partial entry behind
+        tmp_entry = '%s.%d.tmp' % (entry, os.getpid())
+        if os.path.isdir(tmp_entry):
+            remove_stored_tree(tmp_entry)
+        os.makedirs(tmp_entry)
+        xpi_zipfile = zipfile.ZipFile(xpi_path, 'r')
+        try:
+            details = addon_details(StringIO(xpi_zipfile.read('install.rdf')))
+            if details.get('unpack', True):
+                tree = os.path.join(tmp_entry, 'addon')
+                unpack_xpi(xpi_zipfile, tree)
+                for dirpath, dirnames, filenames in os.walk(tree):
+                    for name in filenames:
+                        path = os.path.join(dirpath, name)
+                        os.chmod(path, os.stat(path).st_mode & ~0222)
+        finally:
+            xpi_zipfile.close()
+        f = open(os.path.join(tmp_entry, 'details.json'), 'w')
+        simplejson.dump(details, f)
+        f.close()
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+            remove_stored_tree(tmp_entry) # stored by someone else meanwhile
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.store_dir, name)
+                   for name in os.listdir(self.store_dir)
+                   if not name.endswith('.tmp')]
+        entries.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in entries[:-self.max_entries]:
+            remove_stored_tree(path)
+
+    def clone(self, tree, dest):
+        """Make dest a copy of the stored tree, with hard links if possible."""
+        link = getattr(os, 'link', None)
+        for dirpath, dirnames, filenames in os.walk(tree):
+            destdir = os.path.join(dest, os.path.relpath(dirpath, tree))
+            if not os.path.isdir(destdir):
+                os.makedirs(destdir)
+            for name in filenames:
+                src = os.path.join(dirpath, name)
+                dst = os.path.join(destdir, name)
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                if link is not None:
+                    try:
+                        link(src, dst)
+                        continue
+                    except OSError:
+                        # e.g. another file system, stop trying
+                        link = None
+                shutil.copy2(src, dst)
+                os.chmod(dst, os.stat(dst).st_mode | 0200)
+
 class Profile(object):
     """Handles all operations regarding profile. Created new profiles, installs extensions,
     sets preferences and handles cleanup."""
 
     def __init__(self, binary=None, profile=None, addons=None,
-                 preferences=None):
+                 preferences=None, unpack_threads=1, addon_store=None):
 
         self.binary = binary
+        self.unpack_threads = unpack_threads
+        self.addon_store = addon_store
 
         self.create_new = not(bool(profile))
         if profile:
@@ -182,7 +374,7 @@ class Profile(object):
         self.preferences.update(preferences)
 
         for addon in self.addons:
-            self.install_addon(addon)
+            self.install_addon(addon, self.addon_store)
 
         self.set_preferences(self.preferences)
 
@@ -191,21 +383,18 @@ class Profile(object):
         profile = tempfile.mkdtemp(suffix='.mozrunner')
         return profile
 
-    def unpack_addon(self, xpi_zipfile, addon_path):
-        for name in xpi_zipfile.namelist():
-            if name.endswith('/'):
-                makedirs(os.path.join(addon_path, name))
-            else:
-                if not os.path.isdir(os.path.dirname(os.path.join(addon_path, name))):
-                    makedirs(os.path.dirname(os.path.join(addon_path, name)))
-                data = xpi_zipfile.read(name)
-                f = open(os.path.join(addon_path, name), 'wb')
-                f.write(data) ; f.close()
-                zi = xpi_zipfile.getinfo(name)
-                os.chmod(os.path.join(addon_path,name), (zi.external_attr>>16))
+    def unpack_addon(self, xpi_zipfile, addon_path, threads=None):
+        """Extracts xpi_zipfile into addon_path with unpack_xpi(), by
+        default with self.unpack_threads threads. cfx always uses one;
+        unpack_threads is only for library callers like bin/bench-install."""
+        if threads is None:
+            threads = self.unpack_threads
+        unpack_xpi(xpi_zipfile, addon_path, threads)
 
-    def install_addon(self, path):
-        """Installs the given addon or directory of addons in the profile."""
+    def install_addon(self, path, store=None):
+        """Installs the given addon or directory of addons in the profile.
+        XPIs come from the AddonStore store, if one is given and it
+        can be filled."""
 
         extensions_path = os.path.join(self.profile, 'extensions')
         if not os.path.exists(extensions_path):
@@ -216,7 +405,22 @@ class Profile(object):
             addons = [os.path.join(path, x) for x in os.listdir(path)]
 
         for addon in addons:
-            if addon.endswith('.xpi'):
+            stored = None
+            if addon.endswith('.xpi') and store is not None:
+                try:
+                    stored = store.get(addon)
+                except EnvironmentError:
+                    # e.g. a store that cannot be written; unpack it here
+                    pass
+            if stored is not None:
+                details, tree = stored
+                addon_path = os.path.join(extensions_path, details["id"])
+                if tree is not None:
+                    store.clone(tree, addon_path)
+                    self.addons_installed.append(addon_path)
+                else:
+                    shutil.copy(addon, addon_path + '.xpi')
+            elif addon.endswith('.xpi'):
                 xpi_zipfile = zipfile.ZipFile(addon, "r")
                 details = addon_details(StringIO(xpi_zipfile.read('install.rdf')))
                 addon_path = os.path.join(extensions_path, details["id"])
@@ -522,17 +726,27 @@ class Runner(object):
 
         return repository
 
+    process_tree = None
+
     def start(self):
         """Run self.command in the proper environment."""
         if self.profile is None:
             self.profile = self.profile_class()
         self.process_handler = run_command(self.command+self.cmdargs, self.env, **self.kp_kwargs)
+        if sys.platform != 'win32' and proctree.is_supported():
+            # run_command() made the process the leader of its own group
+            pid = self.process_handler.pid
+            self.process_tree = proctree.ProcessTree(pid, pgid=pid)
 
     def wait(self, timeout=None):
         """Wait for the browser to exit."""
         self.process_handler.wait(timeout=timeout)
 
-        if sys.platform != 'win32':
+        if self.process_tree is not None:
+            # the processes it started, even if they outlived it
+            if not self.process_tree.wait(timeout):
+                self.process_tree.kill(signal.SIGKILL)
+        elif sys.platform != 'win32':
             for name in self.names:
                 for pid in get_pids(name, self.process_handler.pid):
                     self.process_handler.pid = pid
@@ -540,7 +754,10 @@ class Runner(object):
 
     def kill(self, kill_signal=signal.SIGTERM):
         """Kill the browser"""
-        if sys.platform != 'win32':
+        if self.process_tree is not None:
+            self.process_handler.kill()
+            self.process_tree.kill(signal.SIGKILL)
+        elif sys.platform != 'win32':
             self.process_handler.kill()
             for name in self.names:
                 for pid in get_pids(name, self.process_handler.pid):
@@ -53,6 +53,8 @@ import os
 import time
 import datetime
 import types
+import errno
+import select
 import exceptions
 
 try:
@@ -75,6 +77,7 @@ if mswindows:
     import winprocess
 else:
     import signal
+    import fcntl
 
 # This is normally defined in win32con, but we don't want
 # to incur the huge tree of dependencies (pywin32 and friends)
@@ -103,8 +106,58 @@ if not mswindows:
     def DoNothing(*args):
         pass
 
+    class SigchldWakeup:
+        """Makes every SIGCHLD write a byte to a pipe, through
+        signal.set_wakeup_fd(), so that waiting for a child to exit can sleep
+        in select() with a timeout instead of polling. Signals can only be
+        handled by the main thread, so install() returns None in others."""
+        def __init__(self):
+            self.read_fd, self.write_fd = os.pipe()
+            for fd in (self.read_fd, self.write_fd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        def install(cls):
+            wakeup = cls()
+            try:
+                wakeup.old_fd = signal.set_wakeup_fd(wakeup.write_fd)
+            except ValueError:
+                wakeup.close()
+                return None
+            # SIGCHLD is ignored by default, which doesn't wake anything up
+            wakeup.old_handler = signal.signal(signal.SIGCHLD, DoNothing)
+            return wakeup
+        install = classmethod(install)
+
+        def sleep(self, timeout):
+            """Sleep until a child changes state, or timeout seconds pass."""
+            try:
+                select.select([self.read_fd], [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            try:
+                while os.read(self.read_fd, 512):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+        def uninstall(self):
+            signal.signal(signal.SIGCHLD, self.old_handler)
+            signal.set_wakeup_fd(self.old_fd)
+            self.close()
+
+        def close(self):
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+
 class Popen(subprocess.Popen):
     kill_called = False
+    # Seconds between SIGTERM and SIGKILL when wait() times out, and how
+    # long that took, if it did.
+    terminate_grace = 5
+    teardown_time = None
     if mswindows:
         def _execute_child(self, args, executable, preexec_fn, close_fds,
                            cwd, env, universal_newlines, startupinfo,
@@ -200,7 +253,12 @@ class Popen(subprocess.Popen):
         """Wait for the process to terminate. Returns returncode attribute.
         If timeout seconds are reached and the process has not terminated,
         it will be forcefully killed. If timeout is -1, wait will not
-        time out."""
+        time out.
+
+        On POSIX, the timeout is exact: SIGCHLD wakes the wait up as soon as
+        the process exits. A process that times out gets SIGTERM (its whole
+        group with group=True), then SIGKILL after terminate_grace seconds,
+        and teardown_time tells how long that took."""
         if timeout is not None:
             # timeout is now in milliseconds
             timeout = timeout * 1000
@@ -257,52 +315,66 @@ class Popen(subprocess.Popen):
                 self.kill(group)
 
         else:
-            if (sys.platform == 'linux2') or (sys.platform in ('sunos5', 'solaris')):
-                def group_wait(timeout):
-                    try:
-                        os.waitpid(self.pid, 0)
-                    except OSError, e:
-                        pass # If wait has already been called on this pid, bad things happen
-                    return self.returncode
-            elif sys.platform == 'darwin':
-                def group_wait(timeout):
-                    try:
-                        count = 0
-                        if timeout is None and self.kill_called:
-                            timeout = 10 # Have to set some kind of timeout or else this could go on forever
-                        if timeout is None:
-                            while 1:
-                                os.killpg(self.pid, signal.SIG_DFL)
-                        while ((count * 2) <= timeout):
-                            os.killpg(self.pid, signal.SIG_DFL)
-                            # count is increased by 500ms for every 0.5s of sleep
-                            time.sleep(.5); count += 500
-                    except exceptions.OSError:
-                        return self.returncode
-                        
-            if timeout is None:
-                if group is True:
-                    return group_wait(timeout)
-                else:
-                    subprocess.Popen.wait(self)
-                    return self.returncode
-
-            returncode = False
-
-            now = datetime.datetime.now()
-            diff = now - starttime
-            while (diff.seconds * 1000 * 1000 + diff.microseconds) < (timeout * 1000) and ( returncode is False ):
-                if group is True:
-                    return group_wait(timeout)
-                else:
-                    if subprocess.poll() is not None:
-                        returncode = self.returncode
-                time.sleep(.5)
-                now = datetime.datetime.now()
-                diff = now - starttime
-            return self.returncode
-                
+            if timeout is None or timeout < 0:
+                self._reap(0)
+            elif not self._wait_exit(timeout / 1000.0):
+                self._terminate(group)
         return self.returncode
+
+    if not mswindows:
+        def _reap(self, flags=os.WNOHANG):
+            """Collect the exit status of the process if it has exited, and
+            return whether it has."""
+            try:
+                pid, sts = os.waitpid(self.pid, flags)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                return True # someone else already waited for it
+            if pid == 0:
+                return False
+            self._handle_exitstatus(sts)
+            return True
+
+        def _wait_exit(self, timeout):
+            """Wait until the process exits, or timeout seconds pass, and
+            return whether it exited."""
+            deadline = time.time() + timeout
+            wakeup = SigchldWakeup.install()
+            delay = 0.001
+            try:
+                while not self._reap():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    if wakeup:
+                        wakeup.sleep(remaining)
+                    else:
+                        time.sleep(min(delay, remaining))
+                        delay = min(delay * 2, 0.05)
+                return True
+            finally:
+                if wakeup:
+                    wakeup.uninstall()
+
+        def _terminate(self, group):
+            """Ask the process (and its group) to exit with SIGTERM, and send
+            SIGKILL if it is still there after terminate_grace seconds."""
+            start = time.time()
+            for sig, grace in [(signal.SIGTERM, self.terminate_grace),
+                               (signal.SIGKILL, 10)]:
+                try:
+                    if group:
+                        os.killpg(self.pid, sig)
+                    else:
+                        os.kill(self.pid, sig)
+                except OSError:
+                    pass
+                if self._wait_exit(grace):
+                    break
+            self.kill_called = True
+            self.teardown_time = time.time() - start
+
     # We get random maxint errors from subprocesses __del__
     __del__ = lambda self: None        
         
@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Keep track of a launched process and all of its descendants by reading
+/proc, so that they can be waited for and killed without running `ps` and
+without matching unrelated processes by name."""
+
+import os
+import time
+import errno
+import signal
+
+PROC_ROOT = '/proc'
+
+def is_supported():
+    """Whether this system has a Linux-style /proc."""
+    return os.path.exists(os.path.join(PROC_ROOT, str(os.getpid()), 'stat'))
+
+def read_stat(pid):
+    """Return (ppid, pgrp, state, starttime) for pid, or None if there is no
+    such process."""
+    try:
+        f = open(os.path.join(PROC_ROOT, str(pid), 'stat'))
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    # the command name is in parentheses, and may itself contain spaces and
+    # parentheses, so the other fields are the ones after the last ')'
+    fields = data[data.rfind(')') + 2:].split()
+    if len(fields) < 20:
+        return None
+    return int(fields[1]), int(fields[2]), fields[0], int(fields[19])
+
+def get_process_table():
+    """Return a dict of pid: (ppid, pgrp, state, starttime) for every
+    process."""
+    table = {}
+    for name in os.listdir(PROC_ROOT):
+        if not name.isdigit():
+            continue
+        stat = read_stat(int(name))
+        if stat is not None:
+            table[int(name)] = stat
+    return table
+
+class ProcessTree(object):
+    """The process `pid` and every process it starts.
+
+    A process belongs to the tree if its parent does, or if it is in the
+    process group `pgid` (killableprocess puts the processes it starts in a
+    group of their own), which catches the ones whose parent exits before we
+    look. Once seen, a process stays in the tree until it exits, even if it
+    gets a new parent or group. Processes are remembered along with their
+    start time, so a reused pid is never mistaken for one of them."""
+
+    poll_interval = 0.05
+
+    def __init__(self, pid, pgid=None):
+        self.pid = pid
+        self.pgid = pgid
+        self.known = {}
+        self.update()
+
+    def update(self):
+        """Look at /proc again, and return the pids of the processes in the
+        tree that are still running."""
+        table = get_process_table()
+        children = {}
+        for pid, (ppid, pgrp, state, starttime) in table.items():
+            children.setdefault(ppid, []).append(pid)
+
+        live = {}
+        for pid, starttime in self.known.items():
+            if pid in table and table[pid][3] == starttime:
+                live[pid] = starttime
+        if self.pid in table and self.pid not in live:
+            live[self.pid] = table[self.pid][3]
+        if self.pgid is not None:
+            for pid, (ppid, pgrp, state, starttime) in table.items():
+                if pgrp == self.pgid:
+                    live[pid] = starttime
+        pending = live.keys()
+        while pending:
+            for child in children.get(pending.pop(), []):
+                if child not in live:
+                    live[child] = table[child][3]
+                    pending.append(child)
+
+        self.known = live
+        # zombies have exited, they are only waiting for their parent
+        return sorted([pid for pid in live if table[pid][2] != 'Z'])
+
+    def _reap(self):
+        # The root is our child, and stays a zombie until we wait for it.
+        # Others are reaped by their parent or by init.
+        try:
+            os.waitpid(self.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+
+    def wait(self, timeout=None):
+        """Wait until every process in the tree has exited, or timeout
+        seconds have passed. Return True if they all exited."""
+        start = time.time()
+        while True:
+            self._reap()
+            if not self.update():
+                return True
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            time.sleep(self.poll_interval)
+
+    def kill(self, sig=signal.SIGKILL):
+        """Send sig to every process in the tree, and return their pids."""
+        pids = self.update()
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        return pids